@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Minoru Kobayashi <unknownbit@gmail.com> (@unkn0wnbit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+TABLE_NAME = "SpotlightDataView-1-store"
+# Columns read by extract_spotlight_dataview_file_download. The other columns are filled with text of this length.
+READ_COLUMNS = ("kMDItemDownloadedDate", "kMDItemWhereFroms", "FullPath")
+FILLER_LENGTH = 36
+FIRST_DAY = datetime.datetime(2023, 6, 1)
+
+
+def create_mac_apt_db(db_path: str, rows_count: int, columns_count: int, days: int) -> None:
+    # A SpotlightDataView table as wide as the ones mac_apt creates, with download dates spread over the days.
+    filler_columns = [f"kMDItemAttribute{index:03d}" for index in range(columns_count - len(READ_COLUMNS))]
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        f'CREATE TABLE "{TABLE_NAME}" (' + ", ".join(f'"{column}" TEXT' for column in READ_COLUMNS + tuple(filler_columns)) + ")"
+    )
+    step = datetime.timedelta(days=days) / rows_count
+    rows = (
+        (
+            (FIRST_DAY + step * index).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            f"https://example.com/file{index}.zip, https://example.com/",
+            f"/Users/user/Downloads/file{index}.zip",
+            *(f"{column}-{index:0{FILLER_LENGTH - len(column) - 1}d}" for column in filler_columns),
+        )
+        for index in range(rows_count)
+    )
+    conn.executemany(f'INSERT INTO "{TABLE_NAME}" VALUES (?' + ",?" * (columns_count - 1) + ")", rows)
+    conn.commit()
+    conn.close()
+
+
+def load_repository(repo_path: str):
+    # The ma2tl checkout to measure, e.g. a worktree of an older commit to compare with.
+    sys.path.insert(0, repo_path)
+    import ma2tl
+    from plugins import file_download
+    from plugins.helpers import basic_info as basicinfo
+
+    file_download.log = logging.getLogger("BENCH")
+    return ma2tl, basicinfo, file_download
+
+
+def run_benchmark(repo, input_path: str, start_ts: str, end_ts: str, runs: int) -> tuple[float, int, dict]:
+    ma2tl, basicinfo, file_download = repo
+    macapt_dbs = basicinfo.MacAptDbs()
+    if not ma2tl.check_input_path(input_path, macapt_dbs):
+        sys.exit(1)
+    macapt_dbs.open_dbs()
+    basic_info = basicinfo.BasicInfo(macapt_dbs, basicinfo.OutputParams(), start_ts, end_ts, "UTC")
+
+    best_time = None
+    events = []
+    for _ in range(runs):
+        events = []
+        started_time = time.perf_counter()
+        file_download.extract_spotlight_dataview_file_download(basic_info, events)
+        elapsed_time = time.perf_counter() - started_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+
+    # The rows that the query layer hands to the extractor are counted in a separate run, outside of the timing.
+    stats = {"rows": 0, "values": 0, "characters": 0}
+    select = macapt_dbs.select
+
+    def counting_select(db_type, query):
+        rows = list(select(db_type, query))
+        for row in rows:
+            values = list(row.values()) if isinstance(row, dict) else list(row)
+            stats["rows"] += 1
+            stats["values"] += len(values)
+            stats["characters"] += sum(len(value) for value in values if isinstance(value, str))
+        return rows
+
+    macapt_dbs.select = counting_select
+    file_download.extract_spotlight_dataview_file_download(basic_info, [])
+    macapt_dbs.select = select
+
+    basic_info.data_writer.close_writer()
+    macapt_dbs.close_dbs()
+    return best_time, len(events), stats
+
+
+def print_result(label: str, best_time: float, events_count: int, stats: dict, runs: int) -> None:
+    rows = stats["rows"] or 1
+    print(
+        f"{label}: best {best_time:.3f} s of {runs}, {events_count} events, "
+        f"{stats['values'] / rows:.1f} values and {stats['characters'] / rows:.0f} characters of text per row"
+    )
+
+
+def parse_arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Measure extract_spotlight_dataview_file_download on a synthetic SpotlightDataView table.\n"
+        "Run it with --repo pointing to checkouts of two commits to compare them.\n",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--repo",
+        action="store",
+        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        help="Path to the ma2tl checkout to measure (Default: the checkout of this script)",
+    )
+    parser.add_argument(
+        "--rows", action="store", type=int, default=100000, help="Number of rows in the table (Default: 100000)"
+    )
+    parser.add_argument(
+        "--columns", action="store", type=int, default=123, help="Number of text columns in the table (Default: 123)"
+    )
+    parser.add_argument(
+        "--days",
+        action="store",
+        type=int,
+        default=120,
+        help="Number of days the download dates are spread over. The time window is two days (Default: 120)",
+    )
+    parser.add_argument("--runs", action="store", type=int, default=5, help="Number of runs, the best is reported (Default: 5)")
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        default=False,
+        help="Also measure the Parquet conversion of the table created by madb2parquet.py (needs pyarrow)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.columns <= len(READ_COLUMNS) or args.rows <= 0 or args.days < 2 or args.runs <= 0:
+        print("Invalid table size or number of runs.")
+        sys.exit(1)
+
+    repo_path = os.path.abspath(args.repo)
+    if not os.path.isfile(os.path.join(repo_path, "ma2tl.py")):
+        print(f"{repo_path} is not a ma2tl checkout.")
+        sys.exit(1)
+    repo = load_repository(repo_path)
+
+    start_dt = FIRST_DAY + datetime.timedelta(days=args.days // 2)
+    start_ts = start_dt.strftime("%Y-%m-%d %H:%M:%S")
+    end_ts = (start_dt + datetime.timedelta(days=2, seconds=-1)).strftime("%Y-%m-%d %H:%M:%S")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        sqlite_dir = os.path.join(work_dir, "sqlite")
+        os.makedirs(sqlite_dir)
+        db_path = os.path.join(sqlite_dir, "mac_apt.db")
+        create_mac_apt_db(db_path, args.rows, args.columns, args.days)
+        print(f"{TABLE_NAME}: {args.rows} rows, {args.columns} text columns, time window {start_ts} - {end_ts}")
+        print_result("SQLite ", *run_benchmark(repo, sqlite_dir, start_ts, end_ts, args.runs), args.runs)
+
+        if args.parquet:
+            parquet_dir = os.path.join(work_dir, "parquet")
+            os.makedirs(parquet_dir)
+            result = subprocess.run(
+                [sys.executable, os.path.join(repo_path, "helper_tools", "madb2parquet.py"), "-i", db_path, "-o", parquet_dir],
+                stdout=subprocess.DEVNULL,
+            )
+            if result.returncode != 0:
+                sys.exit(1)
+            print_result("Parquet", *run_benchmark(repo, parquet_dir, start_ts, end_ts, args.runs), args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Minoru Kobayashi <unknownbit@gmail.com> (@unkn0wnbit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# import time:       self [us] |  cumulative | imported package
+REGEX_IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)\s*$")
+
+
+def run_once(ma2tl_path: str, module_name: str) -> tuple[float, int | None]:
+    # Returns the wall time of "ma2tl.py -h" in seconds and the cumulative import time of the module in microseconds.
+    started_time = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", ma2tl_path, "-h"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    wall_time = time.perf_counter() - started_time
+    if result.returncode != 0:
+        print(f"{ma2tl_path} -h failed:\n{result.stderr}")
+        sys.exit(1)
+
+    cumulative_time = None
+    for line in result.stderr.splitlines():
+        match = REGEX_IMPORT_TIME.match(line)
+        if match and match.group(3) == module_name:
+            cumulative_time = int(match.group(2))
+    return wall_time, cumulative_time
+
+
+def parse_arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='Measure the startup time of "ma2tl.py -h" with "python -X importtime".\n'
+        "Run it with --repo pointing to checkouts of two commits to compare them.\n",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--repo",
+        action="store",
+        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        help="Path to the ma2tl checkout to measure (Default: the checkout of this script)",
+    )
+    parser.add_argument("--runs", action="store", type=int, default=7, help="Number of runs (Default: 7)")
+    parser.add_argument(
+        "--module",
+        action="store",
+        default="plugins.helpers.basic_info",
+        help="Module whose cumulative import time is reported (Default: plugins.helpers.basic_info)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.runs <= 0:
+        print(f"Invalid number of runs: {args.runs}")
+        sys.exit(1)
+
+    ma2tl_path = os.path.join(os.path.abspath(args.repo), "ma2tl.py")
+    if not os.path.isfile(ma2tl_path):
+        print(f"{ma2tl_path} does not exist.")
+        sys.exit(1)
+
+    # The first run writes the bytecode caches, so it is not counted.
+    run_once(ma2tl_path, args.module)
+    wall_times = []
+    import_times = []
+    for _ in range(args.runs):
+        wall_time, import_time = run_once(ma2tl_path, args.module)
+        wall_times.append(wall_time)
+        if import_time is not None:
+            import_times.append(import_time)
+
+    if import_times:
+        print(
+            f"{args.module} cumulative import: median {statistics.median(import_times) / 1000:.1f} ms "
+            f"(min {min(import_times) / 1000:.1f} ms, max {max(import_times) / 1000:.1f} ms)"
+        )
+    else:
+        print(f"{args.module} is not imported by ma2tl.py -h")
+    print(
+        f"ma2tl.py -h wall time: median {statistics.median(wall_times):.3f} s "
+        f"(min {min(wall_times):.3f} s, max {max(wall_times):.3f} s) over {args.runs} runs"
+    )
+
+
+if __name__ == "__main__":
+    main()
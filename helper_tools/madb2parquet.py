@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Minoru Kobayashi <unknownbit@gmail.com> (@unkn0wnbit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import sys
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    print("pyarrow is required. Please install it with \"pip3 install pyarrow\".")
+    sys.exit(1)
+
+# Tables are sorted by these columns, so that the min/max statistics of each row group are narrow
+# and ma2tl skips most row groups of a time window or an exact match.
+SORT_COLUMNS = {
+    'UnifiedLogs': 'TimeUtc',
+    'Combined_Paths': 'Path',
+    'Combined_Inodes': 'CNID',
+}
+
+# Columns that ma2tl compares with a text time window. They are always stored as text, even if all values are
+# numbers, because the time window cannot be compared with a number column in Parquet.
+TIME_COLUMNS = ('TimeUtc', 'kMDItemDownloadedDate', 'TimeStamp', 'Date', 'LastUsed')
+
+# Tables and columns created by helper_tools/ndjson2madb.py for SQLite only
+SKIP_TABLES = ('UnifiedLogsStats', 'UnifiedLogsPartitions', 'UnifiedLogsTemplates', 'UnifiedLogsIngest', 'UnifiedLogsData')
+SKIP_COLUMNS = ('RowHash', 'TemplateID', 'TimeUtcUs', 'RowSeq')
+
+
+def get_tables(conn: sqlite3.Connection) -> list[str]:
+    tables = [row[0] for row in conn.execute('SELECT name FROM sqlite_master WHERE type IN ("table", "view") AND name NOT LIKE "sqlite_%";')]
+    # UnifiedLogs.db created by ndjson2madb.py may have lookup tables and partitions behind a VIEW named UnifiedLogs.
+    if 'UnifiedLogs' in tables:
+        return ['UnifiedLogs']
+    return [table for table in tables if table not in SKIP_TABLES]
+
+
+def get_column_types(conn: sqlite3.Connection, table: str) -> list[tuple[str, pa.DataType]]:
+    # SQLite does not enforce the declared types. The Parquet type is chosen from the types actually stored.
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}");') if row[1] not in SKIP_COLUMNS]
+    if not columns:
+        return []
+
+    sql_types = ', '.join(f'group_concat(DISTINCT typeof("{column}"))' for column in columns)
+    stored_types = conn.execute(f'SELECT {sql_types} FROM "{table}";').fetchone()
+
+    column_types = []
+    for column, types in zip(columns, stored_types):
+        types = set((types or '').split(',')) - {'null', ''}
+        if column in TIME_COLUMNS:
+            column_types.append((column, pa.string()))
+        elif types == {'integer'}:
+            column_types.append((column, pa.int64()))
+        elif types and types <= {'integer', 'real'}:
+            column_types.append((column, pa.float64()))
+        elif types == {'blob'}:
+            column_types.append((column, pa.binary()))
+        else:
+            column_types.append((column, pa.string()))
+    return column_types
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='backslashreplace')
+    return str(value)
+
+
+def convert_table(conn: sqlite3.Connection, table: str, output_path: str, row_group_rows: int) -> int:
+    column_types = get_column_types(conn, table)
+    if not column_types:
+        return 0
+
+    schema = pa.schema(column_types)
+    text_columns = [index for index, (_, data_type) in enumerate(column_types) if data_type == pa.string()]
+    sql = 'SELECT ' + ', '.join(f'"{column}"' for column, _ in column_types) + f' FROM "{table}"'
+    if table in SORT_COLUMNS and SORT_COLUMNS[table] in dict(column_types):
+        sql += f' ORDER BY "{SORT_COLUMNS[table]}"'
+
+    rows_count = 0
+    cursor = conn.execute(sql + ';')
+    with pq.ParquetWriter(output_path, schema, compression='zstd') as writer:
+        while rows := cursor.fetchmany(row_group_rows):
+            columns = list(zip(*rows))
+            for index in text_columns:
+                columns[index] = [to_text(value) for value in columns[index]]
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=data_type) for column, (_, data_type) in zip(columns, column_types)], schema=schema),
+                               row_group_size=row_group_rows)
+            rows_count += len(rows)
+    return rows_count
+
+
+def parse_arguments() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Convert mac_apt DBs (mac_apt.db, UnifiedLogs.db and APFS_Volumes_<UUID>.db) to Parquet folders that ma2tl can read.\n",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        nargs="+",
+        required=True,
+        help="Paths to mac_apt DBs",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        default=None,
+        help="Path to an output folder. <DB name>.parquet folders are created in it (Default: the folder of each DB)",
+    )
+    parser.add_argument(
+        "--row_group_rows",
+        action="store",
+        type=int,
+        default=100000,
+        help="Number of rows in one row group (Default: 100000)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    for db_path in args.input:
+        if not os.path.isfile(db_path):
+            print(f"{db_path} does not exist.")
+            sys.exit(1)
+
+        output_dir = args.output or os.path.dirname(os.path.abspath(db_path))
+        parquet_path = os.path.join(output_dir, os.path.splitext(os.path.basename(db_path))[0] + '.parquet')
+        if os.path.exists(parquet_path):
+            print(f"{parquet_path} is already exist.")
+            sys.exit(1)
+        os.makedirs(parquet_path)
+
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        for table in get_tables(conn):
+            rows_count = convert_table(conn, table, os.path.join(parquet_path, f"{table}.parquet"), args.row_group_rows)
+            print(f"{table}: {rows_count} rows")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
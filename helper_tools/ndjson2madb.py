@@ -18,29 +18,247 @@
 from __future__ import annotations
 
 import argparse
+import ast
+import collections
+import datetime
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import lzma
 import os
+import queue
+import re
 import sqlite3
 import sys
-from typing import NoReturn
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Callable, Iterator, NoReturn
 
-import ndjson
+try:
+    import orjson
 
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Columns, parsing and filtering of log entries are shared with ma2tl (-u), so that both accept the same rows.
+PLUGINS_PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PLUGINS_PARENT_DIR not in sys.path:
+    sys.path.append(PLUGINS_PARENT_DIR)
+from plugins.helpers import unifiedlogs_stream  # noqa: E402
+
+# Same columns in the format of UnifiedLogsDbWriter.column_list
+UNIFIEDLOGS_COLUMNS: list[dict] = [
+    {column_name: column_type} for column_name, column_type in unifiedlogs_stream.UNIFIEDLOGS_COLUMNS
+]
+
+
+def compute_row_hash(time_utc: str, thread: int, process_id: int, message: str) -> int:
+    # Stable across runs and exports, so that the same log entry from overlapping exports has the same hash.
+    key = f"{time_utc}\x00{thread}\x00{process_id}\x00{message}".encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big", signed=True)
+
+
+class IngestCheckpoint:
+    # Number of lines and bytes read from each input. It is written in the same transaction as the rows,
+    # so that an interrupted conversion can be resumed from the last commit with --resume.
+    table_name = "UnifiedLogsIngest"
 
-class UnifiedLogsDbWriter:
     def __init__(self) -> None:
+        self.progress: dict[str, list] = dict()  # input name: [lines, bytes, done]
+        self.updated_sources: set[str] = set()
+
+    def load(self, conn: sqlite3.Connection) -> bool:
+        if not conn.execute(
+            'SELECT name FROM sqlite_master WHERE type="table" AND name=?', (self.table_name,)
+        ).fetchone():
+            return False
+        for name, lines, bytes_read, done in conn.execute(
+            f'SELECT "Source", "Lines", "Bytes", "Done" FROM "{self.table_name}"'
+        ):
+            self.progress[name] = [lines, bytes_read, done]
+        return True
+
+    def get(self, source_name: str) -> list:
+        return self.progress.get(source_name, [0, 0, 0])
+
+    def start(self, source_name: str) -> None:
+        self.progress[source_name] = [0, 0, 0]
+        self.updated_sources.add(source_name)
+
+    def advance(self, source_name: str, lines: int, bytes_read: int) -> None:
+        progress = self.progress.setdefault(source_name, [0, 0, 0])
+        progress[0] += lines
+        progress[1] += bytes_read
+        self.updated_sources.add(source_name)
+
+    def finish(self, source_name: str) -> None:
+        self.progress.setdefault(source_name, [0, 0, 0])[2] = 1
+        self.updated_sources.add(source_name)
+
+    def write(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{self.table_name}" '
+            + '("Source" TEXT PRIMARY KEY, "Lines" INTEGER, "Bytes" INTEGER, "Done" INTEGER)'
+        )
+        conn.executemany(
+            f'INSERT OR REPLACE INTO "{self.table_name}" VALUES (?, ?, ?, ?)',
+            [(source_name, *self.progress[source_name]) for source_name in self.updated_sources],
+        )
+        self.updated_sources.clear()
+
+
+class TemplateMiner:
+    # Drain-style online clustering of messages into templates. A message is split on whitespace and compared
+    # with the templates that have the same number of tokens and the same first token. It joins the most similar
+    # one if enough constant tokens agree, and the tokens that differ become wildcards. Otherwise, it starts a new
+    # template. Template IDs never change, and a template only becomes more general, so every message stays
+    # matched by the final template of its ID. Messages that cannot be restored from their tokens (e.g. multi-line
+    # or with repeated spaces) are not mined and get TemplateID 0.
+    wildcard = "<*>"
+    digit_regex = re.compile(r"\d")
+
+    def __init__(self, similarity_threshold: float = 0.5, max_tokens: int = 64) -> None:
+        self.similarity_threshold = similarity_threshold
+        self.max_tokens = max_tokens
+        self.groups: dict[tuple, list[int]] = dict()
+        self.templates: list[list[str]] = [list()]  # index is TemplateID
+        self.template_rows: list[int] = [0]
+
+    def add_message(self, message: str) -> int:
+        tokens = message.split()
+        if not tokens or len(tokens) > self.max_tokens or " ".join(tokens) != message:
+            self.template_rows[0] += 1
+            return 0
+
+        # Tokens with digits are variables in most log messages.
+        tokens = [self.wildcard if self.digit_regex.search(token) else token for token in tokens]
+        template_ids = self.groups.setdefault((len(tokens), tokens[0]), list())
+        best_template_id = 0
+        best_similarity = -1.0
+        for template_id in template_ids:
+            template = self.templates[template_id]
+            same_tokens = sum(1 for template_token, token in zip(template, tokens) if template_token == token)
+            similarity = same_tokens / len(tokens)
+            if similarity > best_similarity:
+                best_template_id = template_id
+                best_similarity = similarity
+
+        if best_template_id and best_similarity >= self.similarity_threshold:
+            template = self.templates[best_template_id]
+            for index, token in enumerate(tokens):
+                if template[index] != token:
+                    template[index] = self.wildcard
+        else:
+            best_template_id = len(self.templates)
+            self.templates.append(tokens)
+            self.template_rows.append(0)
+            template_ids.append(best_template_id)
+
+        self.template_rows[best_template_id] += 1
+        return best_template_id
+
+    def write_templates(self, conn: sqlite3.Connection, templates_table_name: str = "UnifiedLogsTemplates") -> bool | NoReturn:
+        try:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{templates_table_name}" '
+                + '("TemplateID" INTEGER PRIMARY KEY, "Template" TEXT, "Tokens" INTEGER, "Rows" INTEGER)'
+            )
+            conn.executemany(
+                f'INSERT INTO "{templates_table_name}" VALUES (?, ?, ?, ?)',
+                (
+                    (template_id, " ".join(template), len(template), self.template_rows[template_id])
+                    for template_id, template in enumerate(self.templates)
+                ),
+            )
+            conn.commit()
+            return True
+
+        except sqlite3.Error as ex:
+            print(f"Error writing the templates table: {templates_table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+
+class UnifiedLogsDbWriter:
+    def __init__(
+        self,
+        commit_rows: int = 500000,
+        compact: bool = False,
+        cluster_by_time: bool = False,
+        template_miner: TemplateMiner | None = None,
+    ) -> None:
         self.db_path: str = ""
         self.conn: sqlite3.Connection = None
         self.cursor: sqlite3.Cursor = None
         self.table_name: str = ""
+        self.data_table_name: str = ""
         self.column_list: list[dict] = None
         self.sql_executemany: str = ""
+        self.commit_rows = commit_rows
+        self.uncommitted_rows = 0
+        # Compact layout: low-cardinality columns are stored as integer keys into lookup tables,
+        # and a VIEW with the original table name resolves them for ma2tl.
+        self.compact = compact
+        self.dictionary_columns: tuple = (
+            "ProcessName",
+            "SenderName",
+            "Subsystem",
+            "Category",
+            "SenderUUID",
+            "ProcessImageUUID",
+            "SenderImagePath",
+            "ProcessImagePath",
+        )
+        self.dictionaries: dict[int, dict[str, int]] = dict()
+        self.stats_columns: tuple = ("ProcessName", "SenderName", "Subsystem", "Category")
+        # Time-clustered layout: rows are loaded into a staging table first, then copied in time order
+        # into a WITHOUT ROWID table keyed by (TimeUtcUs, RowSeq). TimeUtcUs is microseconds since the Unix epoch.
+        self.cluster_by_time = cluster_by_time
+        self.staging_table_name: str = ""
+        self.time_utc_index: int = 0
+        # Mined templates: TemplateID column refers to the templates table written by TemplateMiner.
+        self.template_miner = template_miner
+        self.message_index: int = 0
+        # Appending to an existing table: rows get a RowHash column and the ones already stored are skipped.
+        self.existing_table = False
+        self.deduplicate = False
+        self.row_hash_indexes: list[int] = list()
+        self.append_table_name: str = ""
+        self.duplicate_rows = 0
+        self.checkpoint: IngestCheckpoint | None = None
+        # Indexes for the WHERE clauses of ma2tl plugins. They are created after loading all rows.
+        self.index_columns_list: list[tuple] = [
+            ("TimeUtc",),
+            ("ProcessName", "TimeUtc"),
+            ("SenderName", "TimeUtc"),
+            ("Category", "TimeUtc"),
+        ]
+        if self.template_miner:
+            self.index_columns_list.append(("TemplateID", "TimeUtc"))
 
-    def open_db(self, db_path: str) -> bool | NoReturn:
+    def open_db(self, db_path: str, existing: bool = False, deduplicate: bool = False) -> bool | NoReturn:
         self.db_path = db_path
+        self.existing_table = existing
+        self.deduplicate = deduplicate
         try:
-            if self.db_path and not os.path.exists(self.db_path):
+            if existing:
                 self.conn = sqlite3.connect(self.db_path)
                 self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=OFF")
+                return True
+            elif self.db_path and not os.path.exists(self.db_path):
+                self.conn = sqlite3.connect(self.db_path)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                # Durability is not needed while loading. A broken DB is simply converted again.
+                self.conn.execute("PRAGMA synchronous=OFF")
                 return True
             else:
                 print(f"Specified SQLite file has been existed: {self.db_path}")
@@ -53,56 +271,59 @@ class UnifiedLogsDbWriter:
 
     def close_db(self) -> NoReturn:
         if self.conn:
+            self.commit()
+            self.conn.execute("PRAGMA synchronous=FULL")
             self.conn.close()
             self.conn = None
 
-    def _build_create_table_query(self) -> str:
-        sql = 'CREATE TABLE "' + self.table_name + '" ('
+    def _build_create_table_query(self, table_name: str = "", clustered: bool = False, temporary: bool = False) -> str:
+        sql = "CREATE TEMP TABLE " if temporary else "CREATE TABLE "
+        sql += '"' + (table_name or self.data_table_name) + '" ('
         # for column_name in self.column_list:
         #     sql += f'"{column_name}" TEXT,'
         for column_pair in self.column_list:
             for column_name, column_type in column_pair.items():
+                if self.compact and column_name in self.dictionary_columns:
+                    column_type = "INTEGER"
                 sql += f'"{column_name}" {column_type},'
 
+        if clustered:
+            sql += '"RowSeq" INTEGER, PRIMARY KEY ("TimeUtcUs", "RowSeq"),'
+
         sql = sql[:-1]  # remove the last comma
         sql += ")"
+        if clustered:
+            sql += " WITHOUT ROWID"
         return sql
 
     def create_table(self, table_name="UnifiedLogs", column_list: list[dict] = list()) -> bool | NoReturn:
+        if self.existing_table:
+            return self._open_existing_table(table_name)
+
         try:
             self.table_name = table_name
             self.column_list = column_list
             if not self.column_list:
-                self.column_list = [
-                    {"File": "TEXT"},
-                    {"DecompFilePos": "INTEGER"},
-                    {"ContinuousTime": "TEXT"},
-                    {"TimeUtc": "TEXT"},
-                    {"Thread": "INTEGER"},
-                    {"Type": "TEXT"},
-                    {"ActivityID": "INTEGER"},
-                    {"ParentActivityID": "INTEGER"},
-                    {"ProcessID": "INTEGER"},
-                    {"EffectiveUID": "INTEGER"},
-                    {"TTL": "INTEGER"},
-                    {"ProcessName": "TEXT"},
-                    {"SenderName": "TEXT"},
-                    {"Subsystem": "TEXT"},
-                    {"Category": "TEXT"},
-                    {"SignpostName": "TEXT"},
-                    {"SignpostInfo": "TEXT"},
-                    {"ImageOffset": "INTEGER"},
-                    {"SenderUUID": "TEXT"},
-                    {"ProcessImageUUID": "TEXT"},
-                    {"SenderImagePath": "TEXT"},
-                    {"ProcessImagePath": "TEXT"},
-                    {"Message": "TEXT"},
-                ]
+                self.column_list = UNIFIEDLOGS_COLUMNS
+            self.data_table_name = self.table_name + "Data" if self.compact else self.table_name
+            insert_table_name = self.data_table_name
             self.cursor = self.conn.cursor()
-            self.cursor.execute(self._build_create_table_query())
+            if self.template_miner:
+                self.message_index = [list(column_pair.keys())[0] for column_pair in self.column_list].index("Message")
+                self.column_list = self.column_list + [{"TemplateID": "INTEGER"}]
+            if self.cluster_by_time:
+                self.time_utc_index = [list(column_pair.keys())[0] for column_pair in self.column_list].index("TimeUtc")
+                self.column_list = self.column_list + [{"TimeUtcUs": "INTEGER"}]
+                self.staging_table_name = self.data_table_name + "_Staging"
+                insert_table_name = self.staging_table_name
+                self.cursor.execute(self._build_create_table_query(self.staging_table_name))
+            else:
+                self.cursor.execute(self._build_create_table_query())
+            if self.compact:
+                self._create_dictionary_tables()
             self.conn.commit()
             self.sql_executemany = (
-                'INSERT INTO "' + self.table_name + '" VALUES (?' + ",?" * (len(self.column_list) - 1) + ")"
+                'INSERT INTO "' + insert_table_name + '" VALUES (?' + ",?" * (len(self.column_list) - 1) + ")"
             )
             return True
 
@@ -111,18 +332,343 @@ class UnifiedLogsDbWriter:
             print(f"Error details: {str(ex)}")
             raise ex
 
+    def _open_existing_table(self, table_name: str) -> bool | NoReturn:
+        # Only the default layout can be extended. When deduplicating, rows are inserted through a TEMP table
+        # and the ones whose RowHash is already in the table are skipped.
+        try:
+            self.table_name = table_name
+            self.data_table_name = table_name
+            self.cursor = self.conn.cursor()
+            table_type = self.cursor.execute(
+                "SELECT type FROM sqlite_master WHERE name=?", (self.table_name,)
+            ).fetchone()
+            column_names = [row[1] for row in self.cursor.execute(f'PRAGMA table_info("{self.table_name}")')]
+            default_column_names = [list(column_pair.keys())[0] for column_pair in UNIFIEDLOGS_COLUMNS]
+            if (
+                not table_type
+                or table_type[0] != "table"
+                or column_names[: len(default_column_names)] != default_column_names
+                or column_names[len(default_column_names) :] not in ([], ["RowHash"])
+            ):
+                print(f"{self.db_path} does not have a {self.table_name} table with the default layout.")
+                return False
+
+            self.column_list = list(UNIFIEDLOGS_COLUMNS)
+            # The statistics of the existing rows are outdated. They are created again after loading.
+            self.cursor.execute('DROP TABLE IF EXISTS "UnifiedLogsStats"')
+            if not self.deduplicate and "RowHash" not in column_names:
+                self.conn.commit()
+                self.sql_executemany = (
+                    f'INSERT INTO "{self.table_name}" VALUES (?' + ",?" * (len(self.column_list) - 1) + ")"
+                )
+                return True
+
+            if "RowHash" not in column_names:
+                print("Computing RowHash of the existing rows...", file=sys.stderr)
+                self.conn.create_function("row_hash", 4, compute_row_hash, deterministic=True)
+                self.cursor.execute(f'ALTER TABLE "{self.table_name}" ADD COLUMN "RowHash" INTEGER')
+                self.cursor.execute(
+                    f'UPDATE "{self.table_name}" SET "RowHash" = row_hash("TimeUtc", "Thread", "ProcessID", "Message")'
+                )
+            self.column_list = self.column_list + [{"RowHash": "INTEGER"}]
+            self.cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_{self.table_name}_RowHash" ON "{self.table_name}" ("RowHash")'
+            )
+            self.row_hash_indexes = [
+                default_column_names.index(column_name) for column_name in ("TimeUtc", "Thread", "ProcessID", "Message")
+            ]
+            self.append_table_name = self.table_name + "_Append"
+            self.cursor.execute(self._build_create_table_query(self.append_table_name, temporary=True))
+            self.cursor.execute(
+                f'CREATE INDEX temp."idx_{self.append_table_name}_RowHash" ON "{self.append_table_name}" ("RowHash")'
+            )
+            self.conn.commit()
+            self.sql_executemany = (
+                f'INSERT INTO temp."{self.append_table_name}" VALUES (?' + ",?" * (len(self.column_list) - 1) + ")"
+            )
+            return True
+
+        except sqlite3.Error as ex:
+            print(f"Error opening SQLite table: {self.table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+    def _get_lookup_table_name(self, column_name: str) -> str:
+        return f"{self.table_name}_{column_name}"
+
+    def _create_dictionary_tables(self) -> NoReturn:
+        select_columns = list()
+        joins = list()
+        for index, column_pair in enumerate(self.column_list):
+            column_name = list(column_pair.keys())[0]
+            if column_name in self.dictionary_columns:
+                lookup_table_name = self._get_lookup_table_name(column_name)
+                self.cursor.execute(
+                    f'CREATE TABLE "{lookup_table_name}" ("ID" INTEGER PRIMARY KEY, "Value" TEXT UNIQUE)'
+                )
+                self.dictionaries[index] = dict()
+                alias = f"t{index}"
+                select_columns.append(f'{alias}."Value" AS "{column_name}"')
+                joins.append(f'LEFT JOIN "{lookup_table_name}" AS {alias} ON {alias}."ID" = d."{column_name}"')
+            else:
+                select_columns.append(f'd."{column_name}" AS "{column_name}"')
+
+        self.cursor.execute(
+            f'CREATE VIEW "{self.table_name}" AS SELECT '
+            + ", ".join(select_columns)
+            + f' FROM "{self.data_table_name}" AS d '
+            + " ".join(joins)
+        )
+
+    def _encode_rows(self, rows: list[list | tuple]) -> list[list]:
+        encoded_rows = list()
+        for row in rows:
+            row = list(row)
+            for index, dictionary in self.dictionaries.items():
+                value = row[index]
+                key = dictionary.get(value)
+                if key is None:
+                    key = len(dictionary) + 1
+                    dictionary[value] = key
+                    self.cursor.execute(
+                        f'INSERT INTO "{self._get_lookup_table_name(list(self.column_list[index].keys())[0])}" VALUES (?, ?)',
+                        (key, value),
+                    )
+                row[index] = key
+            encoded_rows.append(row)
+
+        return encoded_rows
+
     def write_rows(self, rows: list[list | tuple]) -> bool | NoReturn:
         try:
+            if self.template_miner:
+                rows = [list(row) + [self.template_miner.add_message(row[self.message_index])] for row in rows]
+            if self.compact:
+                rows = self._encode_rows(rows)
+            if self.cluster_by_time:
+                rows = [list(row) + [convert_time_utc_to_us(row[self.time_utc_index])] for row in rows]
+            if self.append_table_name:
+                rows = [list(row) + [compute_row_hash(*(row[index] for index in self.row_hash_indexes))] for row in rows]
             self.cursor.executemany(self.sql_executemany, rows)
+            if self.append_table_name:
+                # A row is skipped if it is already stored or repeated earlier in the batch.
+                self.cursor.execute(
+                    f'INSERT INTO main."{self.table_name}" SELECT * FROM temp."{self.append_table_name}" AS a '
+                    + f'WHERE NOT EXISTS (SELECT 1 FROM main."{self.table_name}" AS u WHERE u."RowHash" = a."RowHash") '
+                    + f'AND a.rowid = (SELECT MIN(b.rowid) FROM temp."{self.append_table_name}" AS b WHERE b."RowHash" = a."RowHash")'
+                )
+                self.duplicate_rows += len(rows) - self.cursor.rowcount
+                self.cursor.execute(f'DELETE FROM temp."{self.append_table_name}"')
+            self.uncommitted_rows += len(rows)
+            if self.uncommitted_rows >= self.commit_rows:
+                self.commit()
+            return True
+
+        except sqlite3.Error as ex:
+            print(f"Error writing to SQLite table: {self.table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+    def cluster_rows_by_time(self, vacuum: bool = True) -> bool | NoReturn:
+        # The ORDER BY is done by SQLite's external merge sorter, so the rows do not need to fit in memory.
+        # Inserting them in key order fills the pages of the WITHOUT ROWID table sequentially.
+        try:
+            self.commit()
+            self.cursor.execute(self._build_create_table_query(clustered=True))
+            self.cursor.execute(
+                f'INSERT INTO "{self.data_table_name}" SELECT *, rowid FROM "{self.staging_table_name}" '
+                + 'ORDER BY "TimeUtcUs", rowid'
+            )
+            self.cursor.execute(f'DROP TABLE "{self.staging_table_name}"')
+            self.conn.commit()
+            if vacuum:
+                self.conn.execute("VACUUM")
+            return True
+
+        except sqlite3.Error as ex:
+            print(f"Error clustering SQLite table by time: {self.data_table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+    def create_indexes(self, analyze: bool = True) -> bool | NoReturn:
+        try:
+            self.commit()
+            for index_columns in self.index_columns_list:
+                index_name = f"idx_{self.data_table_name}_" + "_".join(index_columns)
+                columns = ", ".join(f'"{column_name}"' for column_name in index_columns)
+                self.cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{self.data_table_name}" ({columns})')
+                self.conn.commit()
+            if analyze:
+                self.conn.execute("ANALYZE")
+            return True
+
+        except sqlite3.Error as ex:
+            print(f"Error creating indexes on SQLite table: {self.table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+    def create_stats(self, stats_table_name: str = "UnifiedLogsStats") -> bool | NoReturn:
+        # Row counts and time ranges per value of the columns that plugins filter on.
+        # ma2tl reads them to skip extractors that cannot match any row in its time window.
+        try:
+            self.commit()
+            self.cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS "{stats_table_name}" '
+                + '("ColumnName" TEXT, "Value" TEXT, "Rows" INTEGER, "MinTimeUtc" TEXT, "MaxTimeUtc" TEXT)'
+            )
+            for column_name in self.stats_columns:
+                self.cursor.execute(
+                    f'INSERT INTO "{stats_table_name}" SELECT ?, "{column_name}", COUNT(*), MIN("TimeUtc"), MAX("TimeUtc") '
+                    + f'FROM "{self.table_name}" GROUP BY "{column_name}"',
+                    (column_name,),
+                )
+            self.cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_{stats_table_name}" ON "{stats_table_name}" ("ColumnName", "Value")'
+            )
             self.conn.commit()
             return True
 
+        except sqlite3.Error as ex:
+            print(f"Error creating statistics table: {stats_table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+    def commit(self) -> bool | NoReturn:
+        try:
+            if self.checkpoint:
+                self.checkpoint.write(self.conn)
+            self.conn.commit()
+            self.uncommitted_rows = 0
+            return True
+
         except sqlite3.Error as ex:
             print(f"Error writing to SQLite table: {self.table_name}")
             print(f"Error details: {str(ex)}")
             raise ex
 
 
+class PartitionedUnifiedLogsDbWriter:
+    # Writes one table per UTC day (e.g. UnifiedLogs_20230830) into a single database, and a manifest table
+    # (UnifiedLogsPartitions) with the time range of each partition. ma2tl reads the manifest and queries only
+    # the partitions that overlap its time window. A VIEW with the original table name covers all partitions.
+    manifest_table_name = "UnifiedLogsPartitions"
+    max_view_partitions = 500  # SQLITE_MAX_COMPOUND_SELECT
+
+    def __init__(
+        self,
+        commit_rows: int = 500000,
+        compact: bool = False,
+        cluster_by_time: bool = False,
+        template_miner: TemplateMiner | None = None,
+    ) -> None:
+        self.db_writer = UnifiedLogsDbWriter(commit_rows)
+        self.conn: sqlite3.Connection = None
+        self.table_name: str = ""
+        self.commit_rows = commit_rows
+        self.compact = compact
+        self.cluster_by_time = cluster_by_time
+        # One miner is shared by all partitions, so a TemplateID means the same template in every partition.
+        self.template_miner = template_miner
+        self.partition_writers: dict[str, UnifiedLogsDbWriter] = dict()
+        self.partition_stats: dict[str, list] = dict()  # day: [min TimeUtc, max TimeUtc, rows]
+        self.time_utc_index = [list(column_pair.keys())[0] for column_pair in UNIFIEDLOGS_COLUMNS].index("TimeUtc")
+
+    def open_db(self, db_path: str, existing: bool = False, deduplicate: bool = False) -> bool | NoReturn:
+        # Same signature as UnifiedLogsDbWriter.open_db(). Resuming and appending support only the default layout.
+        if existing or deduplicate:
+            print("--resume and --append support only the default layout.")
+            return False
+        if self.db_writer.open_db(db_path):
+            self.conn = self.db_writer.conn
+            return True
+        return False
+
+    def close_db(self) -> NoReturn:
+        if self.conn:
+            self._write_manifest()
+            self.db_writer.close_db()
+            self.conn = None
+
+    def create_table(self, table_name="UnifiedLogs") -> bool:
+        # Partition tables are created when the first row of each day arrives.
+        self.table_name = table_name
+        return True
+
+    def _get_partition_writer(self, day: str) -> UnifiedLogsDbWriter:
+        partition_writer = self.partition_writers.get(day)
+        if partition_writer is None:
+            partition_writer = UnifiedLogsDbWriter(
+                self.commit_rows, self.compact, self.cluster_by_time, self.template_miner
+            )
+            partition_writer.conn = self.conn
+            partition_writer.create_table(f"{self.table_name}_{day.replace('-', '')}")
+            self.partition_writers[day] = partition_writer
+            self.partition_stats[day] = [None, None, 0]
+        return partition_writer
+
+    def write_rows(self, rows: list[list | tuple]) -> bool | NoReturn:
+        rows_by_day: dict[str, list] = dict()
+        for row in rows:
+            rows_by_day.setdefault(row[self.time_utc_index][:10], list()).append(row)
+
+        for day, day_rows in rows_by_day.items():
+            self._get_partition_writer(day).write_rows(day_rows)
+            time_utcs = [row[self.time_utc_index] for row in day_rows]
+            stats = self.partition_stats[day]
+            stats[0] = min(time_utcs) if stats[0] is None else min(stats[0], min(time_utcs))
+            stats[1] = max(time_utcs) if stats[1] is None else max(stats[1], max(time_utcs))
+            stats[2] += len(day_rows)
+        return True
+
+    def cluster_rows_by_time(self) -> bool | NoReturn:
+        for partition_writer in self.partition_writers.values():
+            partition_writer.cluster_rows_by_time(vacuum=False)
+        self.conn.execute("VACUUM")
+        return True
+
+    def create_indexes(self) -> bool | NoReturn:
+        for partition_writer in self.partition_writers.values():
+            partition_writer.create_indexes(analyze=False)
+        self.conn.execute("ANALYZE")
+        return True
+
+    def create_stats(self) -> bool | NoReturn:
+        # Statistics are recorded per partition, so their time ranges are narrower.
+        for partition_writer in self.partition_writers.values():
+            partition_writer.create_stats()
+        return True
+
+    def _write_manifest(self) -> NoReturn:
+        try:
+            self.conn.execute(
+                f'CREATE TABLE "{self.manifest_table_name}" '
+                + '("TableName" TEXT, "Day" TEXT, "MinTimeUtc" TEXT, "MaxTimeUtc" TEXT, "Rows" INTEGER)'
+            )
+            self.conn.executemany(
+                f'INSERT INTO "{self.manifest_table_name}" VALUES (?, ?, ?, ?, ?)',
+                [
+                    (self.partition_writers[day].table_name, day, *self.partition_stats[day])
+                    for day in sorted(self.partition_writers.keys())
+                ],
+            )
+            if 0 < len(self.partition_writers) <= self.max_view_partitions:
+                self.conn.execute(
+                    f'CREATE VIEW "{self.table_name}" AS '
+                    + " UNION ALL ".join(
+                        f'SELECT * FROM "{self.partition_writers[day].table_name}"'
+                        for day in sorted(self.partition_writers.keys())
+                    )
+                )
+            else:
+                print(f"{self.table_name} VIEW is not created because there are {len(self.partition_writers)} partitions.")
+            self.conn.commit()
+
+        except sqlite3.Error as ex:
+            print(f"Error writing the partition manifest: {self.manifest_table_name}")
+            print(f"Error details: {str(ex)}")
+            raise ex
+
+
 def parse_arguments() -> argparse.ArgumentParser:
     epilog = (
         "[Exporting Unified Logs Tips]\n"
@@ -142,7 +688,12 @@ def parse_arguments() -> argparse.ArgumentParser:
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument(
-        "-i", "--input", action="store", default="-", help="Path to an exported Unified Logs file (Default: - (STDIN))"
+        "-i",
+        "--input",
+        action="store",
+        nargs="+",
+        default=["-"],
+        help="Paths to exported Unified Logs files (.zip, .gz, .zst and .xz are decompressed on the fly) (Default: - (STDIN))",
     )
     parser.add_argument(
         "-o",
@@ -152,100 +703,374 @@ def parse_arguments() -> argparse.ArgumentParser:
         required=True,
         help="Path to an output database file (Default: UnifiedLogs.db)",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes to parse log entries (Default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-r",
+        "--readers",
+        action="store",
+        type=int,
+        default=4,
+        help="Number of input files or archive members read concurrently (Default: 4)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        action="store",
+        type=int,
+        default=20000,
+        help="Number of lines passed to a worker process at once (Default: 20000)",
+    )
+    parser.add_argument(
+        "--commit_rows",
+        action="store",
+        type=int,
+        default=500000,
+        help="Number of rows written in one transaction (Default: 500000)",
+    )
+    parser.add_argument(
+        "--ma2tl-only",
+        action="store_true",
+        default=False,
+        help="Store only the log entries that installed ma2tl plugins can match",
+    )
+    parser.add_argument(
+        "--plugins_dir",
+        action="store",
+        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugins"),
+        help="Path to the ma2tl plugins folder used by --ma2tl-only (Default: ../plugins)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        default=False,
+        help="Store low-cardinality columns as integer keys into lookup tables (UnifiedLogs becomes a VIEW)",
+    )
+    parser.add_argument(
+        "--cluster_by_time",
+        action="store_true",
+        default=False,
+        help="Store rows physically ordered by time in a WITHOUT ROWID table with an integer TimeUtcUs key",
+    )
+    parser.add_argument(
+        "--partition_by_day",
+        action="store_true",
+        default=False,
+        help="Store rows in one table per UTC day with a manifest, so that ma2tl can skip days outside its time window",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Continue an interrupted conversion into the existing output from its last commit",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        default=False,
+        help="Add the input to the existing output, skipping log entries that are already stored",
+    )
+    parser.add_argument(
+        "--mine_templates",
+        action="store_true",
+        default=False,
+        help="Cluster messages into templates and store their IDs in a TemplateID column with a templates table",
+    )
+    parser.add_argument(
+        "--no_stats",
+        action="store_true",
+        default=False,
+        help="Do not create the statistics table that ma2tl uses to skip extractors",
+    )
+    parser.add_argument(
+        "--no_index",
+        action="store_true",
+        default=False,
+        help="Do not create indexes for ma2tl queries after loading",
+    )
     return parser.parse_args()
 
 
-def parse_log_entry(log_entry: dict) -> list:
-    file = ""
-    decomp_file_pos = 0
-    continuous_time = "0"
-    # time_utc: str = log_entry.get('machTimestamp', '0000-00-00 00:00:00.000000+0000')
-    time_utc: str = log_entry.get("timestamp", "0000-00-00 00:00:00.000000+0000")
-    thread = log_entry.get("threadID", 0)
-    type = log_entry.get("messageType", "")
-    activity_id = log_entry.get("activityIdentifier", 0)
-    parent_activity_id = log_entry.get("parentActivityIdentifier", 0)
-    process_id = log_entry.get("processID", 0)
-    effective_uid = 0
-    ttl = 0
-    process_name: str = log_entry.get("processImagePath", "")
-    sender_name: str = log_entry.get("senderImagePath", "")
-    subsystem = log_entry.get("subsystem", "")
-    category = log_entry.get("category", "")
-    signpost_name = ""
-    signpost_info = ""
-    image_offset = 0
-    sender_uuid = log_entry.get("senderImageUUID", "")
-    process_image_uuid = log_entry.get("processImageUUID", "")
-    sender_image_path = log_entry.get("senderImagePath", "")
-    process_image_path = log_entry.get("processImagePath", "")
-    message = log_entry.get("eventMessage", "")
-
-    time_utc = time_utc.split("+")[0]
-    process_name = process_name.split("/")[-1]
-    sender_name = sender_name.split("/")[-1]
-
-    unifiedlogs_db_entry = [
-        file,
-        decomp_file_pos,
-        continuous_time,
-        time_utc,
-        thread,
-        type,
-        activity_id,
-        parent_activity_id,
-        process_id,
-        effective_uid,
-        ttl,
-        process_name,
-        sender_name,
-        subsystem,
-        category,
-        signpost_name,
-        signpost_info,
-        image_offset,
-        sender_uuid,
-        process_image_uuid,
-        sender_image_path,
-        process_image_path,
-        message,
-    ]
-
-    return unifiedlogs_db_entry
+def load_plugin_filters(plugins_dir: str) -> tuple[dict, list[tuple]] | NoReturn:
+    # PLUGIN_UNIFIEDLOGS_FILTERS is read from the plugin sources without importing them,
+    # so that this script does not depend on the packages required by ma2tl.
+    filters = list()
+    for filename in sorted(os.listdir(plugins_dir)):
+        if not filename.endswith(".py") or filename.startswith("_"):
+            continue
+
+        with open(os.path.join(plugins_dir, filename), "rt", encoding="utf-8") as f:
+            tree = ast.parse(f.read(), filename)
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == "PLUGIN_UNIFIEDLOGS_FILTERS" for target in node.targets
+            ):
+                for extractor_filters in ast.literal_eval(node.value).values():
+                    filters.extend(extractor_filters)
+
+    if not filters:
+        print(f"No PLUGIN_UNIFIEDLOGS_FILTERS found in {plugins_dir}")
+        sys.exit(1)
+
+    return unifiedlogs_stream.compile_filters(filters)
+
+
+def convert_time_utc_to_us(time_utc: str) -> int:
+    try:
+        dt = datetime.datetime.fromisoformat(time_utc).replace(tzinfo=datetime.timezone.utc)
+        return (dt - UNIX_EPOCH) // datetime.timedelta(microseconds=1)
+    except ValueError:
+        return 0
+
+
+def parse_lines(lines: list[bytes], filters: tuple[dict, list[tuple]] | None = None) -> list[list]:
+    entries = [unifiedlogs_stream.parse_ndjson_entry(json_loads(line)) for line in lines if line.strip()]
+    if filters:
+        entries = [entry for entry in entries if unifiedlogs_stream.match_filters(entry, filters)]
+    return entries
+
+
+class InputSource:
+    def __init__(self, name: str, opener: Callable[[], BinaryIO], seekable: bool = False) -> None:
+        self.name = name
+        self.opener = opener
+        self.seekable = seekable
+        # Position to resume from, taken from IngestCheckpoint
+        self.skip_lines = 0
+        self.skip_bytes = 0
+
+    def open(self) -> BinaryIO:
+        f = self.opener()
+        if self.seekable and self.skip_bytes:
+            f.seek(self.skip_bytes)
+        elif self.skip_lines:
+            # Compressed inputs cannot seek, so the lines already ingested are read and dropped.
+            for _ in itertools.islice(f, self.skip_lines):
+                pass
+        return f
+
+
+def _open_zstd(path: str) -> BinaryIO:
+    import zstandard  # optional dependency, only needed for .zst input
+
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+
+
+def open_input_sources(paths: list[str]) -> tuple[list[InputSource], list[zipfile.ZipFile]]:
+    sources: list[InputSource] = list()
+    zip_files: list[zipfile.ZipFile] = list()
+    for path in paths:
+        if path == "-":
+            sources.append(InputSource("STDIN", lambda: sys.stdin.buffer))
+        elif path.lower().endswith(".zip"):
+            # Every member of a zip file is ingested as a separate input.
+            zip_file = zipfile.ZipFile(path)
+            zip_files.append(zip_file)
+            for member in zip_file.infolist():
+                if not member.is_dir():
+                    sources.append(InputSource(f"{path}:{member.filename}", functools.partial(zip_file.open, member)))
+        elif path.lower().endswith(".gz"):
+            sources.append(InputSource(path, functools.partial(gzip.open, path, "rb")))
+        elif path.lower().endswith(".xz"):
+            sources.append(InputSource(path, functools.partial(lzma.open, path, "rb")))
+        elif path.lower().endswith(".zst"):
+            sources.append(InputSource(path, functools.partial(_open_zstd, path)))
+        else:
+            sources.append(InputSource(path, functools.partial(open, path, "rb"), seekable=True))
+
+    return sources, zip_files
+
+
+def read_line_batches(f: BinaryIO, batch_size: int) -> Iterator[list[bytes]]:
+    batch = list()
+    for line in f:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+
+    if len(batch) > 0:
+        yield batch
+
+
+def _read_source(source: InputSource, batch_size: int, batch_queue: queue.Queue) -> None:
+    try:
+        f = source.open()
+        try:
+            for lines in read_line_batches(f, batch_size):
+                batch_queue.put((source, lines))
+            batch_queue.put((source, list()))  # end of the input
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+    except Exception as ex:
+        batch_queue.put(ex)
+    finally:
+        batch_queue.put(None)
+
+
+def read_sources_line_batches(
+    sources: list[InputSource], batch_size: int, readers: int
+) -> Iterator[tuple[InputSource, list[bytes]]]:
+    # Batches are tagged with their input. An empty batch marks the end of an input.
+    if len(sources) == 1:
+        f = sources[0].open()
+        try:
+            for lines in read_line_batches(f, batch_size):
+                yield sources[0], lines
+            yield sources[0], list()
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        return
+
+    # Several inputs are read and decompressed concurrently by reader threads.
+    # Decompressors release the GIL, so this overlaps with parsing and writing.
+    batch_queue: queue.Queue = queue.Queue(maxsize=readers * 2)
+    pending_sources = collections.deque(sources)
+    running_readers = 0
+    while pending_sources or running_readers:
+        while pending_sources and running_readers < readers:
+            source = pending_sources.popleft()
+            threading.Thread(target=_read_source, args=(source, batch_size, batch_queue), daemon=True).start()
+            running_readers += 1
+
+        item = batch_queue.get()
+        if item is None:
+            running_readers -= 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
+
+
+def parse_batches(
+    line_batches: Iterator[tuple[InputSource, list[bytes]]],
+    workers: int,
+    filters: tuple[dict, list[tuple]] | None = None,
+) -> Iterator[tuple[InputSource, list[bytes], list[list]]]:
+    parse = functools.partial(parse_lines, filters=filters)
+    if workers <= 1:
+        for source, lines in line_batches:
+            yield source, lines, parse(lines)
+        return
+
+    # Keep a bounded number of batches in flight so that reading never runs far ahead of parsing.
+    # Batches are yielded in input order.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for source, lines in line_batches:
+            pending.append((source, lines, executor.submit(parse, lines)))
+            if len(pending) >= workers * 2:
+                source, lines, future = pending.popleft()
+                yield source, lines, future.result()
+
+        while pending:
+            source, lines, future = pending.popleft()
+            yield source, lines, future.result()
+
+
+def print_progress(rows: int, started_time: float, done: bool = False) -> None:
+    elapsed = time.time() - started_time
+    rate = rows / elapsed if elapsed > 0 else 0
+    print(f"\rWrote {rows:,} rows ({rate:,.0f} rows/s)", end="\n" if done else "", file=sys.stderr, flush=True)
 
 
 def main():
     args = parse_arguments()
 
-    if os.path.exists(args.output):
+    existing = (args.resume or args.append) and os.path.exists(args.output)
+    if os.path.exists(args.output) and not existing:
         print("{} is already exist.".format(args.output))
         sys.exit(1)
-
-    db_writer = UnifiedLogsDbWriter()
-    if not db_writer.open_db(args.output):
+    if existing and (args.compact or args.cluster_by_time or args.partition_by_day or args.mine_templates):
+        print("--resume and --append support only the default layout.")
         sys.exit(1)
-    db_writer.create_table()
 
-    if args.input == "-":
-        f = sys.stdin
+    filters = None
+    if args.ma2tl_only:
+        filters = load_plugin_filters(args.plugins_dir)
+
+    template_miner = TemplateMiner() if args.mine_templates else None
+    if args.partition_by_day:
+        db_writer = PartitionedUnifiedLogsDbWriter(args.commit_rows, args.compact, args.cluster_by_time, template_miner)
     else:
-        f = open(args.input, "rt")
+        db_writer = UnifiedLogsDbWriter(args.commit_rows, args.compact, args.cluster_by_time, template_miner)
+    if not db_writer.open_db(args.output, existing, args.append):
+        sys.exit(1)
+    if not db_writer.create_table():
+        sys.exit(1)
 
-    log_reader = ndjson.reader(f)
-    unifiedlogs_db_entries = list()
+    checkpoint = None
+    if not args.partition_by_day:
+        checkpoint = IngestCheckpoint()
+        if existing and not checkpoint.load(db_writer.conn) and not args.append:
+            print(f"{args.output} has no ingest checkpoint to resume from.")
+            sys.exit(1)
+        db_writer.checkpoint = checkpoint
 
-    for log_entry in log_reader:
-        parsed_entry = parse_log_entry(log_entry)
-        unifiedlogs_db_entries.append(parsed_entry)
-        if len(unifiedlogs_db_entries) == 1000:
-            db_writer.write_rows(unifiedlogs_db_entries)
-            unifiedlogs_db_entries = list()
+    try:
+        sources, zip_files = open_input_sources(args.input)
+    except (OSError, zipfile.BadZipFile) as ex:
+        print(f"Failed to open the input: {str(ex)}")
+        sys.exit(1)
+    for source in list(sources):
+        if checkpoint and args.resume:
+            source.skip_lines, source.skip_bytes, done = checkpoint.get(source.name)
+            if done:
+                print(f"Input: {source.name} (already ingested)", file=sys.stderr)
+                sources.remove(source)
+                continue
+            if source.skip_lines:
+                print(f"Input: {source.name} (resuming after line {source.skip_lines:,})", file=sys.stderr)
+                continue
+        elif checkpoint:
+            checkpoint.start(source.name)
+        print(f"Input: {source.name}", file=sys.stderr)
+    line_batches = read_sources_line_batches(sources, args.batch_size, args.readers)
+
+    started_time = time.time()
+    last_progress_time = started_time
+    total_rows = 0
+    try:
+        for source, lines, rows in parse_batches(line_batches, args.workers, filters):
+            # The checkpoint is advanced first, so that it is committed together with the rows.
+            if checkpoint and lines:
+                checkpoint.advance(source.name, len(lines), sum(map(len, lines)))
+            elif checkpoint:
+                checkpoint.finish(source.name)
+            db_writer.write_rows(rows)
+            total_rows += len(rows)
+            if time.time() - last_progress_time >= 1:
+                print_progress(total_rows, started_time)
+                last_progress_time = time.time()
+    except KeyboardInterrupt:
+        print("\nInterrupted. Run again with --resume to continue from the last commit.", file=sys.stderr)
+        sys.exit(1)
 
-    if args.input != "-":
-        f.close()
+    for zip_file in zip_files:
+        zip_file.close()
 
-    if len(unifiedlogs_db_entries) > 0:
-        db_writer.write_rows(unifiedlogs_db_entries)
+    print_progress(total_rows, started_time, done=True)
+    if args.append and not args.partition_by_day:
+        print(f"Skipped {db_writer.duplicate_rows:,} rows already in the database or repeated in the input", file=sys.stderr)
+    if args.cluster_by_time:
+        print("Sorting rows by time...", file=sys.stderr)
+        db_writer.cluster_rows_by_time()
+    if not args.no_index:
+        print("Creating indexes...", file=sys.stderr)
+        db_writer.create_indexes()
+    if not args.no_stats:
+        print("Creating statistics...", file=sys.stderr)
+        db_writer.create_stats()
+    if template_miner:
+        print(f"Writing {len(template_miner.templates) - 1:,} templates...", file=sys.stderr)
+        template_miner.write_templates(db_writer.conn)
     db_writer.close_db()
 
 
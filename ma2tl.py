@@ -38,14 +38,18 @@ import sys
 import textwrap
 import time
 
-import tzlocal
-
 import plugins.helpers.basic_info as basicinfo
 from plugins.helpers.plugin import (check_user_specified_plugin_name,
-                                    import_plugins, setup_logger)
+                                    import_plugins, run_plugins, setup_logger)
 
 log = None
 MA2TL_VERSION = '20230830'
+# Plugins and logger of the library API (timeline())
+library_plugins = []
+LIBRARY_LOGGER_ROOT = 'MA2TL'
+# Thread pool shared by streams of astream() that are not given an executor
+astream_executor = None
+ASTREAM_MAX_WORKERS = 4
 
 
 def parse_arguments(plugins: list) -> argparse.ArgumentParser:
@@ -64,13 +68,24 @@ def parse_arguments(plugins: list) -> argparse.ArgumentParser:
                                     epilog=plugins_info, formatter_class=argparse.RawTextHelpFormatter
                                     )
     parser.add_argument('-i', '--input', action='store', default=None, help='Path to a folder that contains mac_apt DBs')
+    parser.add_argument('-u', '--unifiedlogs', action='store', default=None, help='Path to Unified Logs exported by "log show --style ndjson" or aul2madb TSV (.gz is also supported). It is read directly instead of UnifiedLogs.db')
+    parser.add_argument('--working_set', action='store_true', default=False, help='Copy the UnifiedLogs entries in the time window that plugins can match to an indexed temporary DB before running plugins')
+    parser.add_argument('--working_set_budget', action='store', type=int, default=512, help='RAM budget of the temporary DB for --working_set and -u in MiB. The rest is spilled to a temporary file (Default: 512)')
     parser.add_argument('-o', '--output', action='store', default=None, help='Path to a folder to save ma2tl result')
-    parser.add_argument('-ot', '--output_type', action='store', default='SQLITE', help='Specify the output file type: SQLITE, XLSX, TSV (Default: SQLITE)')
+    parser.add_argument('-ot', '--output_type', action='store', default='SQLITE', help='Specify the output file types (comma separated): SQLITE, XLSX, TSV, NDJSON (Default: SQLITE)')
+    parser.add_argument('--sqlite_page_size', action='store', type=int, default=0, help='Page size of the output SQLite DB in bytes: 512 - 65536, a power of two (Default: SQLite default)')
+    parser.add_argument('--tsv_compression', action='store', default='NONE', help='Compress TSV output on the fly: NONE, GZIP, ZSTD (Default: NONE)')
+    parser.add_argument('--tsv_buffer_size', action='store', type=int, default=16, help='Write buffer size of TSV output in MiB (Default: 16)')
+    parser.add_argument('--ndjson_path', action='store', default=None, help='Path to write NDJSON output to: "-" (STDOUT) or a FIFO (Default: ma2tl.ndjson in the output folder)')
     # parser.add_argument('-f', '--force', action='store_true', default=False, help='Overwrite an output file.')
     # parser.add_argument('-u', '--unifiedlogs_only', action='store_true', default=False, help='Analyze UnifiedLogs.db only (Default: False)')
     parser.add_argument('-s', '--start', action='store', default=None, help='Specify start timestamp (ex. 2021-11-05 08:30:00)')
     parser.add_argument('-e', '--end', action='store', default=None, help='Specify end timestamp')
     parser.add_argument('-t', '--timezone', action='store', default=None, help='Specify Timezone: "UTC", "Asia/Tokyo", "US/Eastern", etc (Default: System Local Timezone)')
+    parser.add_argument('--serve', action='store', default=None, help='Run as a service that keeps the DBs open and answers timeline queries with NDJSON on [HOST:]PORT (HOST defaults to 127.0.0.1) or a Unix socket path. -s and -e are given with each query')
+    parser.add_argument('--serve_cache_size', action='store', type=int, default=256, help='Size of the result cache of --serve in MiB (Default: 256)')
+    parser.add_argument('--memory_report', action='store_true', default=False, help='Record the peak memory of each plugin and extractor to memory_report.tsv in the output folder')
+    parser.add_argument('--memory_budget', action='store', type=int, default=0, help='Memory budget in MiB. Memory-heavy structures of extractors are moved to temporary DBs before it is reached (Default: 0, no budget)')
     parser.add_argument('-l', '--log_level', action='store', default='INFO', help='Specify log level: INFO, DEBUG, WARNING, ERROR, CRITICAL (Default: INFO)')
     parser.add_argument('plugin', nargs="+", help="Plugins to run (space separated).")
     return parser.parse_args()
@@ -82,30 +97,36 @@ def expand_to_abspath(path):
     return os.path.abspath(path)
 
 
+def find_dbs(input_path: str, macapt_dbs: basicinfo.MacAptDbs) -> bool:
+    # SQLite DBs (*.db files) are preferred to Parquet folders (*.parquet) converted by helper_tools/madb2parquet.py.
+    db_list = glob.glob(os.path.join(input_path, '*.parquet')) + glob.glob(os.path.join(input_path, '*.db'))
+    for db_path in db_list:
+        if os.path.isfile(db_path) or (os.path.isdir(db_path) and db_path.endswith('.parquet')):
+            db_name = os.path.splitext(os.path.basename(db_path))[0]
+            if db_name == 'mac_apt':
+                macapt_dbs.mac_apt_db_path = db_path
+            elif db_name == 'UnifiedLogs':
+                macapt_dbs.unifiedlogs_db_path = db_path
+            elif re.match(r'APFS_Volumes_\w{8}-\w{4}-\w{4}-\w{4}-\w{12}$', db_name):
+                macapt_dbs.apfs_volumes_db_path = db_path
+    # return macapt_dbs.mac_apt_db_path and macapt_dbs.unifiedlogs_db_path and macapt_dbs.apfs_volumes_db_path
+    return bool(macapt_dbs.mac_apt_db_path or macapt_dbs.unifiedlogs_db_path or macapt_dbs.apfs_volumes_db_path)
+
+
 def check_input_path(input_path: str, macapt_dbs: basicinfo.MacAptDbs) -> bool:
     try:
         if os.path.isdir(input_path):
-            db_list = glob.glob(os.path.join(input_path, '*.db'))
-            for db_path in db_list:
-                if os.path.isfile(db_path):
-                    if os.path.basename(db_path) == 'mac_apt.db':
-                        macapt_dbs.mac_apt_db_path = db_path
-                    elif os.path.basename(db_path) == 'UnifiedLogs.db':
-                        macapt_dbs.unifiedlogs_db_path = db_path
-                    elif re.match(r'APFS_Volumes_\w{8}-\w{4}-\w{4}-\w{4}-\w{12}\.db', os.path.basename(db_path)):
-                        macapt_dbs.apfs_volumes_db_path = db_path
-                # if macapt_dbs.mac_apt_db_path and macapt_dbs.unifiedlogs_db_path and macapt_dbs.apfs_volumes_db_path:
-                if macapt_dbs.mac_apt_db_path or macapt_dbs.unifiedlogs_db_path or macapt_dbs.apfs_volumes_db_path:
-                    return True
+            if find_dbs(input_path, macapt_dbs):
+                return True
             # else:
-            print("Error: mac_apt analysis result DBs are insufficient.")
+            print("Error: mac_apt analysis result DBs are insufficient.", file=sys.stderr)
             return False
         else:
-            print("Error: the input path is not a directory.")
+            print("Error: the input path is not a directory.", file=sys.stderr)
             return False
 
     except Exception as ex:
-        print(f"Error: Unknown exception, error details are: {str(ex)}")
+        print(f"Error: Unknown exception, error details are: {str(ex)}", file=sys.stderr)
         return False
 
 
@@ -114,13 +135,13 @@ def check_output_path(output_path, force_flag=False):
         if os.path.isdir(output_path):
             for filename in os.listdir(output_path):
                 if filename.startswith('ma2tl.'):
-                    print(f"Error: There is already a file that starts with \"ma2tl.\" : {filename}")
+                    print(f"Error: There is already a file that starts with \"ma2tl.\" : {filename}", file=sys.stderr)
                     return False
             return True
 
         else:
             if os.path.isfile(output_path):
-                print(f"Error: The file already exists : {output_path}")
+                print(f"Error: The file already exists : {output_path}", file=sys.stderr)
                 return False
 
             else:
@@ -128,11 +149,11 @@ def check_output_path(output_path, force_flag=False):
                     os.makedirs(output_path)
                     return True
                 except Exception as ex:
-                    print(f"Error: Cannot create an output folder : {output_path}\nError Details: {str(ex)}")
+                    print(f"Error: Cannot create an output folder : {output_path}\nError Details: {str(ex)}", file=sys.stderr)
                     return False
 
     except Exception as ex:
-        print(f"Exception occurred: {str(ex)}")
+        print(f"Exception occurred: {str(ex)}", file=sys.stderr)
         return False
 
 
@@ -145,6 +166,203 @@ def exit_(message=''):
         sys.exit(message)
 
 
+#
+# Library API
+#
+class TimelineEvent:
+    # An event of the timeline. Timestamps are the same strings as in the output files.
+    def __init__(self, ts_utc, ts_local, activity_type, message, plugin_name):
+        self.ts_utc = ts_utc
+        self.ts_local = ts_local
+        self.activity_type = activity_type
+        self.message = message
+        self.plugin_name = plugin_name
+
+    def __repr__(self):
+        return f"TimelineEvent({self.ts_utc!r}, {self.ts_local!r}, {self.activity_type!r}, {self.message!r}, {self.plugin_name!r})"
+
+
+def open_case(input_path: str) -> basicinfo.MacAptDbs:
+    # Each DB in the folder is connected when a plugin reads it, and stays open for the following queries
+    # until close_dbs() is called.
+    input_path = expand_to_abspath(input_path)
+    macapt_dbs = basicinfo.MacAptDbs()
+    if not os.path.isdir(input_path) or not find_dbs(input_path, macapt_dbs):
+        raise FileNotFoundError(f"mac_apt analysis result DBs are not found : {input_path}")
+    macapt_dbs.open_dbs()
+    return macapt_dbs
+
+
+def timeline(case, start: str, end: str, tz: str | None = None, plugins=None):
+    # Returns an iterator of TimelineEvent. case is a folder of mac_apt DBs, or MacAptDbs returned by open_case()
+    # to share the open DBs between queries. plugins is a list of plugin names (Default: all plugins), and
+    # tz defaults to the local timezone. Plugins run one by one while the iterator is consumed. No files are
+    # created and logs are only passed to the "MA2TL" logger. Invalid arguments raise ValueError.
+    if not (re.fullmatch(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', start) and re.fullmatch(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', end)):
+        raise ValueError('Start timestamp or end timestamp cannot be recognized.')
+
+    if tz is None:
+        import tzlocal
+        tz = str(tzlocal.get_localzone())
+    import pytz
+    try:
+        pytz.timezone(tz)
+    except pytz.exceptions.UnknownTimeZoneError:
+        raise ValueError(f"Unknown TimeZone: {tz}")
+
+    if not library_plugins:
+        import_plugins(library_plugins)
+    plugins_to_run = [x.upper() for x in (plugins or ['ALL'])]
+    for plugin_name in plugins_to_run:
+        if plugin_name != 'ALL' and plugin_name not in (plugin.PLUGIN_NAME for plugin in library_plugins):
+            raise ValueError(f"Plugin name not found : {plugin_name}")
+    selected_plugins = [plugin for plugin in library_plugins if 'ALL' in plugins_to_run or plugin.PLUGIN_NAME in plugins_to_run]
+
+    if isinstance(case, basicinfo.MacAptDbs):
+        return _iter_timeline(case, start, end, tz, selected_plugins, False)
+    return _iter_timeline(open_case(case), start, end, tz, selected_plugins, True)
+
+
+def _iter_timeline(macapt_dbs, start, end, tz, plugins, close_dbs):
+    events = []
+    output_params = basicinfo.OutputParams()
+    output_params.logger_root = LIBRARY_LOGGER_ROOT
+    output_params.event_callback = lambda rows: events.extend(TimelineEvent(*row) for row in rows)
+    basic_info = basicinfo.BasicInfo(macapt_dbs, output_params, start, end, tz)
+    try:
+        macapt_dbs.select_unifiedlogs_partitions(*basic_info.get_between_dates_utc())
+        for plugin in plugins:
+            run_plugins(basic_info, [plugin], logging.getLogger(LIBRARY_LOGGER_ROOT))
+            basic_info.data_writer.flush()
+            plugin_events = events[:]
+            events.clear()
+            yield from plugin_events
+    finally:
+        basic_info.data_writer.close_writer()
+        basic_info.memory_monitor.close()
+        if close_dbs:
+            macapt_dbs.close_dbs()
+
+
+class _StreamWorker:
+    # Runs plugins of astream() in an executor thread, and passes events to the event loop in batches.
+    def __init__(self, events, macapt_dbs, close_dbs, loop, batches, batch_size, max_batches):
+        import threading
+
+        self.events = events
+        self.macapt_dbs = macapt_dbs
+        self.close_dbs = close_dbs
+        self.loop = loop
+        self.batches = batches
+        self.batch_size = batch_size
+        # Batches passed to the event loop and not taken by the consumer yet are limited to max_batches.
+        self.free_slots = threading.Semaphore(max_batches)
+        self.stopped = threading.Event()
+        self.state_lock = threading.Lock()
+        self.running = False
+
+    def run(self):
+        try:
+            # Streams on the same MacAptDbs run one at a time, because they share the connections and the
+            # partition view of UnifiedLogs.db.
+            while not self.macapt_dbs.query_lock.acquire(timeout=0.1):
+                if self.stopped.is_set():
+                    return
+            try:
+                with self.state_lock:
+                    if self.stopped.is_set():
+                        return
+                    self.running = True
+                batch = []
+                for event in self.events:
+                    batch.append(event)
+                    if len(batch) >= self.batch_size:
+                        if not self._send(batch):
+                            return
+                        batch = []
+                if batch:
+                    self._send(batch)
+            finally:
+                self.events.close()
+                with self.state_lock:
+                    self.running = False
+                    self.macapt_dbs.interrupted = False
+                self.macapt_dbs.query_lock.release()
+        finally:
+            if self.close_dbs:
+                self.macapt_dbs.close_dbs()
+            self._put(None)
+
+    def stop(self):
+        # Called from the event loop. SQLite queries of the running plugin are interrupted.
+        self.stopped.set()
+        with self.state_lock:
+            if self.running:
+                self.macapt_dbs.interrupt()
+
+    def _send(self, batch) -> bool:
+        # Waits for a free slot, so that plugins do not run ahead of a slow consumer.
+        while not self.free_slots.acquire(timeout=0.1):
+            if self.stopped.is_set():
+                return False
+        return not self.stopped.is_set() and self._put(batch)
+
+    def _put(self, item) -> bool:
+        try:
+            self.loop.call_soon_threadsafe(self.batches.put_nowait, item)
+            return True
+        except RuntimeError:
+            # The event loop has been closed.
+            return False
+
+
+async def astream(case, start: str, end: str, tz: str | None = None, plugins=None, batch_size=1000, max_batches=4, executor=None):
+    # Async iterator of TimelineEvent for asyncio applications. Arguments are the same as timeline(). Plugins run
+    # in a thread of executor (Default: a thread pool of ASTREAM_MAX_WORKERS shared by streams), which passes events
+    # to the event loop in batches of batch_size. Plugins wait while max_batches batches are not consumed. When the
+    # iteration is cancelled or closed, the running SQLite queries are interrupted and the plugins stop.
+    import asyncio
+
+    if batch_size < 1 or max_batches < 1:
+        raise ValueError('batch_size and max_batches must be 1 or more.')
+
+    macapt_dbs = case if isinstance(case, basicinfo.MacAptDbs) else open_case(case)
+    try:
+        events = timeline(macapt_dbs, start, end, tz, plugins)
+    except ValueError:
+        if macapt_dbs is not case:
+            macapt_dbs.close_dbs()
+        raise
+
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue()
+    worker = _StreamWorker(events, macapt_dbs, macapt_dbs is not case, loop, batches, batch_size, max_batches)
+    future = loop.run_in_executor(executor or _get_astream_executor(), worker.run)
+    try:
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            worker.free_slots.release()
+            for event in batch:
+                yield event
+        # Raises an exception that occurred in the worker.
+        await future
+    finally:
+        if not future.done():
+            worker.stop()
+            # Waits until the worker releases the DBs.
+            await asyncio.gather(future, return_exceptions=True)
+
+
+def _get_astream_executor():
+    global astream_executor
+    if astream_executor is None:
+        import concurrent.futures
+        astream_executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASTREAM_MAX_WORKERS, thread_name_prefix='ma2tl')
+    return astream_executor
+
+
 def main():
     global log
     plugins = []
@@ -158,7 +376,8 @@ def main():
 
     if args.output:
         args.output = expand_to_abspath(args.output)
-        print(f"Output path: {args.output}")
+        # Keep STDOUT clean when it carries the NDJSON event stream.
+        print(f"Output path: {args.output}", file=sys.stderr if args.ndjson_path == '-' else sys.stdout)
         if not check_output_path(args.output):
             exit_()
     else:
@@ -203,26 +422,89 @@ def main():
     output_params.logger_root = logger_root
     output_params.output_path = args.output
     if args.output_type:
-        args.output_type = args.output_type.upper()
-        if args.output_type not in ('SQLITE', 'XLSX', 'TSV'):
-            exit_(f"Error: Unsupported output type: {args.output_type}")
+        output_types = [x.strip().upper() for x in args.output_type.split(',') if x.strip()]
+        for output_type in output_types:
+            if output_type not in ('SQLITE', 'XLSX', 'TSV', 'NDJSON'):
+                exit_(f"Error: Unsupported output type: {output_type}")
 
-        if args.output_type == 'SQLITE':
+        if 'SQLITE' in output_types:
             output_params.use_sqlite = True
-        elif args.output_type == 'XLSX':
+            if args.sqlite_page_size:
+                if not (512 <= args.sqlite_page_size <= 65536 and (args.sqlite_page_size & (args.sqlite_page_size - 1)) == 0):
+                    exit_(f"Error: Invalid SQLite page size: {args.sqlite_page_size}")
+                output_params.sqlite_page_size = args.sqlite_page_size
+        if 'XLSX' in output_types:
             output_params.use_xlsx = True
-        elif args.output_type == 'TSV':
+        if 'TSV' in output_types:
             output_params.use_tsv = True
+            args.tsv_compression = args.tsv_compression.upper()
+            if args.tsv_compression not in ('NONE', 'GZIP', 'ZSTD'):
+                exit_(f"Error: Unsupported TSV compression: {args.tsv_compression}")
+            if args.tsv_buffer_size <= 0:
+                exit_(f"Error: Invalid TSV buffer size: {args.tsv_buffer_size}")
+            output_params.tsv_compression = '' if args.tsv_compression == 'NONE' else args.tsv_compression.lower()
+            output_params.tsv_buffer_size = args.tsv_buffer_size * 1024 * 1024
+        if 'NDJSON' in output_types:
+            output_params.use_ndjson = True
+            if args.ndjson_path:
+                output_params.ndjson_path = args.ndjson_path if args.ndjson_path == '-' else expand_to_abspath(args.ndjson_path)
+    if args.ndjson_path and not output_params.use_ndjson:
+        exit_('Error: --ndjson_path requires NDJSON in --output_type.')
+
+    if args.memory_budget < 0:
+        exit_(f"Error: Invalid memory budget: {args.memory_budget}")
+    output_params.memory_report = args.memory_report
+    output_params.memory_budget = args.memory_budget
 
     macapt_dbs = basicinfo.MacAptDbs()
+    macapt_dbs.working_set_budget = args.working_set_budget
     if args.input:
         args.input = expand_to_abspath(args.input)
         log.info(f"Input path : {args.input}")
         if not check_input_path(args.input, macapt_dbs):
             exit_()
-    else:
+    elif not args.unifiedlogs:
         exit_('Error: Specify mac_apt result DBs folder.')
 
+    if args.unifiedlogs:
+        args.unifiedlogs = expand_to_abspath(args.unifiedlogs)
+        if not os.path.isfile(args.unifiedlogs):
+            exit_(f"Error: Unified Logs file is not found : {args.unifiedlogs}")
+        log.info(f"Unified Logs path : {args.unifiedlogs}")
+        macapt_dbs.unifiedlogs_stream_path = args.unifiedlogs
+
+    if args.timezone:
+        tz = args.timezone
+    else:
+        import tzlocal
+        tz = str(tzlocal.get_localzone())
+
+    #
+    # Serve queries with the DBs kept open
+    #
+    if args.serve:
+        if args.unifiedlogs or args.working_set:
+            exit_('Error: --serve cannot be used with -u or --working_set.')
+        if args.memory_report:
+            exit_('Error: --serve cannot be used with --memory_report.')
+        from plugins.helpers.server import TimelineService, serve
+
+        # Events are only streamed to clients. The log file is still written to the output folder.
+        service_output_params = basicinfo.OutputParams()
+        service_output_params.logger_root = logger_root
+        service_output_params.output_path = args.output
+        service_output_params.memory_budget = args.memory_budget
+        macapt_dbs.open_dbs()
+        service = TimelineService(macapt_dbs, [plugin for plugin in plugins if process_all or (plugin.PLUGIN_NAME in plugins_to_run)],
+                                  service_output_params, tz, args.serve_cache_size)
+        try:
+            serve(args.serve, service)
+        except OSError as ex:
+            exit_(f"Error: Cannot serve on {args.serve} : {str(ex)}")
+        macapt_dbs.close_dbs()
+        log.info("Finished.")
+        return
+
     if args.start and args.end:
         regex_ts = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
         if not (re.match(regex_ts, args.start) and re.match(regex_ts, args.end)):
@@ -233,12 +515,23 @@ def main():
     #
     # Prepare BasicInfo object
     #
-    if args.timezone:
-        tz = args.timezone
-    else:
-        tz = str(tzlocal.get_localzone())
-    basic_info = basicinfo.BasicInfo(macapt_dbs, output_params, args.start, args.end, tz)
+    try:
+        basic_info = basicinfo.BasicInfo(macapt_dbs, output_params, args.start, args.end, tz)
+    except ValueError as ex:
+        exit_(f"Error: {str(ex)}")
     basic_info.mac_apt_dbs.open_dbs()
+    basic_info.mac_apt_dbs.select_unifiedlogs_partitions(*basic_info.get_between_dates_utc())
+    if args.unifiedlogs or args.working_set:
+        unifiedlogs_filters = [
+            column_filter
+            for plugin in plugins if process_all or (plugin.PLUGIN_NAME in plugins_to_run)
+            for extractor_filters in getattr(plugin, 'PLUGIN_UNIFIEDLOGS_FILTERS', {}).values()
+            for column_filter in extractor_filters
+        ]
+        if args.unifiedlogs:
+            basic_info.mac_apt_dbs.load_unifiedlogs_stream(*basic_info.get_between_dates_utc(), unifiedlogs_filters)
+        else:
+            basic_info.mac_apt_dbs.load_unifiedlogs_working_set(*basic_info.get_between_dates_utc(), unifiedlogs_filters)
 
     #
     # Write data header
@@ -249,14 +542,10 @@ def main():
     #
     # Run plugins!!
     #
-    for plugin in plugins:
-        if process_all or (plugin.PLUGIN_NAME in plugins_to_run):
-            log.info("-"*50)
-            log.info(f"Running plugin - {plugin.PLUGIN_NAME}")
-            try:
-                plugin.run(basic_info)
-            except Exception:
-                log.exception(f"An exception occurred while running plugin - {plugin.PLUGIN_NAME}")
+    run_plugins(basic_info, [plugin for plugin in plugins if process_all or (plugin.PLUGIN_NAME in plugins_to_run)], log)
+    if args.memory_report:
+        basic_info.memory_monitor.write_report(os.path.join(output_params.output_path, 'memory_report.tsv'))
+    basic_info.memory_monitor.close()
 
     #
     # Close mac_apt DBs
@@ -10,7 +10,7 @@ from __future__ import annotations
 import logging
 import os
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 from plugins.helpers.common import get_timedelta
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
@@ -19,6 +19,7 @@ PLUGIN_ACTIVITY_TYPE = "File Download"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('MACAPT_DB',)
 
 log = None
 
@@ -36,25 +37,22 @@ def extract_spotlight_dataview_file_download(basic_info: BasicInfo, filedownload
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.MACAPT_DB):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
-    sql = 'SELECT * FROM "{}" WHERE kMDItemDownloadedDate BETWEEN "{}" AND "{}" \
-            ORDER BY kMDItemDownloadedDate;'
-    sql_tableinfo = 'PRAGMA table_info("{}");'
     tables = {
         'SpotlightDataView-1-store': False,
         'SpotlightDataView-1-.store-DIFF': False
     }
 
     for table in tables.keys():
-        for column in run_query(MacAptDBType.MACAPT_DB, sql_tableinfo.format(table)).fetchall():
-            if column[1] == 'kMDItemDownloadedDate':
-                tables[table] = True
-                break
+        if 'kMDItemDownloadedDate' in basic_info.mac_apt_dbs.get_columns(MacAptDBType.MACAPT_DB, table):
+            tables[table] = True
 
     start_ts, end_ts = basic_info.get_between_dates_utc()
     for table, has_downloaddeddate in tables.items():
         if has_downloaddeddate:
-            for row in run_query(MacAptDBType.MACAPT_DB, sql.format(table, start_ts, end_ts)):
+            query = TableQuery(table, columns=('kMDItemDownloadedDate', 'kMDItemWhereFroms', 'FullPath'),
+                               time_column='kMDItemDownloadedDate', start_ts=start_ts, end_ts=end_ts,
+                               order_by='kMDItemDownloadedDate')
+            for row in basic_info.mac_apt_dbs.select(MacAptDBType.MACAPT_DB, query):
                 skip_flag = False
                 ts = row['kMDItemDownloadedDate']
                 data_url = row['kMDItemWhereFroms']  # If this column have multiple URLs, it should be split with comma(,). First one is DataUrl, second one is OriginUrl.
@@ -82,20 +80,29 @@ def extract_safari_quarantine_file_download(basic_info: BasicInfo, filedownload_
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.MACAPT_DB):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
+    select = basic_info.mac_apt_dbs.select
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT Quarantine.TimeStamp, Quarantine.AgentName, Quarantine.DataUrl, Quarantine.OriginUrl, Safari.Other_Info FROM Quarantine \
-            INNER JOIN Safari ON Safari.Type = "DOWNLOAD" AND Quarantine.DataUrl = Safari.URL \
-            WHERE Quarantine.TimeStamp BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            Quarantine.AgentName = "Safari" \
-            ORDER BY TimeStamp;'
+    query_quarantine = TableQuery('Quarantine', columns=('TimeStamp', 'AgentName', 'DataUrl', 'OriginUrl'),
+                                  time_column='TimeStamp', start_ts=start_ts, end_ts=end_ts,
+                                  equals={'AgentName': 'Safari'}, order_by='TimeStamp')
+    query_safari = TableQuery('Safari', columns=('URL', 'Other_Info'), equals={'Type': 'DOWNLOAD'})
+    if not basic_info.mac_apt_dbs.can_match(MacAptDBType.MACAPT_DB, query_quarantine):
+        log.info("Skipped extract_safari_quarantine_file_download: no Quarantine entries in the time window.")
+        return False
+
+    # Join Quarantine and Safari downloads on the URL. Backends other than SQLite cannot join tables.
+    safari_downloads = dict()
+    for row in select(MacAptDBType.MACAPT_DB, query_safari):
+        safari_downloads.setdefault(row['URL'], []).append(row['Other_Info'])
 
-    for row in run_query(MacAptDBType.MACAPT_DB, sql):
+    rows = ((row, other_info) for row in select(MacAptDBType.MACAPT_DB, query_quarantine)
+            for other_info in safari_downloads.get(row['DataUrl'], ()))
+    for row, other_info in rows:
         skip_flag = False
         ts = row['TimeStamp']
         data_url = row['DataUrl']
         origin_url = row['OriginUrl']
-        local_path = row['Other_Info']
+        local_path = other_info
         agent = row['AgentName']
 
         for event in filedownload_events:
@@ -122,11 +129,11 @@ def extract_chrome_file_download(basic_info: BasicInfo, filedownload_events: lis
         log.info(f"{table_name} table does not exist.")
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM Chrome WHERE Type = "DOWNLOAD" AND Date BETWEEN "{start_ts}" AND "{end_ts}" ORDER BY Date;'
+    query = TableQuery('Chrome', columns=('Date', 'URL', 'Referrer or Previous Page', 'Local Path'), time_column='Date', start_ts=start_ts, end_ts=end_ts,
+                       equals={'Type': 'DOWNLOAD'}, order_by='Date')
 
-    for row in run_query(MacAptDBType.MACAPT_DB, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.MACAPT_DB, query):
         ts = row['Date']
         data_url = row['URL']
         origin_url = row['Referrer or Previous Page']
@@ -141,13 +148,11 @@ def extract_quarantine_file_download(basic_info: BasicInfo, filedownload_events:
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.MACAPT_DB):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT TimeStamp, AgentName, DataUrl, OriginUrl FROM Quarantine \
-            WHERE TimeStamp BETWEEN "{start_ts}" AND "{end_ts}" \
-            ORDER BY TimeStamp;'
+    query = TableQuery('Quarantine', columns=('TimeStamp', 'AgentName', 'DataUrl', 'OriginUrl'),
+                       time_column='TimeStamp', start_ts=start_ts, end_ts=end_ts, order_by='TimeStamp')
 
-    for row in run_query(MacAptDBType.MACAPT_DB, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.MACAPT_DB, query):
         skip_flag = False
         ts = row['TimeStamp']
         data_url = row['DataUrl']
@@ -170,29 +175,44 @@ def extract_quarantine_file_download(basic_info: BasicInfo, filedownload_events:
     return True
 
 
+def format_event(event: FileDownloadEvent) -> list:
+    if event.local_path in (None, '', 'N/A'):
+        return [event.ts, PLUGIN_ACTIVITY_TYPE, f"From {event.data_url} , Origin: {event.origin_url} , Agent: {event.agent})", PLUGIN_NAME]
+    else:
+        return [event.ts, PLUGIN_ACTIVITY_TYPE, f"{event.local_path} (From {event.data_url} , Origin: {event.origin_url} , Agent: {event.agent})", PLUGIN_NAME]
+
+
 def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
-    timeline_events = []
+    extractors = (
+        extract_spotlight_dataview_file_download,
+        extract_safari_quarantine_file_download,
+        extract_chrome_file_download,
+        extract_quarantine_file_download,
+    )
+
+    # Hand the events of each extractor to the writer as soon as they are ready. Later extractors skip the downloads
+    # found earlier and fill in a missing agent, so an event without an agent is held until it gets one or the last
+    # extractor has run.
     filedownload_events = []
-    extract_spotlight_dataview_file_download(basic_info, filedownload_events)
-    extract_safari_quarantine_file_download(basic_info, filedownload_events)
-    extract_chrome_file_download(basic_info, filedownload_events)
-    extract_quarantine_file_download(basic_info, filedownload_events)
-
-    for event in filedownload_events:
-        if event.local_path in (None, '', 'N/A'):
-            event = [event.ts, PLUGIN_ACTIVITY_TYPE, f"From {event.data_url} , Origin: {event.origin_url} , Agent: {event.agent})", PLUGIN_NAME]
+    pending_events = []
+    events_count = 0
+    for extractor in extractors:
+        new_events_index = len(filedownload_events)
+        basic_info.run_extractor(extractor, filedownload_events)
+        pending_events += filedownload_events[new_events_index:]
+        if extractor is not extractors[-1]:
+            ready_events = [event for event in pending_events if event.agent not in (None, '', 'N/A')]
+            pending_events = [event for event in pending_events if event.agent in (None, '', 'N/A')]
         else:
-            event = [event.ts, PLUGIN_ACTIVITY_TYPE, f"{event.local_path} (From {event.data_url} , Origin: {event.origin_url} , Agent: {event.agent})", PLUGIN_NAME]
-        timeline_events.append(event)
-
-    log.info(f"Detected {len(timeline_events)} events.")
-    if len(timeline_events) > 0:
-        basic_info.data_writer.write_data_rows(timeline_events)
-        return True
+            ready_events, pending_events = pending_events, []
+        if len(ready_events) > 0:
+            basic_info.data_writer.write_data_rows([format_event(event) for event in ready_events])
+            events_count += len(ready_events)
 
-    return False
+    log.info(f"Detected {events_count} events.")
+    return events_count > 0
 
 
 if __name__ == '__main__':
@@ -11,14 +11,22 @@
 from __future__ import annotations
 
 import datetime
+import functools
+import itertools
+import logging
+import operator
+import os
 import sqlite3
 import sys
+import threading
 from enum import Enum, Flag, auto
 
-import pytz
-
+from plugins.helpers.memory import MemoryMonitor
+from plugins.helpers.unifiedlogs_stream import UNIFIEDLOGS_COLUMNS, read_unifiedlogs_stream
 from plugins.helpers.writer import TLEventWriter
 
+log = logging.getLogger('MA2TL.HELPERS.BASIC_INFO')
+
 
 # class MacAptDBType(Enum):
 class MacAptDBType(Flag):
@@ -34,8 +42,20 @@ class OutputParams:
         self.logger_root = ''
         self.output_path = ''
         self.use_sqlite = False
+        self.sqlite_page_size = 0
         self.use_xlsx = False
         self.use_tsv = False
+        self.tsv_compression = ''
+        self.tsv_buffer_size = 16 * 1024 * 1024
+        self.use_ndjson = False
+        self.ndjson_path = ''
+        self.writer_queue_size = 64
+        # Callable that receives each batch of event rows, e.g. to stream them to a client of the service
+        self.event_callback = None
+        # Records the peak memory of each plugin and extractor (--memory_report)
+        self.memory_report = False
+        # Memory budget in MiB. Memory-heavy structures of extractors are moved to disk before it is reached.
+        self.memory_budget = 0
 
 
 class ExistDbs(Flag):
@@ -46,8 +66,228 @@ class ExistDbs(Flag):
     ALL = MACAPT_DB | UNIFIED_LOGS | APFS_VOLUMES
 
 
+class TableQuery:
+    # What an extractor reads from a table. Each backend translates it into its own access method.
+    # The time range is inclusive and compared as text, the same as BETWEEN of SQLite.
+    # Prefixes and substrings are matched case-insensitively, the same as LIKE of SQLite.
+    def __init__(self, table, columns=None, time_column='', start_ts='', end_ts='', equals=None, prefixes=None,
+                 contains=None, excludes=None, order_by='', descending=False, limit=0):
+        self.table = table
+        self.columns = columns          # None means all columns
+        self.time_column = time_column
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.equals = equals or {}      # column: value, or tuple of values
+        self.prefixes = prefixes or {}  # column: tuple of prefixes (any of them)
+        self.contains = contains or {}  # column: tuple of substrings (any of them)
+        self.excludes = excludes or {}  # column: tuple of substrings (none of them)
+        self.order_by = order_by
+        self.descending = descending
+        self.limit = limit
+
+
+class SqliteBackend:
+    def __init__(self, conn, extra_conditions=None):
+        self.conn = conn
+        # Callable that returns additional SQL conditions for a TableQuery
+        self.extra_conditions = extra_conditions
+
+    def get_tables(self):
+        sql = "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') UNION SELECT name FROM sqlite_temp_master WHERE type IN ('table', 'view');"
+        return [row[0] for row in self.conn.execute(sql)]
+
+    def get_columns(self, table):
+        return [row[1] for row in self.conn.execute(f'PRAGMA table_info("{table}");')]
+
+    def get_time_bounds(self, table, column):
+        # MIN() and MAX() are read from an index whose first column is the time column.
+        # Without such an index, they would need a full scan, so the bounds are unknown (None).
+        for index in self.conn.execute(f'PRAGMA index_list("{table}");').fetchall():
+            if index[4]:  # partial index
+                continue
+            first_column = self.conn.execute(f'PRAGMA index_info("{index[1]}");').fetchone()
+            if first_column and first_column[2] == column:
+                min_ts = self.conn.execute(f'SELECT MIN("{column}") FROM "{table}";').fetchone()[0]
+                max_ts = self.conn.execute(f'SELECT MAX("{column}") FROM "{table}";').fetchone()[0]
+                return min_ts, max_ts
+        return None
+
+    def select(self, query: TableQuery):
+        conditions = []
+        params = []
+        if query.time_column:
+            conditions.append(f'"{query.time_column}" BETWEEN ? AND ?')
+            params += [query.start_ts, query.end_ts]
+        for column, values in query.equals.items():
+            values = values if isinstance(values, tuple) else (values,)
+            conditions.append(f'"{column}" IN ({", ".join("?" * len(values))})')
+            params += values
+        for column, prefixes in query.prefixes.items():
+            conditions.append(self._like_any(column, prefixes))
+            params += [self._escape_like(prefix) + '%' for prefix in prefixes]
+        for column, substrings in query.contains.items():
+            conditions.append(self._like_any(column, substrings))
+            params += ['%' + self._escape_like(substring) + '%' for substring in substrings]
+        for column, substrings in query.excludes.items():
+            conditions.append('NOT ' + self._like_any(column, substrings))
+            params += ['%' + self._escape_like(substring) + '%' for substring in substrings]
+        if self.extra_conditions:
+            conditions += self.extra_conditions(query)
+
+        columns = ', '.join(f'"{column}"' for column in query.columns) if query.columns else '*'
+        sql = f'SELECT {columns} FROM "{query.table}"'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if query.order_by:
+            sql += f' ORDER BY "{query.order_by}"' + (' DESC' if query.descending else '')
+        if query.limit:
+            sql += f' LIMIT {int(query.limit)}'
+        # A new cursor for each query, so that extractors can run another query while iterating over rows.
+        return self.conn.execute(sql + ';', params)
+
+    @staticmethod
+    def _like_any(column, patterns):
+        return '(' + ' OR '.join(f'"{column}" LIKE ? ESCAPE \'\\\'' for _ in patterns) + ')'
+
+    @staticmethod
+    def _escape_like(text):
+        return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class ParquetBackend:
+    # Tables of a mac_apt DB stored as <folder>/<table name>.parquet (created by helper_tools/madb2parquet.py).
+    # Time range and equality filters are pushed down to pyarrow, which skips the row groups whose min/max
+    # statistics are outside of them. pyarrow is needed only for this backend.
+    def __init__(self, path):
+        import pyarrow.dataset
+        self.path = path
+        self.datasets = {}
+        self._dataset = pyarrow.dataset.dataset
+
+    def _get_dataset(self, table):
+        if table not in self.datasets:
+            table_path = os.path.join(self.path, f"{table}.parquet")
+            self.datasets[table] = self._dataset(table_path, format='parquet') if os.path.exists(table_path) else None
+        return self.datasets[table]
+
+    def get_tables(self):
+        return [os.path.splitext(name)[0] for name in os.listdir(self.path) if name.endswith('.parquet')]
+
+    def get_columns(self, table):
+        dataset = self._get_dataset(table)
+        return dataset.schema.names if dataset is not None else []
+
+    def get_time_bounds(self, table, column):
+        # MIN and MAX are taken from the statistics of the row groups without reading the data.
+        dataset = self._get_dataset(table)
+        if dataset is None:
+            return None
+
+        min_values = []
+        max_values = []
+        for fragment in dataset.get_fragments():
+            metadata = fragment.metadata
+            column_index = metadata.schema.names.index(column)
+            for row_group_index in range(metadata.num_row_groups):
+                row_group = metadata.row_group(row_group_index)
+                if row_group.num_rows == 0:
+                    continue
+                statistics = row_group.column(column_index).statistics
+                if statistics is None or not statistics.has_min_max:
+                    return None
+                min_values.append(statistics.min)
+                max_values.append(statistics.max)
+        if not min_values:
+            return None
+        return min(min_values), max(max_values)
+
+    def select(self, query: TableQuery):
+        import pyarrow.compute as pc
+        import pyarrow.types
+
+        dataset = self._get_dataset(query.table)
+        if dataset is None:
+            return []
+
+        filters = []
+        if query.time_column:
+            # The time window is text. As in SQLite, which sorts numbers before and BLOBs after any text,
+            # a time column of another type (e.g. all integers) has no rows in it.
+            time_type = dataset.schema.field(query.time_column).type
+            if not (pyarrow.types.is_string(time_type) or pyarrow.types.is_large_string(time_type)):
+                return []
+            filters.append((pc.field(query.time_column) >= query.start_ts) & (pc.field(query.time_column) <= query.end_ts))
+        for column, values in query.equals.items():
+            filters.append(pc.field(column).isin(list(values) if isinstance(values, tuple) else [values]))
+        for column, prefixes in query.prefixes.items():
+            filters.append(self._any(pc.starts_with(pc.field(column), prefix, ignore_case=True) for prefix in prefixes))
+        for column, substrings in query.contains.items():
+            filters.append(self._any(pc.match_substring(pc.field(column), substring, ignore_case=True) for substring in substrings))
+        for column, substrings in query.excludes.items():
+            filters.append(~self._any(pc.match_substring(pc.field(column), substring, ignore_case=True) for substring in substrings))
+
+        columns = list(query.columns) if query.columns else None
+        if columns and query.order_by and query.order_by not in columns:
+            columns.append(query.order_by)
+        table = dataset.to_table(columns=columns, filter=self._all(filters) if filters else None)
+        if query.order_by:
+            table = table.sort_by([(query.order_by, 'descending' if query.descending else 'ascending')])
+        if query.limit:
+            table = table.slice(0, query.limit)
+        return table.to_pylist()
+
+    @staticmethod
+    def _any(expressions):
+        return functools.reduce(operator.or_, expressions)
+
+    @staticmethod
+    def _all(expressions):
+        return functools.reduce(operator.and_, expressions)
+
+
+class DbCatalog:
+    # Tables, columns and time bounds of one DB. Each of them is read from the backend once and cached.
+    def __init__(self, backend):
+        self.backend = backend
+        self.tables = None
+        self.columns = dict()
+        self.time_bounds = dict()
+
+    def has_table(self, table):
+        if self.tables is None:
+            self.tables = set(self.backend.get_tables())
+        return table in self.tables
+
+    def get_columns(self, table):
+        if table not in self.columns:
+            self.columns[table] = self.backend.get_columns(table) if self.has_table(table) else []
+        return self.columns[table]
+
+    def get_time_bounds(self, table, column):
+        # (MIN, MAX) of a time column, or None if they cannot be read cheaply
+        if (table, column) not in self.time_bounds:
+            has_column = column in self.get_columns(table)
+            self.time_bounds[(table, column)] = self.backend.get_time_bounds(table, column) if has_column else None
+        return self.time_bounds[(table, column)]
+
+    def can_match(self, query: TableQuery) -> bool:
+        # Returns False only if the table does not exist or the time range of the query is outside of the data.
+        # Only text bounds are compared, because SQLite sorts numbers before and BLOBs after any text.
+        if not self.has_table(query.table):
+            return False
+        if query.time_column:
+            bounds = self.get_time_bounds(query.table, query.time_column)
+            if bounds:
+                min_ts, max_ts = bounds
+                if isinstance(max_ts, str) and max_ts < query.start_ts:
+                    return False
+                if isinstance(min_ts, str) and min_ts > query.end_ts:
+                    return False
+        return True
+
+
 class MacAptDbs:
-    def __init__(self, mac_apt_db='', unifiedlogs_db='', apfs_volumes_db=''):
+    def __init__(self, mac_apt_db='', unifiedlogs_db='', apfs_volumes_db='', unifiedlogs_stream=''):
         self.mac_apt_db_path = mac_apt_db
         self.mac_apt_db_conn = None
         self.mac_apt_db_cursor = None
@@ -55,6 +295,8 @@ class MacAptDbs:
         self.unifiedlogs_db_path = unifiedlogs_db
         self.unifiedlogs_db_conn = None
         self.unifiedlogs_db_cursor = None
+        # Exported Unified Logs (log show --style ndjson, or aul2madb TSV) read instead of UnifiedLogs.db
+        self.unifiedlogs_stream_path = unifiedlogs_stream
 
         self.apfs_volumes_db_path = apfs_volumes_db
         self.apfs_volumes_db_conn = None
@@ -64,29 +306,94 @@ class MacAptDbs:
         self.has_unifiedlogs_db = False
         self.has_apfs_volumes_db = False
 
+        # SqliteBackend or ParquetBackend for each DB type, used by select()
+        self.backends = {}
+        # DbCatalog for each DB type
+        self.catalogs = {}
+        # Time window (UTC) for selecting the partitions of UnifiedLogs.db when it is opened
+        self.unifiedlogs_time_window = None
+
+        # (ColumnName, Value): [(MinTimeUtc, MaxTimeUtc), ...] from UnifiedLogsStats created by ndjson2madb.py
+        self.unifiedlogs_stats = None
+        # TemplateID: Template from UnifiedLogsTemplates created by ndjson2madb.py --mine_templates
+        self.unifiedlogs_templates = None
+        self.unifiedlogs_template_conditions = dict()
+        # RAM budget in MiB of the temporary DBs for -u and --working_set. SQLite spills the rest to a temp file.
+        self.working_set_budget = 512
+        # Set by interrupt() to stop the plugin that is running. Queries fail while it is set.
+        self.interrupted = False
+        # Held by a stream of the library API (ma2tl.astream()) while it runs plugins on the DBs.
+        self.query_lock = threading.Lock()
+
     def open_dbs(self):
-        if self.mac_apt_db_path:
-            # self.mac_apt_db_conn = sqlite3.connect(self.mac_apt_db_path)
-            self.mac_apt_db_conn = sqlite3.connect(f"file:{self.mac_apt_db_path}?mode=ro", uri=True)
-            self.mac_apt_db_conn.row_factory = sqlite3.Row
-            self.mac_apt_db_cursor = self.mac_apt_db_conn.cursor()
-            self.has_mac_apt_db = True
-
-        if self.unifiedlogs_db_path:
-            # self.unifiedlogs_db_conn = sqlite3.connect(self.unifiedlogs_db_path)
-            self.unifiedlogs_db_conn = sqlite3.connect(f"file:{self.unifiedlogs_db_path}?mode=ro", uri=True)
-            self.unifiedlogs_db_conn.row_factory = sqlite3.Row
-            self.unifiedlogs_db_cursor = self.unifiedlogs_db_conn.cursor()
-            self.has_unifiedlogs_db = True
-
-        if self.apfs_volumes_db_path:
-            # self.apfs_volumes_db_conn = sqlite3.connect(self.apfs_volumes_db_path)
-            self.apfs_volumes_db_conn = sqlite3.connect(f"file:{self.apfs_volumes_db_path}?mode=ro", uri=True)
-            self.apfs_volumes_db_conn.row_factory = sqlite3.Row
-            self.apfs_volumes_db_cursor = self.apfs_volumes_db_conn.cursor()
-            self.has_apfs_volumes_db = True
+        # Only the available DBs are recorded here. Each DB is connected when it is used for the first time,
+        # so the DBs that the plugins to run do not read are never opened.
+        self.has_mac_apt_db = bool(self.mac_apt_db_path)
+        self.has_unifiedlogs_db = bool(self.unifiedlogs_stream_path or self.unifiedlogs_db_path)
+        self.has_apfs_volumes_db = bool(self.apfs_volumes_db_path)
+
+    def _connect(self, db_type: MacAptDBType):
+        # A folder (e.g. mac_apt.parquet) is opened as Parquet tables. run_query() works with SQLite DBs only.
+        if db_type == MacAptDBType.MACAPT_DB:
+            if os.path.isdir(self.mac_apt_db_path):
+                self.backends[db_type] = ParquetBackend(self.mac_apt_db_path)
+            else:
+                # self.mac_apt_db_conn = sqlite3.connect(self.mac_apt_db_path)
+                self.mac_apt_db_conn = sqlite3.connect(f"file:{self.mac_apt_db_path}?mode=ro", uri=True, check_same_thread=False)
+                self.mac_apt_db_conn.row_factory = sqlite3.Row
+                self.mac_apt_db_cursor = self.mac_apt_db_conn.cursor()
+                self.backends[db_type] = SqliteBackend(self.mac_apt_db_conn)
+            log.info(f"Opened {self.mac_apt_db_path}")
+
+        elif db_type == MacAptDBType.UNIFIED_LOGS:
+            if self.unifiedlogs_stream_path:
+                # Rows are loaded by load_unifiedlogs_stream() into a temporary DB.
+                self.unifiedlogs_db_conn = self._open_working_db(UNIFIEDLOGS_COLUMNS)
+                self.unifiedlogs_db_cursor = self.unifiedlogs_db_conn.cursor()
+                self.backends[db_type] = SqliteBackend(self.unifiedlogs_db_conn)
+            elif os.path.isdir(self.unifiedlogs_db_path):
+                self.backends[db_type] = ParquetBackend(self.unifiedlogs_db_path)
+            else:
+                # self.unifiedlogs_db_conn = sqlite3.connect(self.unifiedlogs_db_path)
+                self.unifiedlogs_db_conn = sqlite3.connect(f"file:{self.unifiedlogs_db_path}?mode=ro", uri=True, check_same_thread=False)
+                self.unifiedlogs_db_conn.row_factory = sqlite3.Row
+                self.unifiedlogs_db_cursor = self.unifiedlogs_db_conn.cursor()
+                self.backends[db_type] = SqliteBackend(self.unifiedlogs_db_conn, self._get_unifiedlogs_template_conditions)
+                self._load_unifiedlogs_stats()
+                self._load_unifiedlogs_templates()
+                if self.unifiedlogs_time_window:
+                    self.select_unifiedlogs_partitions(*self.unifiedlogs_time_window)
+                log.info(f"Opened {self.unifiedlogs_db_path}")
+
+        elif db_type == MacAptDBType.APFS_VOLUMES:
+            if os.path.isdir(self.apfs_volumes_db_path):
+                self.backends[db_type] = ParquetBackend(self.apfs_volumes_db_path)
+            else:
+                # self.apfs_volumes_db_conn = sqlite3.connect(self.apfs_volumes_db_path)
+                self.apfs_volumes_db_conn = sqlite3.connect(f"file:{self.apfs_volumes_db_path}?mode=ro", uri=True, check_same_thread=False)
+                self.apfs_volumes_db_conn.row_factory = sqlite3.Row
+                self.apfs_volumes_db_cursor = self.apfs_volumes_db_conn.cursor()
+                self.backends[db_type] = SqliteBackend(self.apfs_volumes_db_conn)
+            log.info(f"Opened {self.apfs_volumes_db_path}")
+
+    def _get_backend(self, db_type: MacAptDBType):
+        if db_type not in self.backends and db_type in (MacAptDBType.MACAPT_DB, MacAptDBType.UNIFIED_LOGS, MacAptDBType.APFS_VOLUMES) \
+                and self.has_dbs(db_type):
+            self._connect(db_type)
+        return self.backends.get(db_type)
+
+    def get_catalog(self, db_type: MacAptDBType) -> DbCatalog | None:
+        if db_type not in self.catalogs:
+            backend = self._get_backend(db_type)
+            if backend is None:
+                return None
+            self.catalogs[db_type] = DbCatalog(backend)
+        return self.catalogs[db_type]
 
     def close_dbs(self):
+        self.backends = {}
+        self.catalogs = {}
+        self.has_mac_apt_db = self.has_unifiedlogs_db = self.has_apfs_volumes_db = False
         if self.mac_apt_db_conn:
             self.mac_apt_db_path = ''
             self.mac_apt_db_conn.close()
@@ -94,6 +401,7 @@ class MacAptDbs:
 
         if self.unifiedlogs_db_conn:
             self.unifiedlogs_db_path = ''
+            self.unifiedlogs_stream_path = ''
             self.unifiedlogs_db_conn.close()
             self.has_unifiedlogs_db = False
 
@@ -104,14 +412,14 @@ class MacAptDbs:
 
     def has_dbs(self, db_type: MacAptDBType) -> MacAptDBType:
         result = MacAptDBType.NONE
-        if db_type | MacAptDBType.MACAPT_DB and self.has_mac_apt_db:
+        if db_type & MacAptDBType.MACAPT_DB and self.has_mac_apt_db:
             result = MacAptDBType.MACAPT_DB
-        if db_type | MacAptDBType.UNIFIED_LOGS and self.has_unifiedlogs_db:
+        if db_type & MacAptDBType.UNIFIED_LOGS and self.has_unifiedlogs_db:
             if result == MacAptDBType.NONE:
                 result = MacAptDBType.UNIFIED_LOGS
             else:
                 result |= MacAptDBType.UNIFIED_LOGS
-        if db_type | MacAptDBType.APFS_VOLUMES and self.has_apfs_volumes_db:
+        if db_type & MacAptDBType.APFS_VOLUMES and self.has_apfs_volumes_db:
             if result == MacAptDBType.NONE:
                 result = MacAptDBType.APFS_VOLUMES
             else:
@@ -122,7 +430,18 @@ class MacAptDbs:
         else:
             return False
 
+    def interrupt(self):
+        # Stops the running SQLite queries and fails the following queries until interrupted is reset, so that
+        # the running plugin stops. It can be called from any thread. A Parquet scan is not stopped until it ends.
+        self.interrupted = True
+        for conn in (self.mac_apt_db_conn, self.unifiedlogs_db_conn, self.apfs_volumes_db_conn):
+            if conn:
+                conn.interrupt()
+
     def run_query(self, db_type: MacAptDBType, query: str) -> sqlite3.Row | tuple:
+        if self.interrupted:
+            raise sqlite3.OperationalError('interrupted')
+        self._get_backend(db_type)
         cursor = None
         if db_type == MacAptDBType.MACAPT_DB and self.has_mac_apt_db:
             cursor = self.mac_apt_db_cursor
@@ -136,33 +455,259 @@ class MacAptDbs:
         else:
             return tuple()
 
-    def is_table_exist(self, db_type: MacAptDBType, table_name: str) -> bool:
-        if db_type == MacAptDBType.MACAPT_DB:
-            cursor = self.mac_apt_db_cursor
-        if db_type == MacAptDBType.UNIFIED_LOGS:
-            cursor = self.unifiedlogs_db_cursor
-        if db_type == MacAptDBType.APFS_VOLUMES:
-            cursor = self.apfs_volumes_db_cursor
+    def select(self, db_type: MacAptDBType, query: TableQuery):
+        # Queries on a missing table or outside of the time bounds of the data are not run.
+        if self.interrupted:
+            raise sqlite3.OperationalError('interrupted')
+        catalog = self.get_catalog(db_type)
+        if catalog and catalog.can_match(query):
+            return catalog.backend.select(query)
+        else:
+            if catalog:
+                log.debug(f"Skipped a query on {query.table}: no data in {query.start_ts} - {query.end_ts}" if catalog.has_table(query.table)
+                          else f"Skipped a query on {query.table}: the table does not exist")
+            return tuple()
+
+    def can_match(self, db_type: MacAptDBType, query: TableQuery) -> bool:
+        catalog = self.get_catalog(db_type)
+        return catalog.can_match(query) if catalog else False
 
-        cursor.execute(f'SELECT * FROM sqlite_master WHERE type="table" and name="{table_name}"')
-        if cursor.fetchone():
+    def get_columns(self, db_type: MacAptDBType, table_name: str) -> list:
+        catalog = self.get_catalog(db_type)
+        return catalog.get_columns(table_name) if catalog else []
+
+    def _load_unifiedlogs_stats(self):
+        if not self.is_table_exist(MacAptDBType.UNIFIED_LOGS, 'UnifiedLogsStats'):
+            return
+
+        self.unifiedlogs_stats = dict()
+        for row in self.unifiedlogs_db_cursor.execute('SELECT ColumnName, Value, MinTimeUtc, MaxTimeUtc FROM UnifiedLogsStats WHERE Rows > 0;'):
+            self.unifiedlogs_stats.setdefault((row['ColumnName'], row['Value']), []).append((row['MinTimeUtc'], row['MaxTimeUtc']))
+        log.info(f"Loaded UnifiedLogs statistics: {len(self.unifiedlogs_stats)} entries")
+
+    def has_unifiedlogs_matches(self, filters: tuple, start_ts: str, end_ts: str) -> bool:
+        # Returns False only if the statistics prove that none of the filters can match a row in the time window.
+        # Each filter is a dict of column name and value pairs, and all of them must be present in the window.
+        self._get_backend(MacAptDBType.UNIFIED_LOGS)
+        if self.unifiedlogs_stats is None:
             return True
+
+        end_ts += '.999999'
+        for column_filter in filters:
+            for column_value in column_filter.items():
+                time_ranges = self.unifiedlogs_stats.get(column_value, [])
+                if not any(min_ts <= end_ts and max_ts >= start_ts for min_ts, max_ts in time_ranges):
+                    break
+            else:
+                return True
+
+        return False
+
+    def _load_unifiedlogs_templates(self):
+        if not self.is_table_exist(MacAptDBType.UNIFIED_LOGS, 'UnifiedLogsTemplates'):
+            return
+
+        self.unifiedlogs_templates = dict()
+        for row in self.unifiedlogs_db_cursor.execute('SELECT TemplateID, Template FROM UnifiedLogsTemplates WHERE TemplateID > 0;'):
+            self.unifiedlogs_templates[row['TemplateID']] = row['Template']
+        log.info(f"Loaded UnifiedLogs templates: {len(self.unifiedlogs_templates)} entries")
+
+    def get_unifiedlogs_template_condition(self, like_patterns: tuple) -> str:
+        # Returns an SQL condition that selects rows by TemplateID, which is an integer index lookup.
+        # A template is selected if any of the Message LIKE patterns can match a message of the template.
+        # TemplateID 0 is for the messages that were not mined, so it is always selected.
+        if self.unifiedlogs_templates is None:
+            return '1'
+
+        condition = self.unifiedlogs_template_conditions.get(like_patterns)
+        if condition is None:
+            template_ids = [0]
+            for template_id, template in self.unifiedlogs_templates.items():
+                if any(_like_pattern_may_match_template(like_pattern, template) for like_pattern in like_patterns):
+                    template_ids.append(template_id)
+            condition = f"TemplateID IN ({', '.join(map(str, template_ids))})"
+            self.unifiedlogs_template_conditions[like_patterns] = condition
+            log.debug(f"Selected {len(template_ids) - 1}/{len(self.unifiedlogs_templates)} templates for {like_patterns}")
+
+        return condition
+
+    def load_unifiedlogs_stream(self, start_ts: str, end_ts: str, filters=None) -> int:
+        # The exported Unified Logs are read in one sequential pass. Only the rows in the time window that
+        # match PLUGIN_UNIFIEDLOGS_FILTERS of the plugins to run are stored, so extractors run their queries as usual.
+        if not self.unifiedlogs_stream_path or self._get_backend(MacAptDBType.UNIFIED_LOGS) is None:
+            return 0
+
+        log.info(f"Reading UnifiedLogs stream: {self.unifiedlogs_stream_path}")
+        rows = read_unifiedlogs_stream(self.unifiedlogs_stream_path, start_ts, end_ts, filters)
+        total_rows = self._fill_working_db(self.unifiedlogs_db_conn, rows, len(UNIFIEDLOGS_COLUMNS))
+        self.catalogs.pop(MacAptDBType.UNIFIED_LOGS, None)
+        log.info(f"Loaded {total_rows} UnifiedLogs entries in the time window")
+        return total_rows
+
+    def load_unifiedlogs_working_set(self, start_ts: str, end_ts: str, filters=None) -> int:
+        # Copies the rows in the time window that match PLUGIN_UNIFIEDLOGS_FILTERS of the plugins to run from
+        # UnifiedLogs.db into an indexed temporary DB, which replaces UnifiedLogs.db for the extractors.
+        # UnifiedLogs.db is scanned once here instead of once per extractor.
+        self._get_backend(MacAptDBType.UNIFIED_LOGS)
+        if self.unifiedlogs_stream_path or self.unifiedlogs_db_cursor is None:
+            return 0
+
+        conditions = ['TimeUtc BETWEEN ? AND ?']
+        params = [start_ts, end_ts]
+        if filters is not None:
+            filter_conditions = []
+            for column_filter in filters:
+                filter_conditions.append('(' + ' AND '.join(f'"{column}" = ?' for column in column_filter) + ')')
+                params += column_filter.values()
+            conditions.append('(' + (' OR '.join(filter_conditions) or '0') + ')')
+
+        columns = [(row[1], row[2]) for row in self.unifiedlogs_db_cursor.execute('PRAGMA table_info("UnifiedLogs");')]
+        working_db_conn = self._open_working_db(columns)
+        rows = self.unifiedlogs_db_conn.execute(f'SELECT * FROM UnifiedLogs WHERE {" AND ".join(conditions)};', params)
+        total_rows = self._fill_working_db(working_db_conn, rows, len(columns))
+
+        self.unifiedlogs_db_conn.close()
+        self.unifiedlogs_db_conn = working_db_conn
+        self.unifiedlogs_db_cursor = working_db_conn.cursor()
+        self.backends[MacAptDBType.UNIFIED_LOGS].conn = working_db_conn
+        self.catalogs.pop(MacAptDBType.UNIFIED_LOGS, None)
+
+        page_count = self.unifiedlogs_db_cursor.execute('PRAGMA page_count;').fetchone()[0]
+        page_size = self.unifiedlogs_db_cursor.execute('PRAGMA page_size;').fetchone()[0]
+        size = page_count * page_size / 1024 / 1024
+        log.info(f"Copied {total_rows} UnifiedLogs entries in the time window to the working set ({size:.1f} MiB)")
+        if size > self.working_set_budget:
+            log.info(f"The working set exceeds {self.working_set_budget} MiB and partly resides in a temporary file")
+        return total_rows
+
+    def _open_working_db(self, columns):
+        # A temporary DB stays in the page cache up to working_set_budget, and SQLite spills the rest to a temp file.
+        conn = sqlite3.connect('')
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA cache_size = -{self.working_set_budget * 1024};')
+        conn.execute('CREATE TABLE UnifiedLogs (' + ', '.join(f'"{name}" {type_}' for name, type_ in columns) + ');')
+        return conn
+
+    @staticmethod
+    def _fill_working_db(conn, rows, columns_count: int) -> int:
+        sql = f'INSERT INTO UnifiedLogs VALUES (?{",?" * (columns_count - 1)});'
+        total_rows = 0
+        while chunk := list(itertools.islice(rows, 10000)):
+            conn.executemany(sql, chunk)
+            total_rows += len(chunk)
+        for index_columns in (('TimeUtc',), ('ProcessName', 'TimeUtc'), ('SenderName', 'TimeUtc'), ('Category', 'TimeUtc')):
+            conn.execute(f'CREATE INDEX "idx_UnifiedLogs_{"_".join(index_columns)}" ON UnifiedLogs ({", ".join(index_columns)});')
+        conn.commit()
+        return total_rows
+
+    def _get_unifiedlogs_template_conditions(self, query: TableQuery) -> list:
+        # Message prefixes and substrings of a query on UnifiedLogs also select the templates that can match.
+        if query.table != 'UnifiedLogs' or self.unifiedlogs_templates is None:
+            return []
+
+        like_patterns = tuple(prefix + '%' for prefix in query.prefixes.get('Message', ())) + \
+            tuple('%' + substring + '%' for substring in query.contains.get('Message', ()))
+        if not like_patterns:
+            return []
+        return [self.get_unifiedlogs_template_condition(like_patterns)]
+
+    def select_unifiedlogs_partitions(self, start_ts: str, end_ts: str) -> bool:
+        # UnifiedLogs.db created by ndjson2madb.py --partition_by_day has one table per UTC day and a manifest.
+        # A TEMP VIEW named UnifiedLogs over the partitions overlapping the time window shadows the VIEW over
+        # all partitions, so that plugin queries only touch those partitions.
+        if MacAptDBType.UNIFIED_LOGS not in self.backends:
+            # The partitions are selected when UnifiedLogs.db is opened.
+            self.unifiedlogs_time_window = (start_ts, end_ts)
+            return False
+        if not self.is_table_exist(MacAptDBType.UNIFIED_LOGS, 'UnifiedLogsPartitions'):
+            return False
+
+        partitions = self.unifiedlogs_db_cursor.execute(
+            'SELECT TableName FROM UnifiedLogsPartitions ORDER BY Day;').fetchall()
+        selected_partitions = self.unifiedlogs_db_cursor.execute(
+            'SELECT TableName, MinTimeUtc, MaxTimeUtc FROM UnifiedLogsPartitions WHERE MinTimeUtc <= ? AND MaxTimeUtc >= ? ORDER BY Day;',
+            (end_ts + '.999999', start_ts)).fetchall()
+        log.info(f"UnifiedLogs partitions in the time window: {len(selected_partitions)}/{len(partitions)}")
+
+        if selected_partitions:
+            sql = ' UNION ALL '.join(f'SELECT * FROM main."{row[0]}"' for row in selected_partitions)
+        elif partitions:
+            sql = f'SELECT * FROM main."{partitions[0][0]}" WHERE 0'
         else:
             return False
 
+        # The VIEW is replaced when another time window is selected (e.g. by the next query of the service).
+        self.unifiedlogs_db_cursor.execute('DROP VIEW IF EXISTS temp.UnifiedLogs;')
+        self.unifiedlogs_db_cursor.execute(f'CREATE TEMP VIEW UnifiedLogs AS {sql};')
+        # The VIEW has no index, so the time bounds in the catalog are taken from the manifest.
+        catalog = self.get_catalog(MacAptDBType.UNIFIED_LOGS)
+        catalog.time_bounds.pop(('UnifiedLogs', 'TimeUtc'), None)
+        if selected_partitions:
+            catalog.time_bounds[('UnifiedLogs', 'TimeUtc')] = (min(row[1] for row in selected_partitions), max(row[2] for row in selected_partitions))
+        return True
+
+    def is_table_exist(self, db_type: MacAptDBType, table_name: str) -> bool:
+        catalog = self.get_catalog(db_type)
+        return catalog.has_table(table_name) if catalog else False
+
+
+def _like_pattern_may_match_template(like_pattern: str, template: str) -> bool:
+    # Checks whether a message can match both the LIKE pattern and the template.
+    # In the pattern, "%" matches any string and "_" matches any character. LIKE is case-insensitive for ASCII.
+    # In the template, "<*>" is a token that matches any string without whitespace.
+    pattern = list(like_pattern.lower())
+    template_tokens = []
+    for index, token in enumerate(template.lower().split(' ')):
+        if index > 0:
+            template_tokens.append(' ')
+        if token == '<*>':
+            template_tokens.append(None)
+        else:
+            template_tokens.extend(token)
+
+    pattern_len = len(pattern)
+    template_len = len(template_tokens)
+    visited = set()
+    states = [(0, 0)]
+    while states:
+        state = states.pop()
+        if state in visited:
+            continue
+        visited.add(state)
+        i, j = state
+        if i == pattern_len and j == template_len:
+            return True
+        p = pattern[i] if i < pattern_len else ''
+        t = template_tokens[j] if j < template_len else ''
+        if p == '%':
+            states.append((i + 1, j))
+            if j < template_len:
+                states.append((i, j + 1))
+        elif t is None:
+            states.append((i, j + 1))
+            if p and not p.isspace():
+                states.append((i + 1, j))
+        elif p and t and (p == '_' or p == t):
+            states.append((i + 1, j + 1))
+
+    return False
+
 
 class BasicInfo:
     def __init__(self, mac_apt_dbs: MacAptDbs, output_params, start_ts, end_ts, timezone='UTC'):
         self.mac_apt_dbs = mac_apt_dbs
         self.output_params = output_params
         # self.analyzing_unifiedlogs_only = False
-        self.data_writer = TLEventWriter(output_params, 'ma2tl', 'ma2tl', timezone)
 
+        import pytz
         try:
             self.tzinfo_user = pytz.timezone(timezone)
             self.tzinfo_utc = pytz.timezone('UTC')
         except pytz.exceptions.UnknownTimeZoneError as ex:
-            sys.exit(f"Unknown TimeZone: {ex}")
+            raise ValueError(f"Unknown TimeZone: {ex}")
+
+        self.data_writer = TLEventWriter(output_params, 'ma2tl', 'ma2tl', timezone)
+        self.memory_monitor = MemoryMonitor(output_params.memory_report, output_params.memory_budget)
 
         self.start_dt_usertz = self._convert_ts_to_usertz(start_ts)
         self.end_dt_usertz = self._convert_ts_to_usertz(end_ts)
@@ -175,7 +720,7 @@ class BasicInfo:
 
     def _convert_ts_to_utc(self, ts):
         dt_aware_usertz = self._convert_ts_to_usertz(ts)
-        return dt_aware_usertz.astimezone(pytz.timezone('UTC'))
+        return dt_aware_usertz.astimezone(self.tzinfo_utc)
 
     def get_between_dates_usertz(self):
         fmt = '%Y-%m-%d %H:%M:%S'
@@ -185,6 +730,23 @@ class BasicInfo:
         fmt = '%Y-%m-%d %H:%M:%S'
         return [self.start_dt_utc.strftime(fmt), self.end_dt_utc.strftime(fmt)]
 
+    def has_unifiedlogs_matches(self, filters):
+        return self.mac_apt_dbs.has_unifiedlogs_matches(filters, *self.get_between_dates_utc())
+
+    def run_extractor(self, extractor, events: list) -> bool:
+        # Plugins run their extractors through this. An extractor listed in PLUGIN_UNIFIEDLOGS_FILTERS of its plugin
+        # is skipped when the statistics prove that none of its filters can match, and --memory_report records
+        # the peak memory of each extractor.
+        plugin = sys.modules[extractor.__module__]
+        filters = getattr(plugin, 'PLUGIN_UNIFIEDLOGS_FILTERS', {}).get(extractor.__name__)
+        if filters and not self.has_unifiedlogs_matches(filters):
+            plugin_log = logging.getLogger(self.output_params.logger_root + '.PLUGINS.' + plugin.PLUGIN_NAME)
+            plugin_log.info(f"Skipped {extractor.__name__}: no matching UnifiedLogs entries in the time window.")
+            return False
+
+        with self.memory_monitor.measure(extractor.__name__, 'Extractor'):
+            return extractor(self, events)
+
 
 if __name__ == '__main__':
     print('This file is part of forensic timeline generator "ma2tl". So, it cannot run separately.')
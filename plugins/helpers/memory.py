@@ -0,0 +1,211 @@
+#
+#    Copyright (c) 2023 Minoru Kobayashi
+#
+#    This file is part of ma2tl.
+#    Usage or distribution of this code is subject to the terms of the MIT License.
+#
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import tracemalloc
+
+log = logging.getLogger('MA2TL.HELPERS.MEMORY')
+
+MIB = 1024 * 1024
+# Memory-heavy structures are moved to disk when the memory usage reaches this ratio of --memory_budget.
+SPILL_RATIO = 0.8
+RSS_SAMPLING_INTERVAL = 0.01
+
+
+def get_rss() -> int:
+    # Current RSS in bytes. Returns 0 where it cannot be read with the standard library (e.g. macOS).
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def get_max_rss() -> int:
+    # Peak RSS of the process in bytes.
+    try:
+        import resource
+    except ImportError:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class MemorySection:
+    def __init__(self, name, kind, depth, traced_start):
+        self.name = name
+        self.kind = kind
+        self.depth = depth
+        self.traced_start = traced_start
+        self.traced_peak = traced_start
+        self.rss_peak = 0
+
+    def update(self, traced_peak, rss_peak):
+        self.traced_peak = max(self.traced_peak, traced_peak)
+        self.rss_peak = max(self.rss_peak, rss_peak)
+
+
+class MemoryMonitor:
+    # Records the peak memory of each plugin and extractor for --memory_report, and tells memory-heavy structures
+    # when to move to disk for --memory_budget (MiB). With neither of them, measure() does nothing.
+    def __init__(self, report=False, budget=0):
+        self.report = report
+        self.budget = budget * MIB
+        self.sections = []
+        self.stack = []
+        self.rss_peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started_tracemalloc = False
+        self.sampler = None
+        # The budget is compared with the current RSS. Where it cannot be read, the memory allocated by Python is
+        # used instead. The peak RSS of the process is not used, because it never goes down.
+        self.budget_uses_rss = bool(get_rss())
+        if self.budget and not self.budget_uses_rss:
+            log.warning("The current RSS cannot be read on this OS. --memory_budget is compared with the memory "
+                        "allocated by Python (tracemalloc), which makes ma2tl slower.")
+        if report or (self.budget and not self.budget_uses_rss):
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+        if report:
+            # RSS is sampled by a thread, because it can go up and down again while an extractor is running.
+            if get_rss():
+                self.sampler = threading.Thread(target=self._sample, daemon=True)
+                self.sampler.start()
+
+    def _sample(self):
+        while not self.stopped.wait(RSS_SAMPLING_INTERVAL):
+            rss = get_rss()
+            with self.lock:
+                self.rss_peak = max(self.rss_peak, rss)
+
+    def _take_peaks(self) -> tuple:
+        # Returns the peaks since the previous call, and resets them.
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        if self.sampler:
+            rss = get_rss()
+            with self.lock:
+                rss_peak = max(self.rss_peak, rss)
+                self.rss_peak = rss
+        else:
+            # Without RSS sampling, the peak RSS of the process so far is recorded.
+            rss_peak = get_max_rss()
+        return traced_peak, rss_peak
+
+    @contextlib.contextmanager
+    def measure(self, name, kind):
+        if not self.report:
+            yield
+            return
+
+        # A section includes the peaks of the sections nested in it.
+        peaks = self._take_peaks()
+        for section in self.stack:
+            section.update(*peaks)
+        section = MemorySection(name, kind, len(self.stack), tracemalloc.get_traced_memory()[0])
+        self.sections.append(section)
+        self.stack.append(section)
+        try:
+            yield
+        finally:
+            peaks = self._take_peaks()
+            for stacked_section in self.stack:
+                stacked_section.update(*peaks)
+            self.stack.pop()
+            log.debug(f"Peak memory of {name}: allocated {(section.traced_peak - section.traced_start) / MIB:.1f} MiB, RSS {section.rss_peak / MIB:.1f} MiB")
+
+    def is_near_budget(self) -> bool:
+        if not self.budget:
+            return False
+        usage = get_rss() if self.budget_uses_rss else tracemalloc.get_traced_memory()[0]
+        return usage >= self.budget * SPILL_RATIO
+
+    def write_report(self, file_path):
+        # PeakAllocatedMiB is the peak of the memory allocated by Python while a section was running (tracemalloc).
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('Name\tType\tPeakAllocatedMiB\tPeakRssMiB\n')
+            for section in self.sections:
+                f.write(f"{'  ' * section.depth}{section.name}\t{section.kind}\t{(section.traced_peak - section.traced_start) / MIB:.2f}\t{section.rss_peak / MIB:.2f}\n")
+        for section in self.sections:
+            if section.kind == 'Plugin':
+                log.info(f"Peak memory of {section.name}: allocated {(section.traced_peak - section.traced_start) / MIB:.1f} MiB, RSS {section.rss_peak / MIB:.1f} MiB")
+        log.info(f"Memory report: {file_path}")
+
+    def close(self):
+        self.stopped.set()
+        if self.sampler:
+            self.sampler.join()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+
+class SpillableRecords:
+    # Records keyed by a string in insertion order. Each record is a dict of the columns of defaults.
+    # They are kept in a dict, and moved to a temporary SQLite table when the memory usage reaches
+    # SPILL_RATIO of --memory_budget.
+    CHECK_INTERVAL = 1000
+
+    def __init__(self, monitor: MemoryMonitor, defaults: dict):
+        self.monitor = monitor
+        self.defaults = defaults
+        self.columns = tuple(defaults.keys())
+        self.column_list = ', '.join(f'"{column}"' for column in self.columns)
+        self.records = dict()
+        self.conn = None
+
+    def set(self, key, values: dict, initial_values: dict):
+        # Updates the record of key with values. A new record is created from defaults, initial_values and values.
+        if self.conn is None:
+            record = self.records.get(key)
+            if record is not None:
+                record.update(values)
+                return
+            self.records[key] = {**self.defaults, **initial_values, **values}
+            if len(self.records) % self.CHECK_INTERVAL == 0 and self.monitor.is_near_budget():
+                self._spill()
+        else:
+            record = {**self.defaults, **initial_values, **values}
+            update = ', '.join(f'"{column}" = excluded."{column}"' for column in values)
+            self.conn.execute(f"INSERT INTO Records (Key, {self.column_list}) "
+                              f"VALUES (?{', ?' * len(self.columns)}) ON CONFLICT (Key) DO UPDATE SET {update}",
+                              (key, *(record[column] for column in self.columns)))
+
+    def _spill(self):
+        # An empty file name opens a temporary DB on disk, which is deleted when it is closed.
+        self.conn = sqlite3.connect('')
+        self.conn.execute(f"CREATE TABLE Records (Seq INTEGER PRIMARY KEY, Key TEXT UNIQUE, {self.column_list})")
+        self.conn.executemany(f"INSERT INTO Records (Key, {self.column_list}) VALUES (?{', ?' * len(self.columns)})",
+                              ((key, *(record[column] for column in self.columns)) for key, record in self.records.items()))
+        log.info(f"Moved {len(self.records)} records to a temporary DB: the memory usage reached {SPILL_RATIO:.0%} of the budget.")
+        self.records = dict()
+
+    def items(self):
+        if self.conn is None:
+            yield from self.records.items()
+        else:
+            for row in self.conn.execute(f"SELECT Key, {self.column_list} FROM Records ORDER BY Seq"):
+                yield row[0], dict(zip(self.columns, row[1:]))
+
+    def close(self):
+        self.records = dict()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+if __name__ == '__main__':
+    print('This file is part of forensic timeline generator "ma2tl". So, it cannot run separately.')
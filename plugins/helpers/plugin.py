@@ -8,16 +8,71 @@
 #    This code is based on mac_apt's plugin.py
 #
 
+import ast
 import logging
 import os
 import sys
 import traceback
 from importlib import import_module
 
+# Module level variables of a plugin that are read from its source without importing it
+#   PLUGIN_DB_TYPES: mac_apt DBs (names of MacAptDBType) that the plugin reads. The plugin is skipped if none of
+#                    them is available.
+#   PLUGIN_UNIFIEDLOGS_FILTERS: UnifiedLogs rows that each extractor can match ({extractor name: (filter, ...)},
+#                    where a filter is a dict of column name and value pairs). Used by helper_tools/ndjson2madb.py
+#                    --ma2tl-only, by -u and --working_set to load only the relevant rows, and by
+#                    BasicInfo.run_extractor() to skip extractors with no matching rows.
+PLUGIN_METADATA = ('PLUGIN_NAME', 'PLUGIN_DESCRIPTION', 'PLUGIN_ACTIVITY_TYPE', 'PLUGIN_VERSION', 'PLUGIN_AUTHOR',
+                   'PLUGIN_AUTHOR_EMAIL', 'PLUGIN_DB_TYPES', 'PLUGIN_UNIFIEDLOGS_FILTERS')
+# PLUGIN_NAME of the bundled plugins is derived from the file name with this expression
+PLUGIN_NAME_FROM_FILENAME = ast.dump(ast.parse('os.path.splitext(os.path.basename(__file__))[0].upper()', mode='eval').body)
+
+
+class LazyPlugin:
+    # Holds the metadata of a plugin and imports the plugin module when it is run for the first time.
+    def __init__(self, module_name, metadata):
+        self.module_name = module_name
+        self.module = None
+        for name, value in metadata.items():
+            setattr(self, name, value)
+
+    def load(self):
+        if self.module is None:
+            self.module = import_module(self.module_name)
+        return self.module
+
+    def run(self, basic_info):
+        return self.load().run(basic_info)
+
+
+def read_plugin_metadata(file_path):
+    # Returns None if the metadata is not written as literals, so that the plugin is imported instead.
+    with open(file_path, 'rt', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), file_path)
+
+    metadata = dict()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and \
+           node.targets[0].id in PLUGIN_METADATA:
+            name = node.targets[0].id
+            if name == 'PLUGIN_NAME' and ast.dump(node.value) == PLUGIN_NAME_FROM_FILENAME:
+                metadata[name] = os.path.splitext(os.path.basename(file_path))[0].upper()
+                continue
+            try:
+                metadata[name] = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+
+    return metadata
+
 
 def import_plugins(plugins):
-    plugin_path = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), "plugins")
-    sys.path.append(plugin_path)
+    # Plugin modules are not imported here. Their metadata is read from the sources, and a plugin is imported
+    # when it runs. Plugins whose metadata are not literals are imported as before.
+    # The plugins folder is found from this file, so that ma2tl can also be imported as a library.
+    plugin_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    if plugin_path not in sys.path:
+        sys.path.append(plugin_path)
     imported_plugin_name = []
 
     try:
@@ -25,35 +80,63 @@ def import_plugins(plugins):
         for filename in dir_list:
             if filename.endswith(".py") and not filename.startswith("_"):
                 try:
-                    plugin = import_module(filename.replace(".py", ""))
+                    module_name = filename.replace(".py", "")
+                    metadata = read_plugin_metadata(os.path.join(plugin_path, filename))
+                    if metadata is None:
+                        plugin = import_module(module_name)
+                    else:
+                        plugin = LazyPlugin(module_name, metadata)
                     if _check_plugin_validation(plugin):
                         if plugin.PLUGIN_NAME not in imported_plugin_name:
                             plugins.append(plugin)
                             imported_plugin_name.append(plugin.PLUGIN_NAME)
                         else:
-                            print(f"Failed to import plugin - {filename} : Plugin name {plugin.PLUGIN_NAME} is already in use. This plugin is skipped.")
+                            print(f"Failed to import plugin - {filename} : Plugin name {plugin.PLUGIN_NAME} is already in use. This plugin is skipped.", file=sys.stderr)
                     else:
-                        print(f"Failed to import plugin - {filename} : Plugin is missing a required variable")
+                        print(f"Failed to import plugin - {filename} : Plugin is missing a required variable", file=sys.stderr)
 
                 except Exception as ex:
-                    print(f"Failed to import plugin - {filename}")
-                    print(f"Plugin import exception details: {str(ex)}")
+                    print(f"Failed to import plugin - {filename}", file=sys.stderr)
+                    print(f"Plugin import exception details: {str(ex)}", file=sys.stderr)
                     continue
 
     except Exception as ex:
-        print("Error: Does plugin directory exist?")
-        print(f"Exception details: {str(ex)}")
+        print("Error: Does plugin directory exist?", file=sys.stderr)
+        print(f"Exception details: {str(ex)}", file=sys.stderr)
 
     plugins.sort(key=lambda plugin: plugin.PLUGIN_NAME)
     return len(plugins)
 
 
+def run_plugins(basic_info, plugins, log):
+    # A plugin is skipped without importing it when none of the DBs in its PLUGIN_DB_TYPES is available.
+    from plugins.helpers.basic_info import MacAptDBType
+
+    for plugin in plugins:
+        if basic_info.mac_apt_dbs.interrupted:
+            break
+        log.info("-"*50)
+        db_types = getattr(plugin, 'PLUGIN_DB_TYPES', ())
+        if db_types and not any(basic_info.mac_apt_dbs.has_dbs(MacAptDBType[db_type]) for db_type in db_types):
+            log.info(f"Skipped plugin - {plugin.PLUGIN_NAME}: None of {', '.join(db_types)} is available.")
+            continue
+        log.info(f"Running plugin - {plugin.PLUGIN_NAME}")
+        try:
+            with basic_info.memory_monitor.measure(plugin.PLUGIN_NAME, 'Plugin'):
+                plugin.run(basic_info)
+        except Exception:
+            if basic_info.mac_apt_dbs.interrupted:
+                log.info(f"Interrupted plugin - {plugin.PLUGIN_NAME}")
+            else:
+                log.exception(f"An exception occurred while running plugin - {plugin.PLUGIN_NAME}")
+
+
 def _check_plugin_validation(plugin):
     for attr in ('PLUGIN_NAME', 'PLUGIN_DESCRIPTION', 'PLUGIN_ACTIVITY_TYPE', 'PLUGIN_AUTHOR', 'PLUGIN_AUTHOR_EMAIL'):
         try:
             _ = getattr(plugin, attr)
         except Exception:
-            print(f"Plugin {plugin} does not have {attr}.")
+            print(f"Plugin {plugin} does not have {attr}.", file=sys.stderr)
             return False
 
     return True
@@ -68,7 +151,7 @@ def check_user_specified_plugin_name(plugins_to_run, plugins):
                 break
 
         if not found:
-            print(f"Error: Plugin name not found : {user_specified_plugin}")
+            print(f"Error: Plugin name not found : {user_specified_plugin}", file=sys.stderr)
             return False
 
     return True
@@ -83,14 +166,15 @@ def setup_logger(log_file_path, name, log_level=logging.INFO):
         log_file_handler.setFormatter(log_file_format)
         logger.addHandler(log_file_handler)
 
-        log_console_handler = logging.StreamHandler()
+        # Console logs always go to STDERR so that STDOUT can carry the NDJSON event stream.
+        log_console_handler = logging.StreamHandler(sys.stderr)
         log_console_handler.setLevel(log_level)
         log_console_format = logging.Formatter('%(name)s-%(levelname)s-%(message)s')
         log_console_handler.setFormatter(log_console_format)
         logger.addHandler(log_console_handler)
 
     except Exception as ex:
-        print("Error while trying to create log file\nError Details:\n")
+        print("Error while trying to create log file\nError Details:\n", file=sys.stderr)
         traceback.print_exc()
         sys.exit("Program aborted..could not create log file!")
 
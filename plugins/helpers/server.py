@@ -0,0 +1,193 @@
+#
+#    Copyright (c) 2023 Minoru Kobayashi
+#
+#    This file is part of ma2tl.
+#    Usage or distribution of this code is subject to the terms of the MIT License.
+#
+
+import collections
+import copy
+import http.server
+import json
+import logging
+import os
+import re
+import signal
+import socketserver
+import stat
+import time
+import urllib.parse
+
+from plugins.helpers.basic_info import BasicInfo
+from plugins.helpers.plugin import run_plugins
+
+log = logging.getLogger('MA2TL.HELPERS.SERVER')
+
+REGEX_TS = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
+
+
+class TimelineService:
+    # Keeps MacAptDbs of a case open between queries, so that plugins are imported, DBs are opened and their
+    # catalogs, statistics and templates are read only once. NDJSON results of recent queries are cached.
+    def __init__(self, mac_apt_dbs, plugins, output_params, timezone, cache_size):
+        self.mac_apt_dbs = mac_apt_dbs
+        self.plugins = plugins
+        self.output_params = output_params
+        self.timezone = timezone
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size * 1024 * 1024
+        self.cached_bytes = 0
+
+    def get_plugins_info(self) -> list:
+        return [{'name': plugin.PLUGIN_NAME, 'description': plugin.PLUGIN_DESCRIPTION, 'activity_type': plugin.PLUGIN_ACTIVITY_TYPE,
+                 'db_types': list(getattr(plugin, 'PLUGIN_DB_TYPES', ()))} for plugin in self.plugins]
+
+    def check_query(self, start_ts, end_ts, timezone, plugin_names) -> str:
+        # Returns an error message, or an empty string if the query is valid.
+        if not (re.fullmatch(REGEX_TS, start_ts) and re.fullmatch(REGEX_TS, end_ts)):
+            return 'Start timestamp or end timestamp cannot be recognized.'
+        for plugin_name in plugin_names:
+            if plugin_name not in (plugin.PLUGIN_NAME for plugin in self.plugins):
+                return f"Plugin name not found : {plugin_name}"
+
+        import pytz
+        try:
+            pytz.timezone(timezone)
+        except pytz.exceptions.UnknownTimeZoneError:
+            return f"Unknown TimeZone: {timezone}"
+        return ''
+
+    def query(self, start_ts, end_ts, timezone, plugin_names, write) -> bool:
+        # Passes NDJSON chunks of the events to write(). Returns True if the result was in the cache.
+        key = (start_ts, end_ts, timezone, tuple(plugin_names))
+        chunks = self.cache.get(key)
+        if chunks is not None:
+            self.cache.move_to_end(key)
+            for chunk in chunks:
+                write(chunk)
+            return True
+
+        keys = ['Timestamp (UTC)', f"Timestamp ({timezone})", 'ActivityType', 'Message', 'PluginName']
+        chunks = []
+        client = {'connected': True}
+
+        def send_rows(rows):
+            chunk = ''.join(json.dumps(dict(zip(keys, row)), ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+            chunks.append(chunk)
+            # Extraction goes on after the client has gone, so that the result is cached for the next query.
+            if client['connected']:
+                try:
+                    write(chunk)
+                except OSError:
+                    client['connected'] = False
+
+        output_params = copy.copy(self.output_params)
+        output_params.event_callback = send_rows
+        basic_info = BasicInfo(self.mac_apt_dbs, output_params, start_ts, end_ts, timezone)
+        try:
+            self.mac_apt_dbs.select_unifiedlogs_partitions(*basic_info.get_between_dates_utc())
+            run_plugins(basic_info, [plugin for plugin in self.plugins if plugin.PLUGIN_NAME in plugin_names], log)
+        finally:
+            basic_info.data_writer.close_writer()
+            basic_info.memory_monitor.close()
+        if basic_info.data_writer.writer_error is None:
+            self._store(key, chunks)
+        return False
+
+    def _store(self, key, chunks):
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.cache_size:
+            return
+        self.cache[key] = chunks
+        self.cached_bytes += size
+        while self.cached_bytes > self.cache_size:
+            _, evicted_chunks = self.cache.popitem(last=False)
+            self.cached_bytes -= sum(len(chunk) for chunk in evicted_chunks)
+
+
+class TimelineRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET /plugins
+    # GET /timeline?start=2023-08-30 00:00:00&end=2023-08-31 00:00:00&tz=UTC&plugins=PROG_EXEC,REMOTE_LOGIN
+    # Queries are answered one at a time, because plugins share the open DBs.
+    server_version = 'ma2tl'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        service = self.server.service
+
+        if url.path == '/plugins':
+            self._send_json(200, service.get_plugins_info())
+
+        elif url.path == '/timeline':
+            start_ts = params.get('start', '')
+            end_ts = params.get('end', '')
+            timezone = params.get('tz', service.timezone)
+            plugin_names = [name.strip().upper() for name in params.get('plugins', '').split(',') if name.strip()]
+            if not plugin_names or 'ALL' in plugin_names:
+                plugin_names = [plugin.PLUGIN_NAME for plugin in service.plugins]
+
+            error = service.check_query(start_ts, end_ts, timezone, plugin_names)
+            if error:
+                self._send_json(400, {'error': error})
+                return
+
+            log.info(f"Query: {start_ts} - {end_ts} ({timezone}) {','.join(plugin_names)}")
+            started_time = time.time()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            cached = service.query(start_ts, end_ts, timezone, plugin_names, self.wfile.write)
+            log.info(f"Answered in {time.time() - started_time:.2f} seconds{' from the cache' if cached else ''}")
+
+        else:
+            self._send_json(404, {'error': f"Not found: {url.path}"})
+
+    def _send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address of a Unix socket is not a (host, port) tuple.
+        log.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+
+def serve(address, service: TimelineService):
+    # address is [HOST:]PORT (HOST defaults to 127.0.0.1), or a path of a Unix socket.
+    result = re.fullmatch(r'(?:(.+):)?(\d+)', address)
+    if result:
+        server = http.server.HTTPServer((result.group(1) or '127.0.0.1', int(result.group(2))), TimelineRequestHandler)
+    else:
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise FileExistsError(f"{address} exists and is not a socket.")
+            os.remove(address)
+        server = UnixHTTPServer(address, TimelineRequestHandler)
+    server.service = service
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # SIGTERM stops the service the same as Ctrl+C.
+    signal.signal(signal.SIGTERM, stop)
+
+    log.info(f"Serving on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopped.")
+    finally:
+        server.server_close()
+        if not result and os.path.exists(address):
+            os.remove(address)
+
+
+if __name__ == '__main__':
+    print('This file is part of forensic timeline generator "ma2tl". So, it cannot run separately.')
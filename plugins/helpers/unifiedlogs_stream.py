@@ -0,0 +1,144 @@
+#
+#    Copyright (c) 2023 Minoru Kobayashi
+#
+#    This file is part of ma2tl.
+#    Usage or distribution of this code is subject to the terms of the MIT License.
+#
+
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import json
+import os
+
+# Same columns as UnifiedLogs table of mac_apt. helper_tools/ndjson2madb.py imports the definitions of this module,
+# so that UnifiedLogs.db and the stream read by -u have the same rows.
+UNIFIEDLOGS_COLUMNS = (
+    ('File', 'TEXT'),
+    ('DecompFilePos', 'INTEGER'),
+    ('ContinuousTime', 'TEXT'),
+    ('TimeUtc', 'TEXT'),
+    ('Thread', 'INTEGER'),
+    ('Type', 'TEXT'),
+    ('ActivityID', 'INTEGER'),
+    ('ParentActivityID', 'INTEGER'),
+    ('ProcessID', 'INTEGER'),
+    ('EffectiveUID', 'INTEGER'),
+    ('TTL', 'INTEGER'),
+    ('ProcessName', 'TEXT'),
+    ('SenderName', 'TEXT'),
+    ('Subsystem', 'TEXT'),
+    ('Category', 'TEXT'),
+    ('SignpostName', 'TEXT'),
+    ('SignpostInfo', 'TEXT'),
+    ('ImageOffset', 'INTEGER'),
+    ('SenderUUID', 'TEXT'),
+    ('ProcessImageUUID', 'TEXT'),
+    ('SenderImagePath', 'TEXT'),
+    ('ProcessImagePath', 'TEXT'),
+    ('Message', 'TEXT'),
+)
+COLUMN_INDEXES = {column_name: index for index, (column_name, _) in enumerate(UNIFIEDLOGS_COLUMNS)}
+TIME_UTC_INDEX = COLUMN_INDEXES['TimeUtc']
+
+
+def open_stream(path: str):
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def is_tsv(path: str) -> bool:
+    name = path[:-3] if path.lower().endswith('.gz') else path
+    return os.path.splitext(name)[1].lower() in ('.tsv', '.txt')
+
+
+def parse_ndjson_entry(log_entry: dict) -> list:
+    # Converts an entry of "log show --style ndjson" to a row of UNIFIEDLOGS_COLUMNS.
+    time_utc: str = log_entry.get('timestamp', '0000-00-00 00:00:00.000000+0000')
+    process_image_path: str = log_entry.get('processImagePath', '')
+    sender_image_path: str = log_entry.get('senderImagePath', '')
+    return [
+        '',
+        0,
+        '0',
+        time_utc.split('+')[0],
+        log_entry.get('threadID', 0),
+        log_entry.get('messageType', ''),
+        log_entry.get('activityIdentifier', 0),
+        log_entry.get('parentActivityIdentifier', 0),
+        log_entry.get('processID', 0),
+        0,
+        0,
+        process_image_path.split('/')[-1],
+        sender_image_path.split('/')[-1],
+        log_entry.get('subsystem', ''),
+        log_entry.get('category', ''),
+        '',
+        '',
+        0,
+        log_entry.get('senderImageUUID', ''),
+        log_entry.get('processImageUUID', ''),
+        sender_image_path,
+        process_image_path,
+        log_entry.get('eventMessage', ''),
+    ]
+
+
+def read_ndjson_rows(f):
+    for line in f:
+        if line.strip():
+            yield parse_ndjson_entry(json.loads(line))
+
+
+def read_tsv_rows(f):
+    # aul2madb writes RFC 3339 timestamps (2023-08-30T01:02:03.123456Z). They are converted to the format of mac_apt.
+    reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8', errors='replace', newline=''), delimiter='\t')
+    for row in reader:
+        if len(row) != len(UNIFIEDLOGS_COLUMNS) or row[TIME_UTC_INDEX] == 'TimeUTC':
+            continue
+        time_utc = row[TIME_UTC_INDEX]
+        if len(time_utc) > 10 and time_utc[10] == 'T':
+            row[TIME_UTC_INDEX] = time_utc[:10] + ' ' + time_utc[11:].rstrip('Z').split('+')[0]
+        yield row
+
+
+def compile_filters(filters) -> tuple[dict, list]:
+    # filters are dicts of column name and value pairs (PLUGIN_UNIFIEDLOGS_FILTERS).
+    # Single column filters are looked up in sets. Only the others are evaluated one by one.
+    single_column_filters = dict()
+    multi_column_filters = list()
+    for column_filter in filters:
+        pairs = tuple((COLUMN_INDEXES[column_name], value) for column_name, value in column_filter.items())
+        if len(pairs) == 1:
+            single_column_filters.setdefault(pairs[0][0], set()).add(pairs[0][1])
+        else:
+            multi_column_filters.append(pairs)
+    return single_column_filters, multi_column_filters
+
+
+def match_filters(row, compiled_filters: tuple[dict, list]) -> bool:
+    # True if the row matches one of the filters compiled by compile_filters().
+    single_column_filters, multi_column_filters = compiled_filters
+    return any(row[index] in values for index, values in single_column_filters.items()) or \
+        any(all(row[index] == value for index, value in pairs) for pairs in multi_column_filters)
+
+
+def read_unifiedlogs_stream(path: str, start_ts: str, end_ts: str, filters=None):
+    # Reads the whole file once and yields only the rows in the time window that match one of the filters.
+    # If filters is None, all rows in the time window are yielded.
+    compiled_filters = compile_filters(filters or ())
+    end_ts += '.999999'
+    read_rows = read_tsv_rows if is_tsv(path) else read_ndjson_rows
+    with open_stream(path) as f:
+        for row in read_rows(f):
+            if not (start_ts <= row[TIME_UTC_INDEX] <= end_ts):
+                continue
+            if filters is None or match_filters(row, compiled_filters):
+                yield row
+
+
+if __name__ == '__main__':
+    print('This file is part of forensic timeline generator "ma2tl". So, it cannot run separately.')
@@ -10,12 +10,15 @@
 
 import csv
 import datetime
+import gzip
+import io
+import json
 import logging
 import os
+import queue
 import sqlite3
-
-import pytz
-import xlsxwriter
+import sys
+import threading
 
 log = logging.getLogger('MA2TL.HELPERS.WRITER')
 
@@ -25,6 +28,8 @@ class TLEventWriter:
         self.output_path = output_params.output_path
         self.table_name = table_name
         self.tzinfo_user_str = timezone
+        self.tzinfo_user = None
+        self.tzinfo_utc = None
         self.use_sqlite = False
         self.sqlite_writer = None
         self.sqlite_db_path = os.path.join(self.output_path, base_name + '.db')
@@ -33,11 +38,15 @@ class TLEventWriter:
         self.xlsx_file_path = os.path.join(self.output_path, base_name + '.xlsx')
         self.use_tsv = False
         self.tsv_writer = None
-        self.tsv_file_path = os.path.join(self.output_path, base_name + '.tsv')
+        self.tsv_file_path = os.path.join(self.output_path, base_name + '.tsv' + TsvWriter.file_extensions[output_params.tsv_compression])
+        self.use_ndjson = False
+        self.ndjson_writer = None
+        self.ndjson_file_path = output_params.ndjson_path or os.path.join(self.output_path, base_name + '.ndjson')
+        self.event_callback = output_params.event_callback
 
         if output_params.use_sqlite:
             self.use_sqlite = True
-            self.sqlite_writer = SqliteWriter()
+            self.sqlite_writer = SqliteWriter(output_params.sqlite_page_size)
             self.sqlite_writer.open_db(self.sqlite_db_path)
         if output_params.use_xlsx:
             self.use_xlsx = True
@@ -45,10 +54,52 @@ class TLEventWriter:
             self.xlsx_writer.create_xlsx_file(self.xlsx_file_path)
         if output_params.use_tsv:
             self.use_tsv = True
-            self.tsv_writer = TsvWriter()
+            self.tsv_writer = TsvWriter(output_params.tsv_compression, output_params.tsv_buffer_size)
             self.tsv_writer.create_tsv_file(self.tsv_file_path)
+        if output_params.use_ndjson:
+            self.use_ndjson = True
+            self.ndjson_writer = NdjsonWriter()
+            self.ndjson_writer.open_ndjson_file(self.ndjson_file_path)
+
+        # Serialization to the output backends runs on a dedicated thread fed by a bounded queue,
+        # so that plugins can go on with their queries while the previous events are being written.
+        self.event_queue = queue.Queue(maxsize=output_params.writer_queue_size)
+        self.writer_error = None
+        self.writer_thread = threading.Thread(target=self._run_writer, name='TLEventWriterThread', daemon=True)
+        self.writer_thread.start()
+
+    def _run_writer(self):
+        while True:
+            item = self.event_queue.get()
+            if item is None:
+                self.event_queue.task_done()
+                break
+            if self.writer_error:
+                self.event_queue.task_done()
+                continue
+            func, data = item
+            try:
+                func(data)
+            except Exception as ex:
+                log.exception("An exception occurred in the writer thread")
+                self.writer_error = ex
+            self.event_queue.task_done()
+
+    def _enqueue(self, func, data):
+        if self.writer_error:
+            raise self.writer_error
+        self.event_queue.put((func, data))
+
+    def flush(self):
+        # Waits until the writer thread has written all the events passed so far.
+        self.event_queue.join()
+        if self.writer_error:
+            raise self.writer_error
 
     def write_data_header(self, header_list):
+        self._enqueue(self._write_data_header, list(header_list))
+
+    def _write_data_header(self, header_list):
         if self.use_sqlite:
             self.sqlite_writer.create_table(self.table_name, header_list)
         if self.use_xlsx:
@@ -56,20 +107,28 @@ class TLEventWriter:
             self.xlsx_writer.add_header_row(header_list)
         if self.use_tsv:
             self.tsv_writer.write_rows(header_list, header=True)
+        if self.use_ndjson:
+            self.ndjson_writer.set_keys(header_list)
 
     def _convert_ts_microsec_to_usertz(self, ts_with_microsecond):
         try:
             dt_naive = datetime.datetime.strptime(ts_with_microsecond, '%Y-%m-%d %H:%M:%S.%f')
         except ValueError as ex:
             dt_naive = datetime.datetime.strptime(ts_with_microsecond + '.000000', '%Y-%m-%d %H:%M:%S.%f')
-        tzinfo_utc = pytz.timezone('UTC')
-        dt_aware_utc = tzinfo_utc.localize(dt_naive)
-        return dt_aware_utc.astimezone(pytz.timezone(self.tzinfo_user_str)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        if self.tzinfo_user is None:
+            import pytz
+            self.tzinfo_user = pytz.timezone(self.tzinfo_user_str)
+            self.tzinfo_utc = pytz.timezone('UTC')
+        dt_aware_utc = self.tzinfo_utc.localize(dt_naive)
+        return dt_aware_utc.astimezone(self.tzinfo_user).strftime('%Y-%m-%d %H:%M:%S.%f')
 
     def write_data_rows(self, rows):
         if len(rows) == 0:
             return
 
+        self._enqueue(self._write_data_rows, rows)
+
+    def _write_data_rows(self, rows):
         # Insert user timezone timestamp.
         for row in rows:
             row.insert(1, self._convert_ts_microsec_to_usertz(row[0]))
@@ -80,30 +139,50 @@ class TLEventWriter:
             self.xlsx_writer.write_rows(rows)
         if self.use_tsv:
             self.tsv_writer.write_rows(rows)
+        if self.use_ndjson:
+            self.ndjson_writer.write_rows(rows)
+        if self.event_callback:
+            self.event_callback(rows)
 
     def close_writer(self):
+        if self.writer_thread:
+            self.event_queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+
         if self.use_sqlite:
             self.sqlite_writer.close_db()
         if self.use_xlsx:
             self.xlsx_writer.close_xlsx_file()
         if self.use_tsv:
             self.tsv_writer.close_tsv_file()
+        if self.use_ndjson:
+            self.ndjson_writer.close_ndjson_file()
 
 
 class SqliteWriter:
-    def __init__(self):
+    def __init__(self, page_size=0):
         self.db_path = ''
         self.conn = None
         self.cursor = None
         self.table_name = ''
         self.column_list = None
         self.sql_executemany = ''
+        self.page_size = page_size
+        self.index_columns = ('ActivityType', 'PluginName')
 
     def open_db(self, db_path):
         self.db_path = db_path
         try:
             if self.db_path and not os.path.exists(self.db_path):
-                self.conn = sqlite3.connect(self.db_path)
+                # The connection is used by the writer thread of TLEventWriter.
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                # Bulk-load settings. The whole run is written in one transaction without a rollback journal.
+                # The output DB is created from scratch on every run, so it is simply regenerated after a crash.
+                if self.page_size:
+                    self.conn.execute(f"PRAGMA page_size={int(self.page_size)}")
+                self.conn.execute("PRAGMA journal_mode=OFF")
+                self.conn.execute("PRAGMA synchronous=OFF")
                 return True
             else:
                 log.error(f"Specified SQLite files has been existed: {self.db_path}")
@@ -116,9 +195,28 @@ class SqliteWriter:
 
     def close_db(self):
         if self.conn:
+            self._finish_load()
             self.conn.close()
             self.conn = None
 
+    def _finish_load(self):
+        # Indexes are built once after the load, which is much cheaper than maintaining them on every insert.
+        try:
+            if self.table_name:
+                for column_name in (self.column_list[0],) + self.index_columns:
+                    if column_name in self.column_list:
+                        index_name = 'idx_' + self.table_name + '_' + ''.join(c if c.isalnum() else '_' for c in column_name)
+                        self.cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{self.table_name}" ("{column_name}")')
+                self.conn.commit()
+                self.conn.execute("ANALYZE")
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+            self.conn.execute("PRAGMA synchronous=FULL")
+
+        except sqlite3.Error as ex:
+            log.error(f"Error creating indexes on SQLite table: {self.table_name}")
+            log.exception(f"Error details: {str(ex)}")
+            raise ex
+
     def _build_create_table_query(self):
         sql = 'CREATE TABLE "' + self.table_name + '" ('
         for column_name in self.column_list:
@@ -145,8 +243,8 @@ class SqliteWriter:
 
     def write_rows(self, rows):
         try:
+            # Committed once in close_db().
             self.cursor.executemany(self.sql_executemany, rows)
-            self.conn.commit()
             return True
 
         except sqlite3.Error as ex:
@@ -157,42 +255,53 @@ class SqliteWriter:
 
 class XlsxWriter:
     def __init__(self):
+        import xlsxwriter  # imported only when XLSX output is selected
+        self.xlsxwriter = xlsxwriter
         self.file_path = ''
         self.workbook = None
         self.sheet = None
         self.max_allowed_rows = 1000000
         self.row_index = 0
         self.sheet_name = ''
+        self.base_sheet_name = ''
+        self.sheets = []  # list of [sheet_name, max_row_index]
+        self.header_list = None
+        self.header_format = None
         self.max_row_index = 0
         self.max_col_index = 0
         self.col_width_list = None
+        self.col_width_sample_rows = 1000
+        self.sampled_rows = 0
 
     def create_xlsx_file(self, file_path):
         self.file_path = file_path
         try:
-            self.workbook = xlsxwriter.Workbook(self.file_path, {'strings_to_urls': False, 'constant_memory': True})
-        except (xlsxwriter.exceptions.XlsxWriterException, OSError) as ex:
+            self.workbook = self.xlsxwriter.Workbook(self.file_path, {'strings_to_urls': False, 'constant_memory': True})
+        except (self.xlsxwriter.exceptions.XlsxWriterException, OSError) as ex:
             log.error(f"Failed to create xlsx file at path {self.file_path}")
             log.exception(f"Error details: {str(ex)}")
             raise ex
 
     def _beautify_columns(self):
-        sheet = self.workbook.get_worksheet_by_name(self.sheet_name)
-        sheet.freeze_panes(1, 0)  # Freeze 1st row
-        # Set column widths
-        col_index = 0
-        for col_width in self.col_width_list:
-            if col_index == 0 or col_index == 1:
-                col_width = 25
-            if col_width > 100:
-                col_width = 100
-            sheet.set_column(col_index, col_index, col_width)
-            col_index += 1
-        # Autofilter
-        sheet.autofilter(0, 0, self.max_row_index, self.max_col_index)
+        self.sheets[-1][1] = self.max_row_index
+        for sheet_name, max_row_index in self.sheets:
+            sheet = self.workbook.get_worksheet_by_name(sheet_name)
+            sheet.freeze_panes(1, 0)  # Freeze 1st row
+            # Set column widths
+            col_index = 0
+            for col_width in self.col_width_list:
+                if col_index == 0 or col_index == 1:
+                    col_width = 25
+                if col_width > 100:
+                    col_width = 100
+                sheet.set_column(col_index, col_index, col_width)
+                col_index += 1
+            # Autofilter
+            sheet.autofilter(0, 0, max_row_index, self.max_col_index)
 
     def close_xlsx_file(self):
-        self._beautify_columns()
+        if self.sheets:
+            self._beautify_columns()
         if self.workbook:
             self.workbook.close()
             self.workbook = None
@@ -204,22 +313,37 @@ class XlsxWriter:
             sheet_name = sheet_name[0:31]
         try:
             self.sheet = self.workbook.add_worksheet(sheet_name)
-        except xlsxwriter.exceptions.XlsxWriterException as ex:
+        except self.xlsxwriter.exceptions.XlsxWriterException as ex:
             log.exception(f"Unknown error while adding sheet {sheet_name}")
             raise ex
         self.row_index = 0
         self.sheet_name = sheet_name
-
-    def add_header_row(self, header_list):
+        if not self.base_sheet_name:
+            self.base_sheet_name = sheet_name
+        if self.sheets:
+            self.sheets[-1][1] = self.max_row_index
+        self.sheets.append([sheet_name, 0])
+
+    def _add_overflow_sheet(self):
+        # Excel sheets are limited to 1,048,576 rows. Overflowing rows continue on "<sheet name>_2", "<sheet name>_3", ...
+        suffix = f"_{len(self.sheets) + 1}"
+        self.create_sheet(self.base_sheet_name[0:31 - len(suffix)] + suffix)
+        self._write_header_row()
+        log.info(f"Sheet {self.sheets[-2][0]} reached {self.max_allowed_rows} rows. Continuing on sheet {self.sheet_name}")
+
+    def _write_header_row(self):
         column_index = 0
-        for column_name in header_list:
-            column_width = 8.43
-            self.sheet.write_string(self.row_index, column_index, column_name, self.workbook.add_format({'bold': True}))
-            self.sheet.set_column(column_index, column_index, column_width)
+        for column_name in self.header_list:
+            self.sheet.write_string(self.row_index, column_index, column_name, self.header_format)
             column_index += 1
         self.row_index += 1
-        self.max_col_index = column_index - 1
         self.max_row_index = self.row_index - 1
+
+    def add_header_row(self, header_list):
+        self.header_list = list(header_list)
+        self.header_format = self.workbook.add_format({'bold': True})
+        self._write_header_row()
+        self.max_col_index = len(self.header_list) - 1
         self.col_width_list = [len(col_name)+3 for col_name in header_list]
 
     def _store_column_width(self, row):
@@ -233,22 +357,23 @@ class XlsxWriter:
     def _write_row(self, row):
         column_index = 0
         if self.row_index > self.max_allowed_rows:
-            log.exception("Error trying to add sheet for overflow data (>1 million rows)")
-            raise xlsxwriter.exceptions.XlsxWriterException
+            self._add_overflow_sheet()
 
         try:
-            row_str = tuple(map(str, row))
-            for item in row_str:
+            for item in row:
                 try:
-                    self.sheet.write(self.row_index, column_index, item)
-                except (TypeError, ValueError, xlsxwriter.exceptions.XlsxWriterException):
-                    log.exception(f"Error writing data:{item} of type:{type(row[column_index])} in excel row:{self.row_index}")
+                    self.sheet.write_string(self.row_index, column_index, item if type(item) is str else str(item))
+                except (TypeError, ValueError, self.xlsxwriter.exceptions.XlsxWriterException):
+                    log.exception(f"Error writing data:{item} of type:{type(item)} in excel row:{self.row_index}")
                 column_index += 1
 
             self.row_index += 1
             self.max_row_index = self.row_index - 1
-            self._store_column_width(row_str)
-        except xlsxwriter.exceptions.XlsxWriterException as ex:
+            # Column widths are estimated from the first rows only.
+            if self.sampled_rows < self.col_width_sample_rows:
+                self._store_column_width(tuple(map(str, row)))
+                self.sampled_rows += 1
+        except self.xlsxwriter.exceptions.XlsxWriterException as ex:
             log.exception(f"Error writing excel row {self.row_index}")
 
     def write_rows(self, rows):
@@ -256,23 +381,93 @@ class XlsxWriter:
             self._write_row(row)
 
 
+# Writes (and optionally compresses) data chunks to a file on a dedicated thread.
+class BackgroundFileWriter:
+    def __init__(self, file_path, compression='', max_queued_chunks=4):
+        self.file_path = file_path
+        self.compression = compression
+        self.file_handle = None
+        self.compressor = None
+        self.chunk_queue = queue.Queue(maxsize=max_queued_chunks)
+        self.thread = None
+        self.error = None
+
+    def open(self):
+        self.file_handle = open(self.file_path, 'wb')
+        if self.compression == 'gzip':
+            self.compressor = gzip.GzipFile(filename=os.path.basename(self.file_path)[:-3], mode='wb', fileobj=self.file_handle)
+        elif self.compression == 'zstd':
+            import zstandard  # optional dependency, only needed for zstd output
+            self.compressor = zstandard.ZstdCompressor(threads=-1).stream_writer(self.file_handle, closefd=False)
+        self.thread = threading.Thread(target=self._run, name='TsvWriterThread', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        out = self.compressor if self.compressor else self.file_handle
+        while True:
+            chunk = self.chunk_queue.get()
+            if chunk is None:
+                break
+            if self.error:
+                continue
+            try:
+                out.write(chunk)
+            except Exception as ex:
+                self.error = ex
+
+    def write(self, chunk):
+        if self.error:
+            raise self.error
+        self.chunk_queue.put(chunk)
+
+    def close(self):
+        if self.thread:
+            self.chunk_queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.compressor:
+            self.compressor.close()
+            self.compressor = None
+        if self.file_handle:
+            self.file_handle.close()
+            self.file_handle = None
+        if self.error:
+            raise self.error
+
+
 class TsvWriter:
-    def __init__(self):
+    file_extensions = {'': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, compression='', buffer_size=16 * 1024 * 1024):
         self.file_path = ''
         self.file_handle = None
         self.tsv_writer = None
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.buffer = None
 
     def create_tsv_file(self, file_path):
+        # Rows are formatted into an in-memory buffer. Full buffers are handed to a background thread
+        # that compresses and writes them, so that compression overlaps with extraction.
+        self.file_path = file_path
         try:
-            self.file_handle = open(file_path, 'wt', encoding='UTF-8', newline='')
-            self.tsv_writer = csv.writer(self.file_handle, delimiter='\t')
-        except (OSError, csv.Error) as ex:
+            self.file_handle = BackgroundFileWriter(self.file_path, self.compression)
+            self.file_handle.open()
+            self.buffer = io.StringIO(newline='')
+            self.tsv_writer = csv.writer(self.buffer, delimiter='\t')
+        except (OSError, ImportError, csv.Error) as ex:
             log.error(f"Failed to create file at path {self.file_path}")
             log.exception(f"Error details: {str(ex)}")
             raise ex
 
+    def _flush_buffer(self):
+        self.file_handle.write(self.buffer.getvalue().encode('UTF-8'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
     def close_tsv_file(self):
         if self.tsv_writer:
+            self._flush_buffer()
             self.file_handle.close()
             self.tsv_writer = None
             self.file_path = ''
@@ -282,6 +477,44 @@ class TsvWriter:
             self.tsv_writer.writerow(rows)
         else:
             self.tsv_writer.writerows(rows)
+        if self.buffer.tell() >= self.buffer_size:
+            self._flush_buffer()
+
+
+class NdjsonWriter:
+    def __init__(self):
+        self.file_path = ''
+        self.file_handle = None
+        self.keys = None
+
+    def open_ndjson_file(self, file_path):
+        # "-" streams events to stdout. Any other path (a regular file or a FIFO) is opened for writing.
+        self.file_path = file_path
+        try:
+            if self.file_path == '-':
+                self.file_handle = sys.stdout
+            else:
+                self.file_handle = open(self.file_path, 'wt', encoding='UTF-8', newline='\n')
+        except OSError as ex:
+            log.error(f"Failed to open file at path {self.file_path}")
+            log.exception(f"Error details: {str(ex)}")
+            raise ex
+
+    def close_ndjson_file(self):
+        if self.file_handle:
+            self.file_handle.flush()
+            if self.file_handle is not sys.stdout:
+                self.file_handle.close()
+            self.file_handle = None
+            self.file_path = ''
+
+    def set_keys(self, header_list):
+        self.keys = list(header_list)
+
+    def write_rows(self, rows):
+        # Flush every batch so that a downstream consumer can ingest events while extraction is still running.
+        self.file_handle.writelines(json.dumps(dict(zip(self.keys, row)), ensure_ascii=False) + '\n' for row in rows)
+        self.file_handle.flush()
 
 
 if __name__ == '__main__':
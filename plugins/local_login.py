@@ -11,7 +11,7 @@ import logging
 import os
 import re
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
 PLUGIN_DESCRIPTION = "Extract local login activities."
@@ -19,6 +19,11 @@ PLUGIN_ACTIVITY_TYPE = "Local Login"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('UNIFIED_LOGS',)
+
+PLUGIN_UNIFIEDLOGS_FILTERS = {
+    'extract_local_authentication': ({'ProcessName': 'loginwindow'},),
+}
 
 log = None
 
@@ -29,18 +34,13 @@ def extract_local_authentication(basic_info: BasicInfo, timeline_events: list) -
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "loginwindow" AND \
-                Message LIKE "-[SessionAgentNotificationCenter %" AND \
-                Message LIKE "%sendDistributedNotification%" AND \
-                NOT (\
-                    Message LIKE "%com.apple.system.sessionagent.sessionstatechanged%" OR \
-                    Message LIKE "%com.apple.system.loginwindow.likely%"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'loginwindow'},
+                       prefixes={'Message': ('-[SessionAgentNotificationCenter ',)},
+                       contains={'Message': ('sendDistributedNotification',)},
+                       excludes={'Message': ('com.apple.system.sessionagent.sessionstatechanged', 'com.apple.system.loginwindow.likely')},
+                       order_by='TimeUtc')
     regex = r'^-\[SessionAgentNotificationCenter .+ \| .+: (?P<notified_action>.+), with userID:(?P<uid>\d+)'
     actions = {
         'sessionDidLogin': 'Logged in',
@@ -56,7 +56,7 @@ def extract_local_authentication(basic_info: BasicInfo, timeline_events: list) -
     }
 
     state = ""
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         if result := re.match(regex, row['Message']):
             for action in actions.keys():
                 msg = ""
@@ -85,7 +85,7 @@ def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
     timeline_events = []
-    extract_local_authentication(basic_info, timeline_events)
+    basic_info.run_extractor(extract_local_authentication, timeline_events)
 
     log.info(f"Detected {len(timeline_events)} events.")
     if len(timeline_events) > 0:
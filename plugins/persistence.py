@@ -11,7 +11,7 @@ import datetime
 import logging
 import os
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 from plugins.helpers.common import convert_apfs_time
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
@@ -20,6 +20,7 @@ PLUGIN_ACTIVITY_TYPE = "Persistence"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('MACAPT_DB', 'APFS_VOLUMES')
 
 log = None
 
@@ -71,24 +72,36 @@ def _check_between_ts(check_ts, start_ts, end_ts):
         return False
 
 
+def _select_combined_inode(basic_info: BasicInfo, path):
+    # Same as Combined_Paths LEFT JOIN Combined_Inodes ON CNID for the first row of the path
+    select = basic_info.mac_apt_dbs.select
+    query_path = TableQuery('Combined_Paths', columns=('CNID',), equals={'Path': path}, limit=1)
+    for row_path in select(MacAptDBType.APFS_VOLUMES, query_path):
+        query_inode = TableQuery('Combined_Inodes', columns=('CNID', 'Created'), equals={'CNID': row_path['CNID']}, limit=1)
+        for row_inode in select(MacAptDBType.APFS_VOLUMES, query_inode):
+            yield row_inode
+            return
+        yield {'CNID': row_path['CNID'], 'Created': None}
+
+
 def extract_autostart(basic_info: BasicInfo, timeline_events: list) -> bool:
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.MACAPT_DB | MacAptDBType.APFS_VOLUMES):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
+    select = basic_info.mac_apt_dbs.select
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql_users = 'SELECT Username, UID FROM Users;'
-    sql = 'SELECT * FROM AutoStart WHERE AppPath != "";'
-    sql_combined = 'SELECT * FROM Combined_Paths LEFT JOIN Combined_Inodes \
-                    ON Combined_Paths.CNID = Combined_Inodes.CNID \
-                    WHERE Combined_Paths.Path = "{}" LIMIT 1;'
+    query_users = TableQuery('Users', columns=('Username', 'UID'))
+    query = TableQuery('AutoStart', columns=('Source', 'AppPath'))
 
     users = {}
-    for row in run_query(MacAptDBType.MACAPT_DB, sql_users):
+    for row in select(MacAptDBType.MACAPT_DB, query_users):
         users[row['Username']] = int(row['UID'])
 
     persistence_entries = []
-    for row in basic_info.mac_apt_dbs.run_query(MacAptDBType.MACAPT_DB, sql):
+    for row in select(MacAptDBType.MACAPT_DB, query):
+        if not row['AppPath']:
+            continue
+
         skip_flag = False
         for apppath_prefix in std_apppath_system_vol:
             if row['AppPath'].startswith(apppath_prefix):
@@ -119,7 +132,7 @@ def extract_autostart(basic_info: BasicInfo, timeline_events: list) -> bool:
         ts_app_create_utc = ''
         msg = ''
         event_persistence_app = None
-        for row in run_query(MacAptDBType.APFS_VOLUMES, sql_combined.format(persistence_app)):
+        for row in _select_combined_inode(basic_info, persistence_app):
             ts_app_create_utc = convert_apfs_time(row['Created']).strftime('%Y-%m-%d %H:%M:%S.%f')
             msg = persistence_app
             if non_std_apppath:
@@ -129,7 +142,7 @@ def extract_autostart(basic_info: BasicInfo, timeline_events: list) -> bool:
         ts_file_create_utc = ''
         msg = ''
         event_persistence_file = None
-        for row in run_query(MacAptDBType.APFS_VOLUMES, sql_combined.format(persistence_file)):
+        for row in _select_combined_inode(basic_info, persistence_file):
             ts_file_create_utc = convert_apfs_time(row['Created']).strftime('%Y-%m-%d %H:%M:%S.%f')
             msg = f"{persistence_file} (AppPath: {persistence_app})"
             if non_std_apppath:
@@ -148,7 +161,7 @@ def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
     timeline_events = []
-    extract_autostart(basic_info, timeline_events)
+    basic_info.run_extractor(extract_autostart, timeline_events)
 
     log.info(f"Detected {len(timeline_events)} events.")
     if len(timeline_events) > 0:
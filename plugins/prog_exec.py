@@ -8,13 +8,15 @@
 from __future__ import annotations
 
 import datetime
+import heapq
 import json
 import logging
 import os
 import re
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 from plugins.helpers.common import get_timedelta
+from plugins.helpers.memory import SpillableRecords
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
 PLUGIN_DESCRIPTION = "Extract program execution activities."
@@ -22,6 +24,20 @@ PLUGIN_ACTIVITY_TYPE = "Program Execution"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('MACAPT_DB', 'UNIFIED_LOGS')
+
+PLUGIN_UNIFIEDLOGS_FILTERS = {
+    'extract_program_exec_logs_launch': ({'SenderName': 'LaunchServices'}, {'ProcessName': 'lsd'}),
+    'extract_program_exec_logs_tempsign': ({'Category': 'gk'},),
+    'extract_program_exec_logs_adhoc': ({'ProcessName': 'kernel'}, {'ProcessName': 'amfid'}),
+    'extract_program_exec_logs_resolved_pid': ({'Category': 'process'},),
+    'extract_program_exec_logs_sec_pol_not_allow': ({'ProcessName': 'kernel', 'SenderName': 'AppleSystemPolicy'},),
+    'extract_program_exec_logs_sudo': ({'ProcessName': 'sudo'},),
+    'extract_program_exec_logs_tccd': ({'ProcessName': 'tccd'},),
+    'extract_program_exec_logs_sandbox_violation': (
+        {'ProcessName': 'sandboxd', 'Subsystem': 'com.apple.sandbox.reporting', 'Category': 'violation'},
+    ),
+}
 
 log = None
 ignore_processes = ('activateSettings', 'QuickLookUIService', 'com.apple.dock.extra')
@@ -217,11 +233,11 @@ def extract_program_exec_spotlightshortcuts(basic_info: BasicInfo, timeline_even
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.MACAPT_DB):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM SpotlightShortcuts WHERE LastUsed BETWEEN "{start_ts}" AND "{end_ts}" ORDER BY LastUsed;'
+    query = TableQuery('SpotlightShortcuts', columns=('LastUsed', 'UserTyped', 'DisplayName', 'URL'),
+                       time_column='LastUsed', start_ts=start_ts, end_ts=end_ts, order_by='LastUsed')
 
-    for row in run_query(MacAptDBType.MACAPT_DB, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.MACAPT_DB, query):
         ts = row['LastUsed']
         user_typed = row['UserTyped']
         display_name = row['DisplayName']
@@ -239,14 +255,12 @@ def extract_program_exec_logs_launch(basic_info: BasicInfo, timeline_events: lis
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
+    select = basic_info.mac_apt_dbs.select
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (SenderName == "LaunchServices" AND (Message LIKE "LAUNCHING:0x%" OR Message LIKE "LAUNCH: 0x%")) \
-            ORDER BY TimeUtc;'
-    sql_null = 'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{}" AND "{}" AND \
-            ProcessName = "lsd" AND Message LIKE "Non-fatal error enumerating %" \
-            ORDER BY TimeUtc DESC LIMIT 1;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message', 'ProcessImagePath'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'SenderName': 'LaunchServices'},
+                       prefixes={'Message': ('LAUNCHING:0x', 'LAUNCH: 0x')},
+                       order_by='TimeUtc')
 
     # macOS 10.15.7    : ^LAUNCHING:0x.+ (.+) foreground=(\d) bringForward=(\d) .+
     # macOS 11+        : ^LAUNCH: 0x.+ (.+) starting stopped process.
@@ -254,7 +268,7 @@ def extract_program_exec_logs_launch(basic_info: BasicInfo, timeline_events: lis
     # macOS 11+ (Info) : LAUNCH: 0x0-0xa00a0 com.ridiculousfish.HexFiend launched with launchInQuarantine == true, so not starting the application.
     regex = r'^(LAUNCHING:|LAUNCH: )0x.+-0x.+ (.+) (foreground=\d bringForward=\d|starting stopped process|launched with )'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in select(MacAptDBType.UNIFIED_LOGS, query):
         result = re.match(regex, row['Message'])
         if result:
             if result.group(2) not in ignore_processes:
@@ -267,7 +281,11 @@ def extract_program_exec_logs_launch(basic_info: BasicInfo, timeline_events: lis
             if app_name == '(null)':
                 regex_null = r'^Non-fatal error enumerating .+ file://(.+)/Contents/, .+'
                 delta_ts = (datetime.datetime.strptime(row['TimeUtc'], '%Y-%m-%d %H:%M:%S.%f') - datetime.timedelta(microseconds=100000)).strftime('%Y-%m-%d %H:%M:%S.%f')
-                for row_null in run_query(MacAptDBType.UNIFIED_LOGS, sql_null.format(delta_ts, row['TimeUtc'])):
+                query_null = TableQuery('UnifiedLogs', columns=('Message',), time_column='TimeUtc', start_ts=delta_ts, end_ts=row['TimeUtc'],
+                                        equals={'ProcessName': 'lsd'},
+                                        prefixes={'Message': ('Non-fatal error enumerating ',)},
+                                        order_by='TimeUtc', descending=True, limit=1)
+                for row_null in select(MacAptDBType.UNIFIED_LOGS, query_null):
                     result_null = re.match(regex_null, row_null['Message'])
                     if result_null:
                         app_name = result_null.group(1)
@@ -287,14 +305,14 @@ def extract_program_exec_logs_tempsign(basic_info: BasicInfo, timeline_events: l
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (Category == "gk" AND Message LIKE "temporarySigning %") \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'Category': 'gk'},
+                       prefixes={'Message': ('temporarySigning ',)},
+                       order_by='TimeUtc')
     regex = r'^temporarySigning .+ path=(.+)'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         result = re.match(regex, row['Message'])
         if result:
             if result.group(1) not in ignore_processes:
@@ -314,20 +332,23 @@ def extract_program_exec_logs_adhoc(basic_info: BasicInfo, timeline_events: list
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
+    select = basic_info.mac_apt_dbs.select
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    # sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-    #     (ProcessName = "kernel" AND Message LIKE "AMFI: % is %") OR (ProcessName = "amfid" and Message LIKE "% signature %") \
-    #     ORDER BY TimeUtc;'
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-        (ProcessName = "kernel" AND Message LIKE "AMFI: % is %") OR (ProcessName = "amfid" and Message LIKE "% not valid: %") \
-        ORDER BY TimeUtc;'
+    # query_amfid = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+    #                          equals={'ProcessName': 'amfid'}, contains={'Message': (' signature ',)}, order_by='TimeUtc')
+    query_kernel = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                              equals={'ProcessName': 'kernel'}, prefixes={'Message': ('AMFI: ',)}, order_by='TimeUtc')
+    query_amfid = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                             equals={'ProcessName': 'amfid'}, contains={'Message': (' not valid: ',)}, order_by='TimeUtc')
     regex_kernel = r'^AMFI: \'(.+)\' is (.+)'
     # regex_amfid = r'^(/.+) (signature .+): .+'
     regex_amfid = r'^(/.+) not valid: .+'
     prog_exec_events: list[ProgExecEvent] = []
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    # The kernel logs come first at the same time, so that the amfid logs are paired with them.
+    rows = heapq.merge(select(MacAptDBType.UNIFIED_LOGS, query_kernel), select(MacAptDBType.UNIFIED_LOGS, query_amfid),
+                       key=lambda row: row['TimeUtc'])
+    for row in rows:
         row_msg = row['Message'].strip()
         log.debug(f"REGEX: {regex_kernel} , ROW: {row_msg}")
         result = re.match(regex_kernel, row_msg)
@@ -376,14 +397,15 @@ def extract_program_exec_logs_resolved_pid(basic_info: BasicInfo, timeline_event
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (Category == "process" AND Message LIKE "Resolved pid %" AND Message LIKE "%[executable<%") \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'Category': 'process'},
+                       prefixes={'Message': ('Resolved pid ',)},
+                       contains={'Message': ('[executable<',)},
+                       order_by='TimeUtc')
     regex_executable = r'^Resolved pid (\d+) to \[executable<(.+)\(\d+\)>:\d+\]'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         result = re.match(regex_executable, row['Message'])
         if result and result.group(2) not in ignore_processes:
             event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, f"{result.group(2)}, PID={result.group(1)}", PLUGIN_NAME]
@@ -398,15 +420,14 @@ def extract_program_exec_logs_sec_pol_not_allow(basic_info: BasicInfo, timeline_
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            ProcessName = "kernel" AND SenderName = "AppleSystemPolicy" AND \
-            Message LIKE "Security policy would not allow process:%" \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'kernel', 'SenderName': 'AppleSystemPolicy'},
+                       prefixes={'Message': ('Security policy would not allow process:',)},
+                       order_by='TimeUtc')
     regex_sec_pol_not_allow = r'.*Security policy would not allow process: \d+, (.+)'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         result = re.match(regex_sec_pol_not_allow, row['Message'])
         if result:
             event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, f"{result.group(1)} would not allow to execute", PLUGIN_NAME]
@@ -421,15 +442,15 @@ def extract_program_exec_logs_sudo(basic_info: BasicInfo, timeline_events: list)
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "sudo" AND Message LIKE "%COMMAND=%") \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'sudo'},
+                       contains={'Message': ('COMMAND=',)},
+                       order_by='TimeUtc')
     regex_sudo_succeeded = r'^(?P<exec_user>.+) : TTY=(?P<tty>.+) ; PWD=(?P<pwd>.+) ; USER=(?P<user>.+) ; COMMAND=(?P<command>.+)'
     regex_sudo_failed = r'^(?P<exed_user>.+) : (?P<attempts>\d+) incorrect password attempts ; TTY=(?P<tty>.+) ; PWD=(?P<pwd>.+) ; USER=(?P<user>.+) ; COMMAND=(?P<command>.+)'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         if result := re.match(regex_sudo_succeeded, row['Message']):
             msg = f"{result['exec_user']} executed {result['command']} as {result['user']} on {result['pwd']} ({result['tty']})"
             event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, msg, PLUGIN_NAME]
@@ -443,74 +464,71 @@ def extract_program_exec_logs_sudo(basic_info: BasicInfo, timeline_events: list)
     return True
 
 
+# Fills attribution_dict of a TCC authreq event. Returns False if the event is caused by an ignored process.
+def parse_tcc_attribution(tcc_event: TccAuthreqEvent) -> bool:
+    ignored = False
+    for attr in tcc_event.attribution.split("}, "):
+        attr_items = attr.split("={")
+        if len(attr_items) == 2:
+            attr_name = attr_items[0]
+            attr_items[1] = attr_items[1][len("TCCDProcess: "):]
+            element_dict = dict()
+            for elements in attr_items[1].split(", "):
+                element_name, element_value = elements.split("=")
+                element_dict[element_name] = element_value
+                if attr_name in ("responsible", "accessing", "requesting") and element_name == "binary_path":
+                    if element_value in ignore_tccd_processes or \
+                       element_value.startswith('/Library/Apple/System/Library/CoreServices/XProtect.app/Contents/MacOS/XProtectRemediator'):
+                    # if element_value in ignore_tccd_processes:
+                        ignored = True
+
+            tcc_event.attribution_dict[attr_name] = element_dict
+
+    return not ignored
+
+
 # Extract tccd's AUTHREQ_* logs
 # This function is confirmed to work correctly for macOS 13+
 def extract_program_exec_logs_tccd(basic_info: BasicInfo, timeline_events: list) -> bool:
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "tccd" AND \
-                (Message LIKE "AUTHREQ_CTX: %" OR \
-                Message LIKE "AUTHREQ_ATTRIBUTION: %" OR \
-                Message LIKE "AUTHREQ_RESULT: %" OR \
-                Message LIKE "AUTHREQ_PROMPTING: %"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'tccd'},
+                       prefixes={'Message': (
+                           'AUTHREQ_CTX: ',
+                           'AUTHREQ_ATTRIBUTION: ',
+                           'AUTHREQ_RESULT: ',
+                           'AUTHREQ_PROMPTING: '
+                       )},
+                       order_by='TimeUtc')
     regex_ctx = r'^AUTHREQ_CTX: msgID=(?P<msg_id>[\d\.]+), function=.+, service=(?P<service>.+?), .+'
     regex_attrib = r'^AUTHREQ_ATTRIBUTION: msgID=(?P<msg_id>[\d\.]+), attribution={(?P<attribution>.+)},'
     regex_result = r'^AUTHREQ_RESULT: msgID=(?P<msg_id>[\d\.]+), authValue=(?P<auth_value>\d+), authReason=(?P<auth_reason>\d+), authVersion=(?P<auth_version>\d+), error=.+'
 
-    tcc_authreq_events: dict[str, TccAuthreqEvent] = dict()
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
-        if result := re.match(regex_ctx, row['Message']):
-            if result['msg_id'] in tcc_authreq_events.keys():
-                tcc_authreq_events[result['msg_id']].msg_id = result['msg_id']
-                tcc_authreq_events[result['msg_id']].service = result['service']
-            else:
-                tcc_authreq_events[result['msg_id']] = TccAuthreqEvent(timeutc=row['TimeUtc'], msg_id=result['msg_id'], service=result['service'])
-
-        elif result := re.match(regex_attrib, row['Message']):
-            if result['msg_id'] in tcc_authreq_events.keys():
-                tcc_authreq_events[result['msg_id']].attribution = result['attribution']
-            else:
-                tcc_authreq_events[result['msg_id']] = TccAuthreqEvent(timeutc=row['TimeUtc'], msg_id=result['msg_id'], attribution=result['attribution'])
+    # Kept in a temporary DB when the memory usage reaches --memory_budget, because a noisy Mac logs a lot of AUTHREQ_*.
+    tcc_authreq_events = SpillableRecords(basic_info.memory_monitor, {'timeutc': '', 'service': '', 'attribution': '',
+                                                                      'auth_value': 0, 'auth_reason': 0, 'auth_version': 0})
+    try:
+        for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
+            if result := re.match(regex_ctx, row['Message']):
+                tcc_authreq_events.set(result['msg_id'], {'service': result['service']}, {'timeutc': row['TimeUtc']})
+
+            elif result := re.match(regex_attrib, row['Message']):
+                tcc_authreq_events.set(result['msg_id'], {'attribution': result['attribution']}, {'timeutc': row['TimeUtc']})
+
+            elif result := re.match(regex_result, row['Message']):
+                tcc_authreq_events.set(result['msg_id'], {'auth_value': int(result['auth_value']),
+                                                          'auth_reason': int(result['auth_reason']),
+                                                          'auth_version': int(result['auth_version'])},
+                                       {'timeutc': row['TimeUtc']})
+
+        for msg_id, record in tcc_authreq_events.items():
+            tcc_event = TccAuthreqEvent(msg_id=msg_id, **record)
+            if not parse_tcc_attribution(tcc_event):
+                continue
 
-        elif result := re.match(regex_result, row['Message']):
-            if result['msg_id'] in tcc_authreq_events.keys():
-                tcc_authreq_events[result['msg_id']].auth_value = int(result['auth_value'])
-                tcc_authreq_events[result['msg_id']].auth_reason = int(result['auth_reason'])
-                tcc_authreq_events[result['msg_id']].auth_version = int(result['auth_version'])
-            else:
-                tcc_authreq_events[result['msg_id']] = TccAuthreqEvent(timeutc=row['TimeUtc'], msg_id=result['msg_id'],
-                                                                       auth_value=int(result['auth_value']),
-                                                                       auth_reason=int(result['auth_reason']),
-                                                                       auth_version=int(result['auth_version']))
-
-    ignore_events = list()
-    for msg_id, event in tcc_authreq_events.items():
-        for attr in event.attribution.split("}, "):
-            attr_items = attr.split("={")
-            if len(attr_items) == 2:
-                attr_name = attr_items[0]
-                attr_items[1] = attr_items[1][len("TCCDProcess: "):]
-                element_dict = dict()
-                for elements in attr_items[1].split(", "):
-                    element_name, element_value = elements.split("=")
-                    element_dict[element_name] = element_value
-                    if attr_name in ("responsible", "accessing", "requesting") and element_name == "binary_path":
-                        if element_value in ignore_tccd_processes or \
-                           element_value.startswith('/Library/Apple/System/Library/CoreServices/XProtect.app/Contents/MacOS/XProtectRemediator'):
-                        # if element_value in ignore_tccd_processes:
-                            ignore_events.append(msg_id)
-
-                event.attribution_dict[attr_name] = element_dict
-
-    for msg_id, tcc_event in tcc_authreq_events.items():
-        if msg_id not in ignore_events:
             msg = "TCC authreq: "
             if tcc_event.attribution_dict.get('accessing'):
                 if msg == "TCC authreq: ":
@@ -534,6 +552,8 @@ def extract_program_exec_logs_tccd(basic_info: BasicInfo, timeline_events: list)
                 msg += f"Result: authValue={tcc_event.get_auth_value()}({tcc_event.auth_value}), authReason={tcc_event.get_auth_reason()}({tcc_event.auth_reason}), authVersion={tcc_event.auth_version}"
                 event = [tcc_event.timeutc, PLUGIN_ACTIVITY_TYPE, msg, PLUGIN_NAME]
                 timeline_events.append(event)
+    finally:
+        tcc_authreq_events.close()
 
     return True
 
@@ -544,14 +564,13 @@ def extract_program_exec_logs_sandbox_violation(basic_info: BasicInfo, timeline_
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "sandboxd" AND Subsystem == "com.apple.sandbox.reporting" AND Category == "violation") \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'sandboxd', 'Subsystem': 'com.apple.sandbox.reporting', 'Category': 'violation'},
+                       order_by='TimeUtc')
     regex_metadata = r'^MetaData: (?P<metadata>.+)'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         for msg_line in row['Message'].splitlines():
             if result := re.match(regex_metadata, msg_line):
                 data = json.loads(result['metadata'])
@@ -566,23 +585,29 @@ def extract_program_exec_logs_sandbox_violation(basic_info: BasicInfo, timeline_
 def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
-    timeline_events = []
-    extract_program_exec_spotlightshortcuts(basic_info, timeline_events)
-    extract_program_exec_logs_launch(basic_info, timeline_events)
-    extract_program_exec_logs_tempsign(basic_info, timeline_events)
-    extract_program_exec_logs_adhoc(basic_info, timeline_events)
-    extract_program_exec_logs_resolved_pid(basic_info, timeline_events)
-    extract_program_exec_logs_sec_pol_not_allow(basic_info, timeline_events)
-    extract_program_exec_logs_sudo(basic_info, timeline_events)
-    extract_program_exec_logs_tccd(basic_info, timeline_events)
-    extract_program_exec_logs_sandbox_violation(basic_info, timeline_events)
-
-    log.info(f"Detected {len(timeline_events)} events.")
-    if len(timeline_events) > 0:
-        basic_info.data_writer.write_data_rows(timeline_events)
-        return True
-
-    return False
+    extractors = (
+        extract_program_exec_spotlightshortcuts,
+        extract_program_exec_logs_launch,
+        extract_program_exec_logs_tempsign,
+        extract_program_exec_logs_adhoc,
+        extract_program_exec_logs_resolved_pid,
+        extract_program_exec_logs_sec_pol_not_allow,
+        extract_program_exec_logs_sudo,
+        extract_program_exec_logs_tccd,
+        extract_program_exec_logs_sandbox_violation,
+    )
+
+    # Hand the events of each extractor to the writer as soon as they are ready.
+    events_count = 0
+    for extractor in extractors:
+        timeline_events = []
+        basic_info.run_extractor(extractor, timeline_events)
+        if len(timeline_events) > 0:
+            basic_info.data_writer.write_data_rows(timeline_events)
+            events_count += len(timeline_events)
+
+    log.info(f"Detected {events_count} events.")
+    return events_count > 0
 
 
 if __name__ == '__main__':
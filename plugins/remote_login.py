@@ -11,7 +11,7 @@ import logging
 import os
 import re
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
 PLUGIN_DESCRIPTION = "Extract remote login activities."
@@ -19,6 +19,12 @@ PLUGIN_ACTIVITY_TYPE = "Remote Login"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('UNIFIED_LOGS',)
+
+PLUGIN_UNIFIEDLOGS_FILTERS = {
+    'extract_remote_authentication_sshd': ({'ProcessName': 'sshd', 'SenderName': 'sshd'},),
+    'extract_remote_authentication_screensharing': ({'ProcessName': 'screensharingd'},),
+}
 
 log = None
 
@@ -29,7 +35,7 @@ def extract_remote_authentication_sshd(basic_info: BasicInfo, timeline_events: l
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
+    select = basic_info.mac_apt_dbs.select
     start_ts, end_ts = basic_info.get_between_dates_utc()
     # sshd log samples
     ### accepted login and logout
@@ -54,33 +60,27 @@ def extract_remote_authentication_sshd(basic_info: BasicInfo, timeline_events: l
     # [Info: Connection closed by invalid user ZZZZZ 172.16.114.1 port 62588 [preauth]]
     # [Default] error: maximum authentication attempts exceeded for invalid user ZZZZZ from 172.16.114.1 port 59701 ssh2 [preauth]
     # [Info] Disconnecting invalid user ZZZZZ 172.16.114.1 port 59701: Too many authentication failures [preauth]
-    sql_loginout = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "sshd" AND SenderName == "sshd" AND \
-                (Message LIKE "fatal: Timeout before authentication for %" OR \
-                Message LIKE "Accepted % for % from %" OR \
-                Message LIKE "Disconnected from %"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
-    sql_invalid_password = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "sshd" AND SenderName == "sshd" AND \
-                (Message LIKE "error: PAM: authentication error for %" OR \
-                Message LIKE "Failed password for % from % port %" OR \
-                Message LIKE "Connection closed by authenticating user %"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
-    sql_invalid_user = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "sshd" AND SenderName == "sshd" AND \
-                (Message LIKE "Invalid user %" OR \
-                Message LIKE "error: PAM: unknown user for illegal user %" OR \
-                Message LIKE "Failed % for invalid user % from % port %" OR \
-                Message LIKE "Connection closed by invalid user %" OR \
-                Message LIKE "error: maximum authentication attempts %" OR \
-                Message LIKE "Disconnecting invalid user %"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
+    # The message prefixes select a superset of the rows that the regexes below match.
+    sshd_query = dict(columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                      equals={'ProcessName': 'sshd', 'SenderName': 'sshd'}, order_by='TimeUtc')
+    query_loginout = TableQuery('UnifiedLogs', prefixes={'Message': (
+        'fatal: Timeout before authentication for ',
+        'Accepted ',
+        'Disconnected from '
+    )}, **sshd_query)
+    query_invalid_password = TableQuery('UnifiedLogs', prefixes={'Message': (
+        'error: PAM: authentication error for ',
+        'Failed password for ',
+        'Connection closed by authenticating user '
+    )}, **sshd_query)
+    query_invalid_user = TableQuery('UnifiedLogs', prefixes={'Message': (
+        'Invalid user ',
+        'error: PAM: unknown user for illegal user ',
+        'Failed ',
+        'Connection closed by invalid user ',
+        'error: maximum authentication attempts ',
+        'Disconnecting invalid user '
+    )}, **sshd_query)
 
     regex_loginout = (
         r'^fatal: Timeout before authentication for (?P<address>.+) port (?P<port>.+)',
@@ -103,7 +103,7 @@ def extract_remote_authentication_sshd(basic_info: BasicInfo, timeline_events: l
         r'^Disconnecting invalid user (?P<username>.+) (?P<address>.+) port (?P<port>.+): Too many authentication failures .+'
     )
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql_loginout):
+    for row in select(MacAptDBType.UNIFIED_LOGS, query_loginout):
         for idx, regex in enumerate(regex_loginout):
             if result := re.match(regex, row['Message']):
                 msg = ""
@@ -118,7 +118,7 @@ def extract_remote_authentication_sshd(basic_info: BasicInfo, timeline_events: l
                     event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, msg, PLUGIN_NAME]
                     timeline_events.append(event)
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql_invalid_password):
+    for row in select(MacAptDBType.UNIFIED_LOGS, query_invalid_password):
         for idx, regex in enumerate(regex_invalid_password):
             if result := re.match(regex, row['Message']):
                 msg = ""
@@ -137,7 +137,7 @@ def extract_remote_authentication_sshd(basic_info: BasicInfo, timeline_events: l
                     event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, msg, PLUGIN_NAME]
                     timeline_events.append(event)
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql_invalid_user):
+    for row in select(MacAptDBType.UNIFIED_LOGS, query_invalid_user):
         for idx, regex in enumerate(regex_invalid_user):
             if result := re.match(regex, row['Message']):
                 msg = ""
@@ -167,16 +167,14 @@ def extract_remote_authentication_screensharing(basic_info: BasicInfo, timeline_
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName == "screensharingd" AND \
-                Message LIKE "Authentication: %"\
-            ) \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'screensharingd'},
+                       prefixes={'Message': ('Authentication: ',)},
+                       order_by='TimeUtc')
     regex = r'^Authnetication: (?P<auth_result>.+) :: (?P<auth_result>.+) :: User Name: (?P<username>.+) :: Viewer Address: (?P<address>.+) :: Type: (?P<type>.+)'
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         if result := re.match(regex, row['Message']):
             msg = f"Screen Sharing: authentication={result['auth_result']}, user={result['username']}, addr={result['address']}, type={result['type']}"
             event = [row['TimeUtc'], PLUGIN_ACTIVITY_TYPE, msg, PLUGIN_NAME]
@@ -188,16 +186,22 @@ def extract_remote_authentication_screensharing(basic_info: BasicInfo, timeline_
 def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
-    timeline_events = []
-    extract_remote_authentication_sshd(basic_info, timeline_events)
-    extract_remote_authentication_screensharing(basic_info, timeline_events)
-
-    log.info(f"Detected {len(timeline_events)} events.")
-    if len(timeline_events) > 0:
-        basic_info.data_writer.write_data_rows(timeline_events)
-        return True
+    extractors = (
+        extract_remote_authentication_sshd,
+        extract_remote_authentication_screensharing,
+    )
 
-    return False
+    # Hand the events of each extractor to the writer as soon as they are ready.
+    events_count = 0
+    for extractor in extractors:
+        timeline_events = []
+        basic_info.run_extractor(extractor, timeline_events)
+        if len(timeline_events) > 0:
+            basic_info.data_writer.write_data_rows(timeline_events)
+            events_count += len(timeline_events)
+
+    log.info(f"Detected {events_count} events.")
+    return events_count > 0
 
 
 if __name__ == '__main__':
@@ -11,7 +11,7 @@ import logging
 import os
 import re
 
-from plugins.helpers.basic_info import BasicInfo, MacAptDBType
+from plugins.helpers.basic_info import BasicInfo, MacAptDBType, TableQuery
 
 PLUGIN_NAME = os.path.splitext(os.path.basename(__file__))[0].upper()
 PLUGIN_DESCRIPTION = "Extract volume mount/unmount activities."
@@ -19,6 +19,11 @@ PLUGIN_ACTIVITY_TYPE = "Volume Mount"
 PLUGIN_VERSION = "20230830"
 PLUGIN_AUTHOR = "Minoru Kobayashi"
 PLUGIN_AUTHOR_EMAIL = "unknownbit@gmail.com"
+PLUGIN_DB_TYPES = ('UNIFIED_LOGS',)
+
+PLUGIN_UNIFIEDLOGS_FILTERS = {
+    'extract_volume_mount_logs_hfs_apfs': ({'ProcessName': 'kernel'},),
+}
 
 log = None
 
@@ -28,17 +33,11 @@ def extract_volume_mount_logs_hfs_apfs(basic_info: BasicInfo, timeline_events: l
     if not basic_info.mac_apt_dbs.has_dbs(MacAptDBType.UNIFIED_LOGS):
         return False
 
-    run_query = basic_info.mac_apt_dbs.run_query
     start_ts, end_ts = basic_info.get_between_dates_utc()
-    sql = f'SELECT * FROM UnifiedLogs WHERE TimeUtc BETWEEN "{start_ts}" AND "{end_ts}" AND \
-            (ProcessName = "kernel" AND \
-                (Message LIKE "%mounted%" OR \
-                Message LIKE "%unmount%" OR \
-                Message LIKE "%mounting volume%" OR \
-                Message LIKE "%unmounting volume%"\
-                )\
-            ) \
-            ORDER BY TimeUtc;'
+    query = TableQuery('UnifiedLogs', columns=('TimeUtc', 'Message'), time_column='TimeUtc', start_ts=start_ts, end_ts=end_ts,
+                       equals={'ProcessName': 'kernel'},
+                       contains={'Message': ('mounted', 'unmount', 'mounting volume', 'unmounting volume')},
+                       order_by='TimeUtc')
 
     # ignore_volumes = ('Macintosh HD', 'Macintosh HD - Data', 'VM', 'Update', 'Preboot', 'Recovery', 'Boot OS X', 'macOS Base System', 'com.apple.TimeMachine.')
     ignore_volumes = ('Macintosh HD', 'Macintosh HD - Data', 'VM', 'Update', 'Preboot', 'Recovery', 'Boot OS X', 'macOS Base System')
@@ -54,7 +53,7 @@ def extract_volume_mount_logs_hfs_apfs(basic_info: BasicInfo, timeline_events: l
         'unmount_apfs_13': r'apfs_log_.+:\d+: disk.+ unmounting volume (.+), requested by:'  # macOS 13+
     }
 
-    for row in run_query(MacAptDBType.UNIFIED_LOGS, sql):
+    for row in basic_info.mac_apt_dbs.select(MacAptDBType.UNIFIED_LOGS, query):
         for reg_type, regex in regex_dic.items():
             result = re.match(regex, row['Message'])
             if result:
@@ -125,7 +124,7 @@ def run(basic_info: BasicInfo) -> bool:
     global log
     log = logging.getLogger(basic_info.output_params.logger_root + '.PLUGINS.' + PLUGIN_NAME)
     timeline_events = []
-    extract_volume_mount_logs_hfs_apfs(basic_info, timeline_events)
+    basic_info.run_extractor(extract_volume_mount_logs_hfs_apfs, timeline_events)
 
     log.info(f"Detected {len(timeline_events)} events.")
     if len(timeline_events) > 0: